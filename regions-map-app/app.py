@@ -5,23 +5,47 @@
 
 from __future__ import annotations
 
+import bisect
+import copy
+import csv
+import heapq
+import io
+import itertools
 import json
+import math
 import os
 import shutil
+import socket
+import sqlite3
+import struct
+import sys
 import tempfile
+import threading
+import time
 import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
 from werkzeug.security import check_password_hash, generate_password_hash
 import hashlib
 
 try:
     import geopandas as gpd
-    from shapely.geometry import Point
+    import numpy as np
+    import shapely
+    from pyproj import Geod, Transformer
+    from shapely.geometry import Point, mapping, shape
+    from shapely.ops import polylabel
+    from shapely.strtree import STRtree
 except ImportError as exc:  # pragma: no cover - fails fast on missing deps
     raise RuntimeError("لطفاً بسته GeoPandas را نصب کنید (pip install geopandas).") from exc
-from flask import Flask, render_template_string, request, session, redirect, url_for, jsonify
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - ویندوز: فقط قفل بین thread های همین process
+    fcntl = None
+from flask import Flask, g, has_request_context, render_template_string, request, session, redirect, url_for, jsonify
 from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 
@@ -30,8 +54,8 @@ BASE_DIR = Path(__file__).resolve().parent
 PARENT_DIR = BASE_DIR.parent
 
 # تنظیم مستقیم مسیر uploads - مسیر واقعی روی سرور
-# مسیر: /var/www/regions-map-app/uploads/uploads/regions
-UPLOAD_ROOT = PARENT_DIR / "uploads" / "uploads" / "regions"
+# مسیر: /var/www/regions-map-app/uploads/uploads/regions (با UPLOAD_ROOT قابل تغییر است، مثلاً برای تست‌ها)
+UPLOAD_ROOT = Path(os.environ.get("UPLOAD_ROOT", str(PARENT_DIR / "uploads" / "uploads" / "regions")))
 LOGO_DIR = UPLOAD_ROOT / "logos"
 
 # ساخت مسیرها در صورت عدم وجود
@@ -53,6 +77,8 @@ FEATURES_DIR.mkdir(parents=True, exist_ok=True)
 FEATURES_INDEX_FILE = UPLOAD_ROOT / "features_index.json"
 BUSINESSES_DIR = UPLOAD_ROOT / "businesses"
 BUSINESSES_DIR.mkdir(parents=True, exist_ok=True)
+GEOCODE_JOBS_DIR = UPLOAD_ROOT / "geocode_jobs"
+GEOCODE_JOBS_DIR.mkdir(parents=True, exist_ok=True)
 USERS_FILE = UPLOAD_ROOT / "users.json"
 
 ALLOWED_EXTENSIONS = {"zip", "geojson", "json"}
@@ -100,6 +126,25 @@ NEIGHBORHOOD_FIELDS = [
     "neighborhood",
 ]
 SLUG_FIELDS = ["toot_slug", "TootSlug", "TOOT_SLUG"]
+# فیلدهایی که در جستجوی هوشمند نام محله نادیده گرفته می‌شوند (با حروف کوچک)
+NEIGHBORHOOD_NAME_EXCLUDE_FIELDS = frozenset(["geometry", "tootapp_url", "district", "region", "city", "ostan", "id"])
+NEIGHBORHOOD_FALLBACK_EXCLUDE_FIELDS = NEIGHBORHOOD_NAME_EXCLUDE_FIELDS | {"lat", "lon", "longitude", "latitude"}
+LAT_FIELDS = ["lat", "latitude", "Lat", "LAT", "Latitude"]
+LON_FIELDS = ["lon", "longitude", "lng", "Lon", "LON", "Longitude", "Lng"]
+WEIGHT_FIELDS = ["weight", "value", "Weight", "WEIGHT", "Value"]
+# حداکثر تعداد نقاط در یک درخواست geocoding دسته‌ای
+NEIGHBORHOOD_BATCH_MAX_POINTS = 100000
+# حداکثر شعاع مجاز (متر) برای پیدا کردن نزدیک‌ترین محله وقتی نقطه داخل هیچ محله‌ای نیست
+NEIGHBORHOOD_MAX_FALLBACK_DISTANCE_M = 5000
+NEIGHBORHOOD_OVERLAP_MAX_RADIUS_M = 50000
+# همپوشانی‌های کوچک‌تر از این (متر مربع) حاصل خطای تصویر روی مرزهای مشترک هستند و گزارش نمی‌شوند
+NEIGHBORHOOD_OVERLAP_MIN_AREA_M2 = 1.0
+# طول حداکثر ضلع‌ها (درجه) قبل از تصویر کردن، تا خمیدگی اضلاع در تصویر هم‌مساحت لحاظ شود
+OVERLAP_SEGMENTIZE_DEGREES = 0.0005
+GEOD = Geod(ellps="WGS84")
+# دقت (درجه) محاسبه نقطه برچسب (pole of inaccessibility) هر محله
+LABEL_POINT_TOLERANCE_DEGREES = float(os.environ.get("LABEL_POINT_TOLERANCE_DEGREES", "0.00001"))
+FEATURE_METRIC_FIELDS = ("label_point", "area_m2", "perimeter_m", "bbox")
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "change-this-secret-key-in-production")
@@ -360,6 +405,8 @@ def load_geojson(file_obj: FileStorage, attach_links: bool = True) -> Tuple[Dict
         geojson = _load_geojson_from_shapefile(file_obj)
         gdf = gpd.GeoDataFrame.from_features(geojson["features"], crs="EPSG:4326")
 
+    assign_feature_ids(geojson)
+    assign_feature_metrics(geojson)
     if attach_links:
         _attach_tootapp_links(geojson)
 
@@ -417,7 +464,7 @@ def _attach_tootapp_links(geojson: Dict, map_id: Optional[str] = None) -> None:
         props = feature.setdefault("properties", {})
         
         # اول بررسی می‌کنیم که آیا لینک ذخیره شده‌ای وجود دارد
-        feature_id = get_feature_identifier(feature)
+        feature_id = props.get("feature_id") or get_feature_identifier(feature)
         if feature_id and feature_id in saved_links:
             saved_link = saved_links[feature_id]
             # اگر لینک کامل نبود، base URL را اضافه می‌کنیم
@@ -430,29 +477,97 @@ def _attach_tootapp_links(geojson: Dict, map_id: Optional[str] = None) -> None:
             props["tootapp_url"] = TOOTAPP_BASE_URL.rstrip('/')
 
 
+def assign_feature_ids(geojson: Dict) -> int:
+    """ثبت شناسه ثابت هر feature در properties["feature_id"] (فقط برای featureهایی که هنوز ندارند)
+    خروجی: تعداد شناسه‌های جدید
+    """
+    assigned = 0
+    for feature in geojson.get("features", []):
+        props = feature.get("properties")
+        if props is None:
+            props = feature["properties"] = {}
+        existing = props.get("feature_id")
+        if existing not in (None, ""):
+            if not isinstance(existing, str):
+                props["feature_id"] = str(existing).strip()
+                assigned += 1
+            continue
+        feature_id = get_feature_identifier(feature)
+        if feature_id:
+            props["feature_id"] = feature_id
+            assigned += 1
+    return assigned
+
+
+def _label_point(geom):
+    """نقطه برچسب: دورترین نقطه داخل polygon از مرزها (polylabel)، برای MultiPolygon روی بزرگ‌ترین بخش"""
+    polygonal = _polygonal(geom)
+    if polygonal is None:
+        return geom.representative_point()
+    largest = max(shapely.get_parts(polygonal), key=lambda part: part.area)
+    try:
+        return polylabel(largest, tolerance=LABEL_POINT_TOLERANCE_DEGREES)
+    except shapely.errors.GEOSException:
+        return largest.representative_point()
+
+
+def assign_feature_metrics(geojson: Dict, only_missing: bool = False) -> int:
+    """ثبت نقطه برچسب، مساحت و محیط ژئودزیک (متر) و bbox هر feature در properties
+    فیلد area که دستی وارد می‌شود دست نمی‌خورد؛ مقادیر محاسبه شده در area_m2 و perimeter_m هستند.
+    با only_missing فقط featureهایی که هنوز این فیلدها را ندارند محاسبه می‌شوند (نقشه‌های قدیمی).
+    خروجی: تعداد featureهای به‌روز شده
+    """
+    updated = 0
+    for feature in geojson.get("features", []):
+        props = feature.get("properties")
+        if props is None:
+            props = feature["properties"] = {}
+        if only_missing and all(field in props for field in FEATURE_METRIC_FIELDS):
+            continue
+        if not feature.get("geometry"):
+            continue
+        try:
+            geom = shape(feature["geometry"])
+            if not geom.is_valid:
+                geom = shapely.make_valid(geom)
+        except Exception:
+            continue
+        if geom.is_empty:
+            continue
+        area, perimeter = GEOD.geometry_area_perimeter(geom)
+        label = _label_point(geom)
+        props["label_point"] = [round(label.x, 6), round(label.y, 6)]
+        props["area_m2"] = round(abs(area), 2)
+        props["perimeter_m"] = round(perimeter, 2)
+        props["bbox"] = [round(value, 6) for value in geom.bounds]
+        updated += 1
+    return updated
+
+
 def load_history() -> List[Dict]:
-    """بارگذاری تاریخچه آپلودها از فایل JSON"""
-    if not HISTORY_FILE.exists():
-        return []
+    """بارگذاری تاریخچه آپلودها از فایل JSON (از کش فایل‌ها) یا SQLite"""
+    if METADATA_BACKEND == "sqlite":
+        return _sqlite_load_history()
     try:
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return cached_file_read(HISTORY_FILE, _read_json_file) or []
     except (json.JSONDecodeError, IOError):
         return []
 
 
 def save_history(history: List[Dict]) -> None:
-    """ذخیره تاریخچه آپلودها در فایل JSON"""
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
+    """ذخیره تاریخچه آپلودها در فایل JSON یا SQLite"""
+    if METADATA_BACKEND == "sqlite":
+        _sqlite_save_history(history)
+        return
+    write_json_atomic(HISTORY_FILE, history)
 
 
 def save_map_data(map_id: str, geojson: Dict, summary: Dict, original_filename: str) -> None:
-    """ذخیره داده‌های نقشه در فایل JSON"""
-    map_file = STORAGE_DIR / f"{map_id}.json"
-    
+    """ذخیره داده‌های نقشه در فایل ستونی (بخش Map Store)"""
     # پاکسازی GeoJSON از انواع غیرقابل JSON serialization
     cleaned_geojson = _clean_geojson_for_json(geojson)
+    assign_feature_ids(cleaned_geojson)
+    assign_feature_metrics(cleaned_geojson, only_missing=True)
     
     data = {
         "geojson": cleaned_geojson,
@@ -461,30 +576,50 @@ def save_map_data(map_id: str, geojson: Dict, summary: Dict, original_filename:
         "map_id": map_id,
         "upload_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
-    with open(map_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+    write_map_store(map_id, data)
+    legacy_file = STORAGE_DIR / f"{map_id}.json"
+    if legacy_file.exists():
+        legacy_file.unlink()
+    invalidate_map_index(map_id)
+    
+    # ساخت ایندکس مکانی، شبکه پیش‌طبقه‌بندی و لایه‌های منطقه/شهر در زمان آپلود (نه در اولین درخواست API)
+    try:
+        get_map_index(map_id)
+        build_derived_layers(map_id)
+    except Exception as e:
+        print(f"Error building spatial index for map {map_id}: {e}")
 
 
 def load_map_data(map_id: str) -> Optional[Dict]:
-    """بارگذاری داده‌های نقشه از فایل JSON"""
-    map_file = STORAGE_DIR / f"{map_id}.json"
-    if not map_file.exists():
-        return None
-    try:
-        with open(map_file, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError):
+    """بارگذاری کامل داده‌های نقشه از فایل ستونی (از کش فایل‌ها) یا (برای نقشه‌های قدیمی) فایل JSON"""
+    map_data = cached_file_read(get_map_store_file(map_id), _read_map_store_data, clone=_copy_map_data)
+    if map_data is not None:
+        return map_data
+
+    map_data = _load_map_json(map_id)
+    if map_data is None:
         return None
 
+    # نقشه‌های قدیمی: شناسه‌ها و مساحت/نقطه برچسب یک بار ساخته و همراه با انتقال به فایل ستونی ذخیره می‌شوند
+    geojson = map_data.get("geojson") or {}
+    if assign_feature_ids(geojson) + assign_feature_metrics(geojson, only_missing=True):
+        try:
+            write_map_store(map_id, map_data)
+            (STORAGE_DIR / f"{map_id}.json").unlink()
+        except (OSError, ValueError) as e:
+            print(f"Error saving feature ids/metrics for map {map_id}: {e}")
+    return map_data
+
 
 def find_duplicate_map(map_name: str, filename: str) -> Optional[str]:
     """پیدا کردن نقشه قبلی با همان نام"""
-    history = load_history()
     search_name = (map_name or filename).lower().strip()
+    if METADATA_BACKEND == "sqlite":
+        return _sqlite_find_map_by_name(search_name)
+    history = load_history()
     
     for item in history:
-        item_name = (item.get("map_name") or item.get("original_filename", "")).lower().strip()
-        if item_name == search_name:
+        if _history_name_key(item) == search_name:
             return item.get("map_id")
     return None
 
@@ -499,21 +634,24 @@ def transfer_links(old_map_id: str, new_map_id: str) -> None:
 def delete_map(map_id: str, keep_links: bool = False) -> bool:
     """حذف نقشه از تاریخچه و فایل ذخیره شده"""
     try:
-        # حذف فایل JSON
-        map_file = STORAGE_DIR / f"{map_id}.json"
-        if map_file.exists():
-            map_file.unlink()
+        # حذف فایل داده‌های نقشه
+        delete_map_files(map_id)
 
         # حذف فایل لینک‌ها فقط اگر keep_links False باشد
         if not keep_links:
-            links_file = LINKS_DIR / f"{map_id}.json"
-            if links_file.exists():
-                links_file.unlink()
+            delete_links(map_id)
+        edits_file = get_neighborhood_edits_file(map_id)
+        with file_lock(edits_file):
+            remove_lock_file(edits_file)
 
         # حذف از تاریخچه
-        history = load_history()
-        history = [item for item in history if item.get("map_id") != map_id]
-        save_history(history)
+        with file_lock(HISTORY_FILE):
+            history = load_history()
+            history = [item for item in history if item.get("map_id") != map_id]
+            save_history(history)
+        invalidate_map_index(map_id)
+        delete_derived_layers(map_id)
+        delete_map_snapshots(map_id)
 
         return True
     except Exception:
@@ -522,21 +660,33 @@ def delete_map(map_id: str, keep_links: bool = False) -> bool:
 
 def load_links(map_id: str) -> Dict[str, str]:
     """بارگذاری لینک‌های توت‌اپ برای یک نقشه"""
+    if METADATA_BACKEND == "sqlite":
+        return _sqlite_load_links(map_id)
     links_file = LINKS_DIR / f"{map_id}.json"
-    if not links_file.exists():
-        return {}
     try:
-        with open(links_file, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return cached_file_read(links_file, _read_json_file, clone=dict) or {}
     except (json.JSONDecodeError, IOError):
         return {}
 
 
 def save_links(map_id: str, links: Dict[str, str]) -> None:
     """ذخیره لینک‌های توت‌اپ برای یک نقشه"""
+    if METADATA_BACKEND == "sqlite":
+        _sqlite_save_links(map_id, links)
+    else:
+        write_json_atomic(LINKS_DIR / f"{map_id}.json", links)
+    invalidate_map_index(map_id)
+
+
+def delete_links(map_id: str) -> None:
+    """حذف لینک‌های توت‌اپ یک نقشه (همراه فایل قفل آن)"""
     links_file = LINKS_DIR / f"{map_id}.json"
-    with open(links_file, "w", encoding="utf-8") as f:
-        json.dump(links, f, ensure_ascii=False, indent=2)
+    with file_lock(links_file):
+        if METADATA_BACKEND == "sqlite":
+            _sqlite_save_links(map_id, None)
+        elif links_file.exists():
+            links_file.unlink()
+        remove_lock_file(links_file)
 
 
 def get_neighborhood_key(map_id: str, neighborhood_name: str) -> str:
@@ -556,6 +706,9 @@ def load_neighborhood_logo(map_id: str, neighborhood_name: str) -> Optional[str]
     if not neighborhood_name or not neighborhood_name.strip():
         return None
     
+    if METADATA_BACKEND == "sqlite":
+        return _sqlite_load_neighborhood_logo(map_id, neighborhood_name)
+    
     neighborhood_name_clean = neighborhood_name.strip()
     neighborhood_name_normalized = neighborhood_name_clean.lower()
     
@@ -612,18 +765,22 @@ def load_neighborhood_logo(map_id: str, neighborhood_name: str) -> Optional[str]
 
 def save_neighborhood_logo(map_id: str, neighborhood_name: str, logo_filename: str) -> None:
     """ذخیره نام فایل لوگوی محله"""
+    if METADATA_BACKEND == "sqlite":
+        _sqlite_save_neighborhood_logo(map_id, neighborhood_name, logo_filename)
+        return
     logo_file = get_neighborhood_logo_path(map_id, neighborhood_name)
     data = {
         "map_id": map_id,
         "neighborhood_name": neighborhood_name,
         "logo_filename": logo_filename
     }
-    with open(logo_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    write_json_atomic(logo_file, data)
 
 
 def get_all_neighborhood_logos(map_id: str) -> Dict[str, str]:
     """دریافت تمام لوگوهای محلات یک نقشه"""
+    if METADATA_BACKEND == "sqlite":
+        return _sqlite_get_all_neighborhood_logos(map_id)
     logos = {}
     if not LOGO_DIR.exists():
         return logos
@@ -641,6 +798,23 @@ def get_all_neighborhood_logos(map_id: str) -> Dict[str, str]:
     return logos
 
 
+def rename_neighborhood_logo_file(map_id: str, old_filename: str, new_filename: str) -> None:
+    """اصلاح نام فایل عکس ثبت شده برای لوگوهای یک نقشه (وقتی فایل با پسوند دیگری پیدا شده باشد)"""
+    if METADATA_BACKEND == "sqlite":
+        _sqlite_rename_neighborhood_logo_file(map_id, old_filename, new_filename)
+        return
+    for json_file in LOGO_DIR.glob("*.json"):
+        try:
+            with open(json_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("logo_filename") == old_filename and data.get("map_id") == map_id:
+                data["logo_filename"] = new_filename
+                write_json_atomic(json_file, data)
+                break
+        except Exception:
+            continue
+
+
 def get_neighborhood_edits_file(map_id: str) -> Path:
     """مسیر فایل ویرایش‌های محلات یک نقشه"""
     return NEIGHBORHOOD_EDITS_DIR / f"{map_id}.json"
@@ -648,21 +822,39 @@ def get_neighborhood_edits_file(map_id: str) -> Path:
 
 def load_neighborhood_edits(map_id: str) -> Dict[str, Dict]:
     """بارگذاری ویرایش‌های محلات یک نقشه"""
+    if METADATA_BACKEND == "sqlite":
+        return _sqlite_load_neighborhood_edits(map_id)
     edits_file = get_neighborhood_edits_file(map_id)
-    if not edits_file.exists():
-        return {}
     try:
-        with open(edits_file, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return cached_file_read(edits_file, _read_json_file) or {}
     except Exception:
         return {}
 
 
+def _read_neighborhood_edits_by_feature(path: Path) -> Tuple[Dict, Dict]:
+    """(همه ویرایش‌ها، ویرایش هر feature_id) از فایل ویرایش‌های یک نقشه"""
+    edits = _read_json_file(path)
+    return edits, _edits_by_feature(edits)
+
+
+def _edits_by_feature(edits: Dict[str, Dict]) -> Dict[str, Dict]:
+    """ویرایش هر feature_id - اولین ویرایش هر feature_id مثل جستجوی خطی قبلی انتخاب می‌شود"""
+    by_feature = {}
+    for edit_item in edits.values():
+        if isinstance(edit_item, dict):
+            item_feature_id = str(edit_item.get("feature_id", "")).strip()
+            if item_feature_id:
+                by_feature.setdefault(item_feature_id, edit_item.get("edits", {}))
+    return by_feature
+
+
 def save_neighborhood_edits(map_id: str, edits: Dict[str, Dict]) -> None:
     """ذخیره ویرایش‌های محلات یک نقشه"""
-    edits_file = get_neighborhood_edits_file(map_id)
-    with open(edits_file, "w", encoding="utf-8") as f:
-        json.dump(edits, f, ensure_ascii=False, indent=2)
+    if METADATA_BACKEND == "sqlite":
+        _sqlite_save_neighborhood_edits(map_id, edits)
+    else:
+        write_json_atomic(get_neighborhood_edits_file(map_id), edits)
+    invalidate_map_index(map_id)
 
 
 def get_neighborhood_edit_key(feature_id: str, original_name: str) -> str:
@@ -678,20 +870,20 @@ def apply_neighborhood_edits(props: Dict, map_id: str, feature_id: str, original
     if not feature_id:
         return props
     
-    edits = load_neighborhood_edits(map_id)
-    if not edits:
+    # ویرایش‌ها فقط خوانده می‌شوند، پس نسخه کش شده بدون کپی استفاده می‌شود (برای هر feature صدا زده می‌شود)
+    try:
+        if METADATA_BACKEND == "sqlite":
+            cached = _sqlite_neighborhood_edits_by_feature(map_id)
+        else:
+            cached = cached_file_read(get_neighborhood_edits_file(map_id), _read_neighborhood_edits_by_feature, clone=None)
+    except Exception:
+        cached = None
+    if not cached or not cached[0]:
         return props
+    edits, by_feature = cached
     
-    # جستجو در تمام ویرایش‌ها برای پیدا کردن ویرایش مربوط به این feature_id
-    edit_data = None
-    for key, edit_item in edits.items():
-        if isinstance(edit_item, dict):
-            # مقایسه feature_id (می‌تواند string یا number باشد)
-            item_feature_id = str(edit_item.get("feature_id", "")).strip()
-            current_feature_id = str(feature_id).strip()
-            if item_feature_id and current_feature_id and item_feature_id == current_feature_id:
-                edit_data = edit_item.get("edits", {})
-                break
+    # ویرایش مربوط به این feature_id (می‌تواند string یا number باشد)
+    edit_data = by_feature.get(str(feature_id).strip())
     
     # اگر ویرایش پیدا نشد، از کلید مستقیم استفاده کن
     if edit_data is None:
@@ -718,21 +910,25 @@ def apply_neighborhood_edits(props: Dict, map_id: str, feature_id: str, original
     return props
 
 
-def load_features_index() -> List[Dict]:
-    """بارگذاری فهرست عوارض محله‌ها"""
-    if not FEATURES_INDEX_FILE.exists():
-        return []
+def load_features_index(map_id: Optional[str] = None) -> List[Dict]:
+    """بارگذاری فهرست عوارض محله‌ها (همه، یا فقط عوارض یک نقشه)"""
+    if METADATA_BACKEND == "sqlite":
+        return _sqlite_load_features_index(map_id)
     try:
-        with open(FEATURES_INDEX_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        index = cached_file_read(FEATURES_INDEX_FILE, _read_json_file) or []
     except (json.JSONDecodeError, IOError):
         return []
+    if map_id is not None:
+        index = [item for item in index if item.get("map_id") == map_id]
+    return index
 
 
 def save_features_index(index: List[Dict]) -> None:
     """ذخیره فهرست عوارض محله‌ها"""
-    with open(FEATURES_INDEX_FILE, "w", encoding="utf-8") as f:
-        json.dump(index, f, ensure_ascii=False, indent=2)
+    if METADATA_BACKEND == "sqlite":
+        _sqlite_save_features_index(index)
+        return
+    write_json_atomic(FEATURES_INDEX_FILE, index)
 
 
 def load_feature_data(feature_id: str) -> Optional[Dict]:
@@ -763,8 +959,7 @@ def save_feature_data(feature_id: str, geojson: Dict, summary: Dict, original_fi
         "feature_name": feature_name,
         "upload_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
-    with open(feature_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+    write_json_atomic(feature_file, data, default=str)
 
 
 def get_feature_identifier(feature: Dict) -> Optional[str]:
@@ -802,36 +997,47 @@ def get_feature_identifier(feature: Dict) -> Optional[str]:
     return None
 
 
+def default_admin_user() -> Dict:
+    """کاربر پیش‌فرض admin برای نصب جدید"""
+    return {
+        "username": "admin",
+        "password_hash": generate_password_hash("admin123", method="pbkdf2:sha256"),
+        "role": "admin",
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "last_login": None
+    }
+
+
 def load_users() -> List[Dict]:
-    """بارگذاری لیست کاربران از فایل JSON"""
+    """بارگذاری لیست کاربران از فایل JSON یا SQLite
+    کاربر پیش‌فرض admin فقط وقتی فایل کاربران وجود ندارد ساخته می‌شود؛ در SQLite این کار فقط در انتقال
+    اولیه (import_metadata_from_files) انجام می‌شود، نه با خالی بودن جدول.
+    """
+    if METADATA_BACKEND == "sqlite":
+        return _sqlite_load_users()
     if not USERS_FILE.exists():
-        # ایجاد کاربر پیش‌فرض admin
-        default_admin = {
-            "username": "admin",
-            "password_hash": generate_password_hash("admin123", method="pbkdf2:sha256"),
-            "role": "admin",
-            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "last_login": None
-        }
-        users = [default_admin]
+        users = [default_admin_user()]
         save_users(users)
         return users
     
     try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return cached_file_read(USERS_FILE, _read_json_file) or []
     except (json.JSONDecodeError, IOError):
         return []
 
 
 def save_users(users: List[Dict]) -> None:
-    """ذخیره لیست کاربران در فایل JSON"""
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
+    """ذخیره لیست کاربران در فایل JSON یا SQLite"""
+    if METADATA_BACKEND == "sqlite":
+        _sqlite_save_users(users)
+        return
+    write_json_atomic(USERS_FILE, users)
 
 
 def get_user(username: str) -> Optional[Dict]:
     """دریافت اطلاعات یک کاربر"""
+    if METADATA_BACKEND == "sqlite":
+        return _sqlite_get_user(username)
     users = load_users()
     return next((u for u in users if u.get("username") == username), None)
 
@@ -864,21 +1070,22 @@ def create_user(username: str, password: str, role: str = "viewer") -> Tuple[boo
     if role not in ROLES:
         return False, "نقش نامعتبر است"
     
-    users = load_users()
-    if any(u.get("username") == username for u in users):
-        return False, "نام کاربری قبلاً استفاده شده است"
-    
-    new_user = {
-        "username": username,
-        "password_hash": generate_password_hash(password, method="pbkdf2:sha256"),
-        "role": role,
-        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "last_login": None
-    }
-    
-    users.append(new_user)
-    save_users(users)
-    return True, "کاربر با موفقیت ایجاد شد"
+    with file_lock(USERS_FILE):
+        users = load_users()
+        if any(u.get("username") == username for u in users):
+            return False, "نام کاربری قبلاً استفاده شده است"
+        
+        new_user = {
+            "username": username,
+            "password_hash": generate_password_hash(password, method="pbkdf2:sha256"),
+            "role": role,
+            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "last_login": None
+        }
+        
+        users.append(new_user)
+        save_users(users)
+        return True, "کاربر با موفقیت ایجاد شد"
 
 
 def update_user_password(username: str, new_password: str) -> Tuple[bool, str]:
@@ -886,14 +1093,15 @@ def update_user_password(username: str, new_password: str) -> Tuple[bool, str]:
     if len(new_password) < 6:
         return False, "رمز عبور باید حداقل 6 کاراکتر باشد"
     
-    users = load_users()
-    user = next((u for u in users if u.get("username") == username), None)
-    if not user:
-        return False, "کاربر پیدا نشد"
-    
-    user["password_hash"] = generate_password_hash(new_password, method="pbkdf2:sha256")
-    save_users(users)
-    return True, "رمز عبور با موفقیت تغییر کرد"
+    with file_lock(USERS_FILE):
+        users = load_users()
+        user = next((u for u in users if u.get("username") == username), None)
+        if not user:
+            return False, "کاربر پیدا نشد"
+        
+        user["password_hash"] = generate_password_hash(new_password, method="pbkdf2:sha256")
+        save_users(users)
+        return True, "رمز عبور با موفقیت تغییر کرد"
 
 
 def update_user_role(username: str, new_role: str) -> Tuple[bool, str]:
@@ -901,31 +1109,33 @@ def update_user_role(username: str, new_role: str) -> Tuple[bool, str]:
     if new_role not in ROLES:
         return False, "نقش نامعتبر است"
     
-    users = load_users()
-    user = next((u for u in users if u.get("username") == username), None)
-    if not user:
-        return False, "کاربر پیدا نشد"
-    
-    user["role"] = new_role
-    save_users(users)
-    return True, "نقش کاربر با موفقیت تغییر کرد"
+    with file_lock(USERS_FILE):
+        users = load_users()
+        user = next((u for u in users if u.get("username") == username), None)
+        if not user:
+            return False, "کاربر پیدا نشد"
+        
+        user["role"] = new_role
+        save_users(users)
+        return True, "نقش کاربر با موفقیت تغییر کرد"
 
 
 def delete_user(username: str) -> Tuple[bool, str]:
     """حذف کاربر"""
-    users = load_users()
-    if len(users) <= 1:
-        return False, "حداقل باید یک کاربر وجود داشته باشد"
-    
-    if username == session.get("username"):
-        return False, "نمی‌توانید خودتان را حذف کنید"
-    
-    users = [u for u in users if u.get("username") != username]
-    if len(users) == len(load_users()):
-        return False, "کاربر پیدا نشد"
-    
-    save_users(users)
-    return True, "کاربر با موفقیت حذف شد"
+    with file_lock(USERS_FILE):
+        users = load_users()
+        if len(users) <= 1:
+            return False, "حداقل باید یک کاربر وجود داشته باشد"
+        
+        if username == session.get("username"):
+            return False, "نمی‌توانید خودتان را حذف کنید"
+        
+        users = [u for u in users if u.get("username") != username]
+        if len(users) == len(load_users()):
+            return False, "کاربر پیدا نشد"
+        
+        save_users(users)
+        return True, "کاربر با موفقیت حذف شد"
 
 
 def has_permission(permission: str) -> bool:
@@ -947,146 +1157,3107 @@ def is_admin() -> bool:
     return has_permission("manage_users")
 
 
-# ========== Templates ==========
+# ========== Map Store ==========
 
-LOGIN_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="fa">
-<head>
-  <meta charset="utf-8" />
-  <title>ورود ادمین - نقشه محلات</title>
-  <meta name="viewport" content="width=device-width, initial-scale=1" />
-  <style>
-    body { font-family: sans-serif; background: #f4f6f8; margin: 0; padding: 0; direction: rtl; }
-    .container { max-width: 400px; margin: 5rem auto; padding: 2rem; background: #fff; border-radius: 12px; box-shadow: 0 15px 35px rgba(0,0,0,0.1); }
-    h1 { text-align: center; color: #1f4e5f; margin-bottom: 1.5rem; }
-    input[type="password"] { width: 100%; padding: 0.75rem; border: 1px solid #dde3ea; border-radius: 8px; margin-bottom: 1rem; box-sizing: border-box; }
-    button { width: 100%; padding: 0.75rem; border: none; border-radius: 8px; font-size: 1rem; cursor: pointer; background: #2a9d8f; color: #fff; }
-    .error { color: #d62828; margin-top: 0.75rem; text-align: center; }
-    .back-link { text-align: center; margin-top: 1rem; }
-    .back-link a { color: #2a9d8f; text-decoration: none; }
-  </style>
-</head>
-<body>
-  <div class="container">
-    <h1>ورود به پنل مدیریت</h1>
-    <form method="post">
-      <input type="text" name="username" placeholder="نام کاربری" required autofocus />
-      <input type="password" name="password" placeholder="رمز عبور" required />
-      <button type="submit">ورود</button>
-      {% if error %}
-        <div class="error">{{ error }}</div>
-      {% endif %}
-    </form>
-    <div class="back-link">
-      <a href="/">بازگشت به صفحه اصلی</a>
-    </div>
-  </div>
-</body>
-</html>
-"""
+# هر نقشه در یک فایل باینری ستونی STORAGE_DIR/{map_id}.store ذخیره می‌شود (به جای JSON با indent).
+# geometry ها به صورت WKB پشت سر هم و هر فیلد properties یک ستون نوع‌دار است، پس می‌توان فقط geometry ها،
+# فقط ویژگی‌ها یا یک feature را خواند. فایل‌های JSON قدیمی ({map_id}.json) همچنان خوانده می‌شوند
+# و در اولین ذخیره به این قالب منتقل می‌شوند.
+#
+# ساختار (little-endian):
+#   magic "RMAP" | uint16 نسخه قالب | uint16 رزرو | uint32 طول header
+#   header JSON (UTF-8): اطلاعات نقشه، کلیدهای FeatureCollection، ستون‌ها و محل هر آرایه
+#   آرایه‌ها (هر کدام از مرز ۸ بایت، offset نسبت به انتهای header):
+#     geometry: wkb (uint8) + wkb_offsets (int64[n + 1])، طول صفر یعنی بدون geometry
+#     هر ستون: state (uint8[n]: ۰ کلید وجود ندارد، ۱ مقدار، ۲ null) و مقادیر:
+#       int → int64[n] | float → float64[n] | bool → uint8[n] | str و json → blob (UTF-8) + offsets (int64[n + 1])
+#   کلیدهای دیگر هر feature (مثل id) در ستون json جداگانه extras نگه داشته می‌شوند.
+MAP_STORE_MAGIC = b"RMAP"
+MAP_STORE_FORMAT_VERSION = 1
+MAP_STORE_SUFFIX = ".store"
+_MAP_STORE_HEADER = struct.Struct("<4sHHI")
+_MISSING = object()
 
-ADMIN_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="fa">
-<head>
-  <meta charset="utf-8" />
-  <title>پنل ادمین - آپلود نقشه</title>
-  <meta name="viewport" content="width=device-width, initial-scale=1" />
-  <style>
-    body { font-family: sans-serif; background: #f4f6f8; margin: 0; padding: 0; direction: rtl; }
-    header { padding: 1.5rem; text-align: center; background: #1f4e5f; color: #fff; }
-    main { max-width: 1100px; margin: 1.5rem auto; padding: 0 1rem 2rem; }
-    .card { background: #fff; border-radius: 12px; padding: 1.5rem; margin-bottom: 1.5rem; box-shadow: 0 15px 35px rgba(0,0,0,0.07); }
-    input[type="file"], input[type="text"] { width: 100%; padding: 0.75rem; border: 1px solid #dde3ea; border-radius: 8px; margin-bottom: 1rem; box-sizing: border-box; }
-    button { padding: 0.75rem 1.5rem; border: none; border-radius: 8px; font-size: 1rem; cursor: pointer; background: #2a9d8f; color: #fff; margin-left: 0.5rem; }
-    button.logout { background: #d62828; }
-    button.delete { background: #d62828; padding: 0.5rem 1rem; font-size: 0.9rem; }
-    .error { color: #d62828; margin-top: 0.75rem; }
-    .success { color: #2a9d8f; margin-top: 0.75rem; }
-    .back-link { margin-top: 1rem; }
-    .back-link a { color: #2a9d8f; text-decoration: none; }
-    .history-list { list-style: none; padding: 0; margin-top: 1rem; }
-    .history-item { padding: 1rem; margin-bottom: 0.5rem; background: #f8f9fa; border-radius: 8px; display: flex; justify-content: space-between; align-items: center; }
-    .history-item-info { flex: 1; }
-    .history-item-actions { margin-right: 1rem; }
-    h2 { margin-top: 0; }
-  </style>
-</head>
-<body>
-  <header>
-    <h1>پنل مدیریت - آپلود نقشه</h1>
-    <p>کاربر: {{ current_username }} ({{ current_role_name }})</p>
-  </header>
-  <main>
-    <div class="card">
-      <div style="text-align: left; margin-bottom: 1rem;">
-        <a href="/" style="color: #2a9d8f; text-decoration: none;">← بازگشت به صفحه اصلی</a>
-        {% if has_manage_users %}
-        <a href="/admin/users" style="text-decoration: none; margin-right: 1rem;">
-          <button type="button" style="background: #6f42c1;">مدیریت کاربران</button>
-        </a>
-        {% endif %}
-        <form method="post" action="/admin/logout" style="display: inline; margin-right: 1rem;">
-          <button type="submit" class="logout">خروج</button>
-        </form>
-      </div>
-      <form method="post" enctype="multipart/form-data">
-        <label>نام نقشه (اختیاری):</label>
-        <input type="text" name="map_name" placeholder="مثلاً: محلات تهران" />
-        <label>انتخاب فایل (Zip حاوی Shapefile یا GeoJSON):</label>
-        <input type="file" name="shapefile" accept=".zip,.geojson,.json" required />
-        <button type="submit">آپلود و ذخیره</button>
-        {% if error %}
-          <div class="error">{{ error }}</div>
-        {% endif %}
-        {% if success %}
-          <div class="success">{{ success }}</div>
-        {% endif %}
-      </form>
-    </div>
-    <div class="card">
-      <h2>آپلود عوارض محله</h2>
-      <p style="color: #6c757d; margin-bottom: 1rem;">برای آپلود عوارض محله (مثلاً پارک‌ها، مدارس، مراکز خرید و...) ابتدا نقشه را انتخاب کنید:</p>
-      <form id="uploadFeatureForm" enctype="multipart/form-data" onsubmit="uploadFeature(event)">
-        <label>انتخاب نقشه:</label>
-        <select name="map_id" id="featureMapId" required style="width: 100%; padding: 0.75rem; border: 1px solid #dde3ea; border-radius: 8px; margin-bottom: 1rem; box-sizing: border-box;">
-          <option value="">-- انتخاب نقشه --</option>
-          {% for item in history %}
-          <option value="{{ item.map_id }}">{{ item.map_name or item.original_filename }}</option>
-          {% endfor %}
-        </select>
-        <label>نام عارضه (اختیاری):</label>
-        <input type="text" name="feature_name" placeholder="مثلاً: پارک‌های تهران" />
-        <label>انتخاب فایل (Zip حاوی Shapefile یا GeoJSON):</label>
-        <input type="file" name="shapefile" accept=".zip,.geojson,.json" required />
-        <button type="submit">آپلود عوارض</button>
-      </form>
-      <div id="featureUploadStatus" style="margin-top: 1rem;"></div>
-    </div>
-    <div class="card">
-      <h2>تاریخچه نقشه‌ها</h2>
-      {% if history %}
-      <ul class="history-list">
-        {% for item in history %}
-        <li class="history-item">
-          <div class="history-item-info">
-            <strong>{{ item.map_name or item.original_filename }}</strong><br/>
-            <small>تاریخ: {{ item.upload_date }} | تعداد عوارض: {{ item.feature_count }} | شناسه: {{ item.map_id }}</small>
-          </div>
-          <div class="history-item-actions">
-            <a href="/admin/links/{{ item.map_id }}" style="text-decoration: none;">
-              <button type="button" style="background: #2a9d8f; padding: 0.5rem 1rem; font-size: 0.9rem; margin-left: 0.5rem;">مدیریت لینک‌های محلات</button>
-            </a>
-            <a href="/admin/neighborhoods/edit/{{ item.map_id }}" style="text-decoration: none;">
-              <button type="button" style="background: #17a2b8; padding: 0.5rem 1rem; font-size: 0.9rem; margin-left: 0.5rem;">ویرایش محلات</button>
-            </a>
-            <a href="/admin/features/links/{{ item.map_id }}" style="text-decoration: none;">
-              <button type="button" style="background: #ffc107; color: #000; padding: 0.5rem 1rem; font-size: 0.9rem; margin-left: 0.5rem;">مدیریت لینک‌های عوارض</button>
-            </a>
-            <form method="post" action="/admin/delete/{{ item.map_id }}" style="display: inline;" onsubmit="return confirm('آیا مطمئن هستید که می‌خواهید این نقشه را حذف کنید؟');">
-              <button type="submit" class="delete">حذف</button>
-            </form>
+
+def get_map_store_file(map_id: str) -> Path:
+    return STORAGE_DIR / f"{map_id}{MAP_STORE_SUFFIX}"
+
+
+def get_map_file(map_id: str) -> Path:
+    """فایل فعلی داده‌های نقشه: فایل ستونی یا (برای نقشه‌های قدیمی) فایل JSON"""
+    store_file = get_map_store_file(map_id)
+    if store_file.exists():
+        return store_file
+    return STORAGE_DIR / f"{map_id}.json"
+
+
+def map_exists(map_id: str) -> bool:
+    return get_map_file(map_id).exists()
+
+
+def delete_map_files(map_id: str) -> None:
+    """حذف فایل ستونی و فایل JSON قدیمی یک نقشه"""
+    for map_file in (get_map_store_file(map_id), STORAGE_DIR / f"{map_id}.json"):
+        if map_file.exists():
+            map_file.unlink()
+        invalidate_file_cache(map_file)
+
+
+def _column_kind(values: List) -> str:
+    """نوع ستون بر اساس مقادیر موجود (غیر null)؛ ستون‌های مخلوط به صورت json نگه داشته می‌شوند"""
+    present = [value for value in values if value is not _MISSING and value is not None]
+    if all(isinstance(value, bool) for value in present):
+        return "bool"
+    if all(isinstance(value, int) and not isinstance(value, bool) and -2**63 <= value < 2**63 for value in present):
+        return "int"
+    if all(isinstance(value, float) for value in present):
+        return "float"
+    if all(isinstance(value, str) for value in present):
+        return "str"
+    return "json"
+
+
+def _encode_blob(items: List[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+    """بایت‌های پشت سر هم + offset شروع هر مورد"""
+    offsets = np.cumsum([0] + [len(item) for item in items], dtype=np.int64)
+    return np.frombuffer(b"".join(items), dtype=np.uint8), offsets
+
+
+def _encode_column(values: List, prefix: str, arrays: Dict[str, np.ndarray]) -> Dict:
+    """افزودن آرایه‌های یک ستون به arrays و برگرداندن مشخصات آن برای header"""
+    kind = _column_kind(values)
+    present = [value is not _MISSING and value is not None for value in values]
+    arrays[f"{prefix}.state"] = np.array(
+        [0 if value is _MISSING else 2 if value is None else 1 for value in values], dtype=np.uint8
+    )
+    if kind in ("str", "json"):
+        encode = (lambda value: value.encode("utf-8")) if kind == "str" else (
+            lambda value: json.dumps(value, ensure_ascii=False, default=str).encode("utf-8")
+        )
+        arrays[f"{prefix}.blob"], arrays[f"{prefix}.offsets"] = _encode_blob(
+            [encode(value) if keep else b"" for value, keep in zip(values, present)]
+        )
+    else:
+        dtype = {"int": np.int64, "float": np.float64, "bool": np.uint8}[kind]
+        arrays[f"{prefix}.values"] = np.array([value if keep else 0 for value, keep in zip(values, present)], dtype=dtype)
+    return {"kind": kind, "prefix": prefix}
+
+
+def write_map_store(map_id: str, data: Dict) -> None:
+    """نوشتن داده‌های نقشه (همان ساختار load_map_data) در فایل ستونی با جابجایی اتمیک"""
+    geojson = data.get("geojson") or {}
+    features = geojson.get("features") or []
+    arrays: Dict[str, np.ndarray] = {}
+
+    wkb = []
+    extras = []
+    for feature in features:
+        extra = {key: value for key, value in feature.items() if key not in ("type", "properties", "geometry")}
+        geometry = feature.get("geometry")
+        item = b""
+        if geometry:
+            try:
+                item = shapely.to_wkb(shape(geometry), output_dimension=3)
+            except Exception:
+                # geometry ای که shapely نمی‌خواند همان‌طور که هست نگه داشته می‌شود
+                extra["geometry"] = geometry
+        wkb.append(item)
+        extras.append(extra or _MISSING)
+    arrays["wkb"], arrays["wkb_offsets"] = _encode_blob(wkb)
+
+    names: Dict[str, None] = {}
+    for feature in features:
+        for key in feature.get("properties") or {}:
+            names.setdefault(key, None)
+    columns = []
+    for i, name in enumerate(names):
+        values = [(feature.get("properties") or {}).get(name, _MISSING) for feature in features]
+        columns.append({"name": name, **_encode_column(values, f"c{i}", arrays)})
+    extras_column = _encode_column(extras, "extras", arrays) if any(extra is not _MISSING for extra in extras) else None
+
+    layout = {}
+    position = 0
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[key] = array
+        layout[key] = {"offset": position, "dtype": array.dtype.str, "count": int(array.size)}
+        position += -(-array.nbytes // 8) * 8
+    header = json.dumps({
+        "map": {key: value for key, value in data.items() if key != "geojson"},
+        "collection": {key: value for key, value in geojson.items() if key != "features"},
+        "feature_count": len(features),
+        "columns": columns,
+        "extras": extras_column,
+        "arrays": layout,
+    }, ensure_ascii=False, default=str).encode("utf-8")
+
+    store_file = get_map_store_file(map_id)
+    temp_file = store_file.with_name(f".{store_file.name}.{os.getpid()}.{threading.get_ident()}")
+    with open(temp_file, "wb") as f:
+        f.write(_MAP_STORE_HEADER.pack(MAP_STORE_MAGIC, MAP_STORE_FORMAT_VERSION, 0, len(header)))
+        f.write(header)
+        f.write(b"\0" * (-f.tell() % 8))
+        for key, array in arrays.items():
+            f.write(array.tobytes())
+            f.write(b"\0" * (-array.nbytes % 8))
+    os.replace(temp_file, store_file)
+    invalidate_file_cache(store_file)
+
+
+def _open_map_store(map_id: str) -> Optional[Tuple[Dict, np.ndarray]]:
+    return _open_map_store_file(get_map_store_file(map_id))
+
+
+def _open_map_store_file(path: Path) -> Optional[Tuple[Dict, np.ndarray]]:
+    """header و mmap فقط-خواندنی فایل ستونی یک نقشه (None اگر وجود ندارد یا قالب آن ناشناخته است)"""
+    try:
+        buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, version, _, header_length = _MAP_STORE_HEADER.unpack(bytes(buffer[:_MAP_STORE_HEADER.size]))
+        if magic != MAP_STORE_MAGIC or version != MAP_STORE_FORMAT_VERSION:
+            return None
+        header_end = _MAP_STORE_HEADER.size + header_length
+        header = json.loads(bytes(buffer[_MAP_STORE_HEADER.size:header_end]).decode("utf-8"))
+    except (OSError, ValueError, struct.error):
+        return None
+    header["data_start"] = header_end + (-header_end % 8)
+    return header, buffer
+
+
+def _store_array(header: Dict, buffer: np.ndarray, key: str) -> np.ndarray:
+    spec = header["arrays"][key]
+    dtype = np.dtype(spec["dtype"])
+    start = header["data_start"] + spec["offset"]
+    return np.asarray(buffer[start:start + spec["count"] * dtype.itemsize]).view(dtype)
+
+
+def _decode_blob(header: Dict, buffer: np.ndarray, prefix: str, row: Optional[int] = None):
+    """بایت‌های همه ردیف‌ها (لیست) یا فقط یک ردیف"""
+    offsets = _store_array(header, buffer, f"{prefix}_offsets" if prefix == "wkb" else f"{prefix}.offsets")
+    blob = _store_array(header, buffer, "wkb" if prefix == "wkb" else f"{prefix}.blob")
+    if row is not None:
+        return blob[offsets[row]:offsets[row + 1]].tobytes()
+    raw = blob.tobytes()
+    bounds = offsets.tolist()
+    return [raw[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _decode_column(header: Dict, buffer: np.ndarray, column: Dict, row: Optional[int] = None) -> List:
+    """مقادیر یک ستون (_MISSING برای featureهایی که این کلید را ندارند)"""
+    prefix = column["prefix"]
+    states = _store_array(header, buffer, f"{prefix}.state")
+    states = states[row:row + 1] if row is not None else states
+    if column["kind"] in ("str", "json"):
+        items = _decode_blob(header, buffer, prefix, row)
+        items = [items] if row is not None else items
+        if column["kind"] == "str":
+            values = [item.decode("utf-8") for item in items]
+        else:
+            values = [json.loads(item) if item else None for item in items]
+    else:
+        values = _store_array(header, buffer, f"{prefix}.values")
+        values = (values[row:row + 1] if row is not None else values).tolist()
+        if column["kind"] == "bool":
+            values = [bool(value) for value in values]
+    return [
+        value if state == 1 else None if state == 2 else _MISSING
+        for value, state in zip(values, states.tolist())
+    ]
+
+
+def _store_properties(header: Dict, buffer: np.ndarray, row: Optional[int] = None) -> List[Dict]:
+    count = 1 if row is not None else header["feature_count"]
+    properties = [{} for _ in range(count)]
+    for column in header["columns"]:
+        for props, value in zip(properties, _decode_column(header, buffer, column, row)):
+            if value is not _MISSING:
+                props[column["name"]] = value
+    return properties
+
+
+def _store_features(header: Dict, buffer: np.ndarray, row: Optional[int] = None) -> List[Dict]:
+    """بازسازی featureهای GeoJSON (همه یا یک ردیف)"""
+    properties = _store_properties(header, buffer, row)
+    wkb = _decode_blob(header, buffer, "wkb", row)
+    wkb = [wkb] if row is not None else wkb
+    geometries = shapely.from_wkb(np.array([item or None for item in wkb], dtype=object))
+    extras = (
+        _decode_column(header, buffer, header["extras"], row) if header.get("extras")
+        else [_MISSING] * len(properties)
+    )
+    features = []
+    for props, geom, extra in zip(properties, geometries, extras):
+        feature = {"type": "Feature", "properties": props, "geometry": mapping(geom) if geom is not None else None}
+        if extra is not _MISSING:
+            feature.update(extra)
+        features.append(feature)
+    return features
+
+
+def _read_map_store_data(path: Path) -> Optional[Dict]:
+    opened = _open_map_store_file(path)
+    if opened is None:
+        return None
+    header, buffer = opened
+    map_data = dict(header["map"])
+    map_data["geojson"] = {**header["collection"], "features": _store_features(header, buffer)}
+    return map_data
+
+
+def _read_map_store_attributes(path: Path) -> Optional[List[Dict]]:
+    opened = _open_map_store_file(path)
+    return _store_properties(*opened) if opened is not None else None
+
+
+def _copy_map_data(map_data: Dict) -> Dict:
+    """کپی برای فراخواننده: اطلاعات نقشه کامل و featureها سطحی کپی می‌شوند (dict feature و properties)؛
+    geometry ها (tuple های ساخته شده از WKB) بین کپی‌ها مشترک می‌مانند.
+    """
+    copied = {key: copy.deepcopy(value) for key, value in map_data.items() if key != "geojson"}
+    geojson = dict(map_data.get("geojson") or {})
+    geojson["features"] = [
+        {**feature, "properties": dict(feature.get("properties") or {})}
+        for feature in geojson.get("features", [])
+    ]
+    copied["geojson"] = geojson
+    return copied
+
+
+def load_map_info(map_id: str) -> Optional[Dict]:
+    """اطلاعات نقشه بدون featureها (summary، نام فایل، تاریخ آپلود ...) - فقط header فایل ستونی خوانده می‌شود"""
+    opened = _open_map_store(map_id)
+    if opened is not None:
+        return copy.deepcopy(opened[0]["map"])
+    map_data = load_map_data(map_id)
+    if not map_data:
+        return None
+    return {key: value for key, value in map_data.items() if key != "geojson"}
+
+
+def _load_map_json(map_id: str) -> Optional[Dict]:
+    """خواندن فایل JSON نقشه‌های قدیمی"""
+    map_file = STORAGE_DIR / f"{map_id}.json"
+    if not map_file.exists():
+        return None
+    try:
+        with open(map_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, IOError):
+        return None
+
+
+def _feature_geometry(feature: Dict):
+    """geometry shapely یک feature یا None اگر ندارد یا قابل خواندن نیست"""
+    if not feature.get("geometry"):
+        return None
+    try:
+        return shape(feature["geometry"])
+    except Exception:
+        return None
+
+
+def load_map_geometries(map_id: str) -> Optional[np.ndarray]:
+    """فقط geometry های یک نقشه (آرایه shapely، None برای featureهای بدون geometry)"""
+    opened = _open_map_store(map_id)
+    if opened is None:
+        map_data = load_map_data(map_id)
+        if not map_data:
+            return None
+        features = (map_data.get("geojson") or {}).get("features") or []
+        return np.array([_feature_geometry(feature) for feature in features], dtype=object)
+    header, buffer = opened
+    wkb = _decode_blob(header, buffer, "wkb")
+    return shapely.from_wkb(np.array([item or None for item in wkb], dtype=object))
+
+
+def load_map_attributes(map_id: str) -> Optional[List[Dict]]:
+    """فقط properties همه featureهای یک نقشه (بدون خواندن geometry ها)"""
+    attributes = cached_file_read(
+        get_map_store_file(map_id), _read_map_store_attributes, clone=lambda rows: [dict(row) for row in rows]
+    )
+    if attributes is None:
+        map_data = load_map_data(map_id)
+        if not map_data:
+            return None
+        features = (map_data.get("geojson") or {}).get("features") or []
+        return [feature.get("properties") or {} for feature in features]
+    return attributes
+
+
+def load_map_feature(map_id: str, feature_id: str) -> Optional[Dict]:
+    """یک feature کامل (با geometry) بر اساس feature_id؛ فقط ستون شناسه و همان ردیف خوانده می‌شوند"""
+    feature_id = str(feature_id).strip()
+    opened = _open_map_store(map_id)
+    if opened is None:
+        map_data = load_map_data(map_id)
+        features = ((map_data or {}).get("geojson") or {}).get("features") or []
+        return next((f for f in features if (f.get("properties") or {}).get("feature_id") == feature_id), None)
+    header, buffer = opened
+    column = next((column for column in header["columns"] if column["name"] == "feature_id"), None)
+    if column is None:
+        return None
+    values = _decode_column(header, buffer, column)
+    try:
+        row = values.index(feature_id)
+    except ValueError:
+        return None
+    return _store_features(header, buffer, row)[0]
+
+
+# ========== Geocoding Index ==========
+
+# ایندکس هر نقشه به صورت آرایه‌های تخت NumPy روی دیسک ذخیره می‌شود (مختصات، offset حلقه‌ها و polygon ها،
+# bbox ها، شبکه پیش‌طبقه‌بندی و جدول ویژگی‌ها). workerها این فایل‌ها را read-only به صورت mmap باز می‌کنند،
+# پس همه worker ها یک نسخه فیزیکی مشترک دارند و worker جدید در چند میلی‌ثانیه آماده است.
+# هر worker فقط یک STRtree کوچک روی bbox ها می‌سازد؛ geometry های shapely فقط در صورت نیاز ساخته می‌شوند.
+INDEX_DIR = UPLOAD_ROOT / "index"
+INDEX_DIR.mkdir(parents=True, exist_ok=True)
+# با تغییر ساختار آرایه‌ها افزایش می‌یابد تا ایندکس‌های قدیمی روی دیسک دوباره ساخته شوند
+INDEX_FORMAT_VERSION = 5
+
+# ایندکس‌های باز شده در این worker (فقط با تغییر نقشه، لینک‌ها یا ویرایش‌ها عوض می‌شوند)
+_MAP_INDEXES: Dict[str, Dict] = {}
+_MAP_INDEX_LOCK = threading.Lock()
+
+# شبکه پیش‌طبقه‌بندی: هر خانه یا «کاملاً داخل polygon شماره X»، یا خالی، یا مرزی است
+# فقط نقاط خانه‌های مرزی به تست دقیق نیاز دارند
+NEIGHBORHOOD_GRID_MAX_CELLS = int(os.environ.get("NEIGHBORHOOD_GRID_MAX_CELLS", "256"))
+GRID_EMPTY = -1
+GRID_BOUNDARY = -2
+
+# اولویت polygon ها در ناحیه‌های همپوشان: file_order (اولین feature فایل، مثل قبل)،
+# smallest_area (محله کوچک‌تر، برای محلات تو در تو) یا largest_area
+OVERLAP_PRIORITY = os.environ.get("OVERLAP_PRIORITY", "file_order")
+
+# تلرانس (درجه) تشخیص مرز مشترک محلات همسایه - حدود 10 سانتی‌متر
+NEIGHBORHOOD_ADJACENCY_TOLERANCE = float(os.environ.get("NEIGHBORHOOD_ADJACENCY_TOLERANCE", "1e-6"))
+
+# حداکثر اندازه ماتریس (نقطه × ضلع) در هر مرحله تست ray casting
+RAY_CASTING_CHUNK = 2_000_000
+
+# حداکثر تعداد geometry های shapely ساخته شده از آرایه‌ها که هر worker برای هر ایندکس نگه می‌دارد (LRU)
+INDEX_SHAPE_CACHE_SIZE = int(os.environ.get("INDEX_SHAPE_CACHE_SIZE", "2048"))
+
+
+def _file_signature(path: Path) -> Optional[Tuple[int, int]]:
+    """امضای (mtime, size) یک فایل برای تشخیص تغییر آن - حتی اگر worker دیگری آن را نوشته باشد"""
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def get_map_revision(map_id: str) -> Tuple:
+    """نسخه فعلی یک نقشه بر اساس فایل نقشه، لینک‌ها و ویرایش‌های آن"""
+    return (
+        _file_signature(get_map_file(map_id)),
+        metadata_signature("links", map_id),
+        metadata_signature("edits", map_id),
+    )
+
+
+def _index_dir(name: str, revision: Tuple) -> Path:
+    """پوشه آرایه‌های ایندکس برای یک نسخه مشخص (نام پوشه شامل hash نسخه است)"""
+    token = hashlib.md5(
+        json.dumps([INDEX_FORMAT_VERSION, OVERLAP_PRIORITY, revision], default=str).encode("utf-8")
+    ).hexdigest()[:16]
+    return INDEX_DIR / f"{name}.{token}"
+
+
+def _write_index_dir(target: Path, arrays: Dict[str, np.ndarray], meta: Dict, prune: bool = True) -> None:
+    """نوشتن آرایه‌ها در یک پوشه موقت و جابجایی اتمیک آن
+    اگر worker دیگری همزمان همین نسخه را ساخته باشد، نسخه او نگه داشته می‌شود.
+    prune فقط وقتی True است که نسخه ساخته شده هنوز نسخه فعلی باشد؛ worker ای که ساخت نسخه قدیمی‌تر را
+    دیرتر تمام می‌کند نباید ایندکس نسخه جدیدتر را پاک کند.
+    """
+    temp_dir = Path(tempfile.mkdtemp(dir=INDEX_DIR, prefix=".build-"))
+    try:
+        for key, array in arrays.items():
+            np.save(temp_dir / f"{key}.npy", np.ascontiguousarray(array), allow_pickle=False)
+        with open(temp_dir / "meta.json", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, default=str)
+        os.rename(temp_dir, target)
+    except OSError:
+        if not target.exists():
+            raise
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    # حذف نسخه‌های قدیمی‌تر همین ایندکس (worker هایی که هنوز آن‌ها را mmap کرده‌اند مشکلی ندارند)
+    if not prune:
+        return
+    name = target.name.rsplit(".", 1)[0]
+    for old_dir in INDEX_DIR.glob(f"{name}.*"):
+        if old_dir != target:
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _read_index_dir(path: Path) -> Optional[Tuple[Dict[str, np.ndarray], Dict]]:
+    """باز کردن آرایه‌های یک ایندکس به صورت mmap فقط-خواندنی"""
+    try:
+        with open(path / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = {
+            key: np.load(path / f"{key}.npy", mmap_mode="r", allow_pickle=False)
+            for key in meta.get("arrays", [])
+        }
+    except (OSError, ValueError):
+        return None
+    return arrays, meta
+
+
+def _polygonal(geom) -> Optional[object]:
+    """تبدیل Polygon / MultiPolygon به MultiPolygon (سایر انواع geometry در ایندکس محله‌ها جایی ندارند)"""
+    if geom.geom_type == "MultiPolygon":
+        return geom
+    if geom.geom_type == "Polygon":
+        return shapely.multipolygons([geom])
+    if geom.geom_type == "GeometryCollection":
+        polygons = [part for part in shapely.get_parts(shapely.get_parts(geom)) if part.geom_type == "Polygon"]
+        return shapely.multipolygons(polygons) if polygons else None
+    return None
+
+
+def build_map_index(map_id: str, revision: Optional[Tuple] = None) -> Optional[Dict]:
+    """ساخت آرایه‌های تخت ایندکس یک نقشه (geometry ها، شبکه و رکورد آماده پاسخ هر feature) روی دیسک"""
+    # فقط ستون‌های ویژگی و geometry ها خوانده می‌شوند (بدون ساختن GeoJSON کامل)
+    attributes = load_map_attributes(map_id)
+    if attributes is None:
+        return None
+    if revision is None:
+        revision = get_map_revision(map_id)
+
+    links = load_links(map_id)
+    geometries = []
+    records = []
+    for props, geom in zip(attributes, load_map_geometries(map_id)):
+        if geom is None or geom.is_empty:
+            continue
+        # شناسه از روی feature کامل (با geometry) ساخته می‌شود تا با کلید لینک‌های ذخیره شده یکی باشد
+        props = dict(props)
+        feature_id = props.get("feature_id") or get_feature_identifier({"properties": props, "geometry": mapping(geom)})
+        # polygon های نامعتبر (خودتقاطع و ...) عملیات همپوشانی را با TopologyException متوقف می‌کنند
+        geom = _polygonal(geom if geom.is_valid else shapely.make_valid(geom))
+        if geom is None or geom.is_empty:
+            continue
+
+        original_name = props.get('NAME_NEW') or props.get('Name') or props.get('name') or 'نامشخص'
+        props = apply_neighborhood_edits(props, map_id, feature_id, original_name)
+
+        # ویژگی‌های پاسخ API فقط یک بار برای هر feature محاسبه می‌شوند
+        neighborhood, district, city = _neighborhood_attributes(props)
+        geometries.append(geom)
+        records.append({
+            "feature_id": feature_id,
+            "region": neighborhood,
+            "district": district,
+            "city": city,
+            "tootapp_url": _tootapp_url(links, feature_id),
+            "names": _searchable_names(props, neighborhood),
+        })
+
+    # افراز بدون همپوشانی: هر نقطه دقیقاً در یک polygon است و lookup به tie-breaking نیاز ندارد
+    # محله‌ای که کاملاً پوشانده شده با geometry خالی در آرایه‌های lookup می‌ماند (رکورد، جستجو و همسایگی آن حفظ می‌شود)
+    features = np.array(geometries, dtype=object)
+    geometries = resolve_overlaps(features)
+    arrays = _geometry_arrays(geometries, features)
+
+    # جدول ویژگی‌ها: رکوردهای JSON پشت سر هم + offset شروع هر رکورد
+    encoded = [json.dumps(record, ensure_ascii=False).encode("utf-8") for record in records]
+    arrays["record_blob"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    arrays["record_offsets"] = np.cumsum([0] + [len(item) for item in encoded], dtype=np.int64)
+
+    shapely.prepare(geometries)
+    grid = _build_classification_grid(geometries, STRtree(geometries))
+    arrays["adjacency_offsets"], arrays["adjacency"] = _build_adjacency(features, STRtree(features))
+    meta = {"map_id": map_id, "revision": revision}
+    _store_grid(arrays, meta, grid)
+
+    target = _index_dir(map_id, revision)
+    _write_index_dir(target, arrays, meta, prune=revision == get_map_revision(map_id))
+    return load_map_index(map_id, revision)
+
+
+def resolve_overlaps(geometries: np.ndarray) -> np.ndarray:
+    """حذف همپوشانی polygon ها بر اساس اولویت OVERLAP_PRIORITY
+    از هر polygon ناحیه مشترک با polygon های با اولویت بالاتر کم می‌شود؛ polygon ای که کاملاً
+    پوشانده شده باشد خالی برمی‌گردد (در lookup هرگز جواب نمی‌شد).
+    """
+    if len(geometries) < 2:
+        return geometries
+    if OVERLAP_PRIORITY == "smallest_area":
+        order = np.argsort(shapely.area(geometries), kind="stable")
+    elif OVERLAP_PRIORITY == "largest_area":
+        order = np.argsort(-shapely.area(geometries), kind="stable")
+    else:
+        order = np.arange(len(geometries))
+    rank = np.empty(len(geometries), dtype=np.int64)
+    rank[order] = np.arange(len(geometries))
+
+    # فقط جفت‌هایی که درونشان همپوشانی دارد (نه محلاتی که فقط مرز مشترک دارند)
+    left, right = STRtree(geometries).query(geometries, predicate="intersects")
+    higher = rank[right] < rank[left]
+    left, right = left[higher], right[higher]
+    overlapping = shapely.relate_pattern(geometries[left], geometries[right], "2********")
+    left, right = left[overlapping], right[overlapping]
+    if len(left) == 0:
+        return geometries
+
+    resolved = geometries.copy()
+    groups = np.split(right[np.argsort(left, kind="stable")], np.cumsum(np.bincount(left))[:-1])
+    for feature_idx, winners in enumerate(groups):
+        if len(winners) == 0:
+            continue
+        remainder = shapely.difference(geometries[feature_idx], shapely.union_all(geometries[winners]))
+        remainder = _polygonal(shapely.make_valid(remainder)) if not remainder.is_empty else None
+        resolved[feature_idx] = remainder if remainder is not None else shapely.from_wkt("MULTIPOLYGON EMPTY")
+    return resolved
+
+
+def _geometry_arrays(geometries: np.ndarray, features: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+    """آرایه‌های تخت MultiPolygon ها: مختصات، offset حلقه‌ها، polygon ها و geometry ها به علاوه bbox ها
+    bbox، مساحت و مرکز از features (polygon کامل هر محله، پیش از حذف همپوشانی) محاسبه می‌شوند تا برای
+    محله‌ای که در lookup خالی شده هم معتبر باشند.
+    """
+    if features is None:
+        features = geometries
+    if len(geometries) == 0:
+        return {
+            "coords": np.zeros((0, 2)),
+            "ring_offsets": np.zeros(1, dtype=np.int64),
+            "part_offsets": np.zeros(1, dtype=np.int64),
+            "geom_offsets": np.zeros(1, dtype=np.int64),
+            "bboxes": np.zeros((0, 4)),
+            "areas": np.zeros(0),
+            "centroids": np.zeros((0, 2)),
+        }
+    _, coords, (ring_offsets, part_offsets, geom_offsets) = shapely.to_ragged_array(geometries)
+    return {
+        "coords": coords,
+        "ring_offsets": ring_offsets.astype(np.int64),
+        "part_offsets": part_offsets.astype(np.int64),
+        "geom_offsets": geom_offsets.astype(np.int64),
+        "bboxes": shapely.bounds(features),
+        # مساحت ژئودزیک (متر مربع) برای مرتب‌سازی سطوح در جستجوی سلسله‌مراتبی
+        "areas": np.array([abs(GEOD.geometry_area_perimeter(geom)[0]) for geom in features]),
+        "centroids": shapely.get_coordinates(shapely.centroid(features)),
+    }
+
+
+def _build_adjacency(geometries: np.ndarray, tree: STRtree) -> Tuple[np.ndarray, np.ndarray]:
+    """گراف همسایگی محلات به صورت CSR (offset هر feature + لیست همسایه‌ها)
+    دو محله همسایه‌اند اگر طول مرز مشترکشان (با تلرانس NEIGHBORHOOD_ADJACENCY_TOLERANCE برای درزها و
+    خطای گرد کردن مختصات) از چند برابر تلرانس بیشتر باشد؛ پس تماس در یک گوشه حساب نمی‌شود.
+    """
+    tolerance = NEIGHBORHOOD_ADJACENCY_TOLERANCE
+    left, right = tree.query(geometries, predicate="dwithin", distance=tolerance)
+    pairs = left < right
+    left, right = left[pairs], right[pairs]
+    if len(left):
+        buffered = shapely.buffer(geometries[right], tolerance, quad_segs=2)
+        shared = shapely.length(shapely.intersection(shapely.boundary(geometries[left]), buffered))
+        adjacent = shared > 10 * tolerance
+        left, right = left[adjacent], right[adjacent]
+    source = np.concatenate([left, right])
+    target = np.concatenate([right, left])
+    order = np.lexsort((target, source))
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(source, minlength=len(geometries)))]).astype(np.int64)
+    return offsets, target[order].astype(np.int64)
+
+
+def index_neighbors(index: Dict, feature_idx: int) -> np.ndarray:
+    """اندیس محلات همسایه یک feature از گراف همسایگی ذخیره شده"""
+    return np.asarray(index["adjacency"][index["adjacency_offsets"][feature_idx]:index["adjacency_offsets"][feature_idx + 1]])
+
+
+def _store_grid(arrays: Dict[str, np.ndarray], meta: Dict, grid: Optional[Dict]) -> None:
+    """افزودن شبکه پیش‌طبقه‌بندی به آرایه‌ها و متادیتای ایندکس"""
+    if grid is not None:
+        arrays["grid_labels"] = grid["labels"]
+        meta["grid"] = {"origin": grid["origin"], "cell_size": grid["cell_size"], "shape": grid["shape"]}
+    meta["arrays"] = list(arrays)
+
+
+def _load_grid(arrays: Dict[str, np.ndarray], meta: Dict) -> Optional[Dict]:
+    """بازسازی دیکشنری شبکه از آرایه mmap شده و متادیتا"""
+    grid_meta = meta.get("grid")
+    if not grid_meta or "grid_labels" not in arrays:
+        return None
+    return {
+        "origin": tuple(grid_meta["origin"]),
+        "cell_size": tuple(grid_meta["cell_size"]),
+        "shape": tuple(grid_meta["shape"]),
+        "labels": arrays["grid_labels"],
+    }
+
+
+def _bbox_tree(bboxes: np.ndarray) -> STRtree:
+    """STRtree روی bbox ها (تنها ساختار shapely که هر worker در حافظه خودش می‌سازد)"""
+    bboxes = np.asarray(bboxes)
+    return STRtree(shapely.box(bboxes[:, 0], bboxes[:, 1], bboxes[:, 2], bboxes[:, 3]))
+
+
+def load_map_index(map_id: str, revision: Tuple) -> Optional[Dict]:
+    """باز کردن ایندکس ذخیره شده یک نقشه برای نسخه مشخص (None اگر هنوز ساخته نشده)"""
+    path = _index_dir(map_id, revision)
+    loaded = _read_index_dir(path)
+    if loaded is None:
+        return None
+    arrays, meta = loaded
+    index = dict(arrays)
+    index.update({
+        "map_id": map_id,
+        "revision": revision,
+        "path": path,
+        "tree": _bbox_tree(arrays["bboxes"]),
+        "grid": _load_grid(arrays, meta),
+        "_records": {},
+        "_shapes": OrderedDict(),
+        "_feature_ids": None,
+    })
+    return index
+
+
+def index_size(index: Dict) -> int:
+    """تعداد geometry های یک ایندکس"""
+    return len(index["bboxes"])
+
+
+def index_record(index: Dict, feature_idx: int) -> Dict:
+    """رکورد پاسخ یک feature از جدول ویژگی‌های mmap شده (با کش در همین worker)"""
+    record = index["_records"].get(feature_idx)
+    if record is None:
+        start, end = index["record_offsets"][feature_idx], index["record_offsets"][feature_idx + 1]
+        record = json.loads(index["record_blob"][start:end].tobytes().decode("utf-8"))
+        index["_records"][feature_idx] = record
+    return record
+
+
+def index_feature_ids(index: Dict) -> Dict[str, int]:
+    """نگاشت feature_id → اندیس feature (یک بار در هر worker ساخته می‌شود)"""
+    if index["_feature_ids"] is None:
+        feature_ids = {}
+        for feature_idx in range(index_size(index)):
+            feature_id = index_record(index, feature_idx)["feature_id"]
+            if feature_id and feature_id not in feature_ids:
+                feature_ids[feature_id] = feature_idx
+        index["_feature_ids"] = feature_ids
+    return index["_feature_ids"]
+
+
+def _geometry_ranges(index: Dict, feature_idx: int) -> Tuple[int, int, int, int, int, int]:
+    """بازه polygon ها، حلقه‌ها و مختصات یک geometry در آرایه‌های تخت"""
+    p0, p1 = int(index["geom_offsets"][feature_idx]), int(index["geom_offsets"][feature_idx + 1])
+    r0, r1 = int(index["part_offsets"][p0]), int(index["part_offsets"][p1])
+    c0, c1 = int(index["ring_offsets"][r0]), int(index["ring_offsets"][r1])
+    return p0, p1, r0, r1, c0, c1
+
+
+def _index_shape(index: Dict, feature_idx: int):
+    """ساخت geometry shapely یک feature از آرایه‌های تخت"""
+    p0, p1, r0, r1, c0, c1 = _geometry_ranges(index, feature_idx)
+    return shapely.from_ragged_array(
+        shapely.GeometryType.MULTIPOLYGON,
+        np.asarray(index["coords"][c0:c1]),
+        (
+            np.asarray(index["ring_offsets"][r0:r1 + 1]) - c0,
+            np.asarray(index["part_offsets"][p0:p1 + 1]) - r0,
+            np.array([0, p1 - p0]),
+        ),
+    )[0]
+
+
+def index_geometry(index: Dict, feature_idx: int):
+    """geometry shapely یک feature (فقط برای عملیات هندسی، با کش LRU محدود در همین worker)"""
+    shapes = index["_shapes"]
+    geom = shapes.get(feature_idx)
+    if geom is not None:
+        try:
+            shapes.move_to_end(feature_idx)
+        except KeyError:
+            pass
+        return geom
+    geom = _index_shape(index, feature_idx)
+    shapes[feature_idx] = geom
+    while len(shapes) > INDEX_SHAPE_CACHE_SIZE:
+        try:
+            shapes.popitem(last=False)
+        except KeyError:
+            break
+    return geom
+
+
+def index_geometries(index: Dict, feature_indices) -> np.ndarray:
+    """آرایه geometry های shapely برای چند feature (عملیات دسته‌ای: بدون پر کردن کش تا نسخه خصوصی
+    همه geometry ها در حافظه worker باقی نماند)
+    """
+    return np.array([_index_shape(index, int(i)) for i in feature_indices], dtype=object)
+
+
+def points_in_geometry(index: Dict, feature_idx: int, lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
+    """تست دقیق نقطه در polygon با ray casting (قانون زوج و فرد روی همه حلقه‌ها) مستقیماً روی آرایه‌های تخت"""
+    lons = np.asarray(lons, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    _, _, r0, r1, c0, c1 = _geometry_ranges(index, feature_idx)
+    if c1 - c0 < 2:
+        # محله کاملاً پوشانده شده (geometry خالی در آرایه‌های lookup) هیچ نقطه‌ای را شامل نمی‌شود
+        return np.zeros(len(lons), dtype=bool)
+    coords = index["coords"]
+    x1, y1 = coords[c0:c1 - 1, 0], coords[c0:c1 - 1, 1]
+    x2, y2 = coords[c0 + 1:c1, 0], coords[c0 + 1:c1, 1]
+    # ضلع بین آخرین نقطه یک حلقه و اولین نقطه حلقه بعدی واقعی نیست
+    edges = np.ones(len(x1), dtype=bool)
+    edges[np.asarray(index["ring_offsets"][r0 + 1:r1]) - c0 - 1] = False
+    x1, y1, x2, y2 = x1[edges], y1[edges], x2[edges], y2[edges]
+
+    inside = np.zeros(len(lons), dtype=bool)
+    step = max(1, RAY_CASTING_CHUNK // max(len(x1), 1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for start in range(0, len(lons), step):
+            px = lons[start:start + step, None]
+            py = lats[start:start + step, None]
+            crosses = ((y1 > py) != (y2 > py)) & (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1)
+            inside[start:start + step] = np.count_nonzero(crosses, axis=1) % 2 == 1
+    return inside
+
+
+def _build_classification_grid(geometries: np.ndarray, tree: STRtree) -> Optional[Dict]:
+    """ساخت شبکه یکنواخت روی محدوده نقشه و برچسب‌گذاری خانه‌ها (داخل polygon / خالی / مرزی)"""
+    if len(geometries) == 0 or NEIGHBORHOOD_GRID_MAX_CELLS <= 0:
+        return None
+    minx, miny, maxx, maxy = shapely.total_bounds(geometries)
+    width, height = maxx - minx, maxy - miny
+    if not (width > 0 and height > 0):
+        return None
+
+    # تعداد خانه‌ها متناسب با تعداد polygon ها و نسبت طول و عرض نقشه
+    cells = min(NEIGHBORHOOD_GRID_MAX_CELLS, max(16, int(np.sqrt(len(geometries)) * 8)))
+    if width >= height:
+        nx, ny = cells, max(1, int(round(cells * height / width)))
+    else:
+        nx, ny = max(1, int(round(cells * width / height))), cells
+    dx, dy = width / nx, height / ny
+
+    # خانه‌ها کمی بزرگ‌تر ساخته می‌شوند تا خطای گرد کردن در محاسبه شماره خانه بی‌اثر باشد
+    eps = 1e-9
+    gx, gy = np.meshgrid(minx + np.arange(nx) * dx, miny + np.arange(ny) * dy)
+    gx, gy = gx.ravel(), gy.ravel()
+    boxes = shapely.box(gx - eps, gy - eps, gx + dx + eps, gy + dy + eps)
+
+    labels = np.full(len(boxes), GRID_EMPTY, dtype=np.int32)
+    cell_idx, geom_idx = tree.query(boxes, predicate="intersects")
+    if len(cell_idx):
+        # اولین polygon (کمترین اندیس) که خانه را قطع می‌کند؛ اگر کل خانه داخل آن باشد، جواب همه نقاط خانه است
+        first = np.full(len(boxes), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(first, cell_idx, geom_idx)
+        touched = np.flatnonzero(first != np.iinfo(np.int64).max)
+        inside = shapely.contains_properly(geometries[first[touched]], boxes[touched])
+        labels[touched] = np.where(inside, first[touched], GRID_BOUNDARY)
+
+    return {
+        "origin": (float(minx), float(miny)),
+        "cell_size": (float(dx), float(dy)),
+        "shape": (ny, nx),
+        "labels": labels.reshape(ny, nx),
+    }
+
+def _grid_labels(grid: Dict, lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
+    """برچسب خانه شبکه برای آرایه‌ای از نقاط (نقاط خارج از محدوده نقشه خالی هستند)"""
+    minx, miny = grid["origin"]
+    dx, dy = grid["cell_size"]
+    ny, nx = grid["shape"]
+    with np.errstate(invalid="ignore"):
+        fx = (lons - minx) / dx
+        fy = (lats - miny) / dy
+        inside = (fx >= 0) & (fx <= nx) & (fy >= 0) & (fy <= ny)
+    labels = np.full(len(lons), GRID_EMPTY, dtype=np.int32)
+    ix = np.minimum(fx[inside].astype(np.int64), nx - 1)
+    iy = np.minimum(fy[inside].astype(np.int64), ny - 1)
+    labels[inside] = grid["labels"][iy, ix]
+    return labels
+
+
+def _grid_label(grid: Dict, lon: float, lat: float) -> int:
+    """برچسب خانه شبکه برای یک نقطه"""
+    minx, miny = grid["origin"]
+    dx, dy = grid["cell_size"]
+    ny, nx = grid["shape"]
+    fx = (lon - minx) / dx
+    fy = (lat - miny) / dy
+    if not (0 <= fx <= nx and 0 <= fy <= ny):
+        return GRID_EMPTY
+    return int(grid["labels"][min(int(fy), ny - 1), min(int(fx), nx - 1)])
+
+
+def get_map_index(map_id: str) -> Optional[Dict]:
+    """دریافت ایندکس یک نقشه - اگر worker دیگری آن را ساخته باشد فقط mmap می‌شود،
+    و در صورت تغییر فایل‌های نقشه دوباره ساخته می‌شود
+    """
+    derived = split_derived_map_id(map_id)
+    if derived:
+        refresh_derived_layers(derived[0])
+
+    revision = get_map_revision(map_id)
+    if revision[0] is None:
+        _MAP_INDEXES.pop(map_id, None)
+        return None
+
+    index = _MAP_INDEXES.get(map_id)
+    if index is not None and index["revision"] == revision:
+        return index
+
+    with _MAP_INDEX_LOCK:
+        index = _MAP_INDEXES.get(map_id)
+        if index is not None and index["revision"] == revision:
+            return index
+        index = load_map_index(map_id, revision) or build_map_index(map_id, revision)
+        if index is None:
+            _MAP_INDEXES.pop(map_id, None)
+        else:
+            _MAP_INDEXES[map_id] = index
+    return index
+
+
+def invalidate_map_index(map_id: str) -> None:
+    """حذف ایندکس یک نقشه از حافظه و دیسک (بعد از آپلود، جایگزینی، حذف یا ویرایش)"""
+    global _GLOBAL_INDEX
+    _MAP_INDEXES.pop(map_id, None)
+    _GLOBAL_INDEX = {}
+    for index_dir in INDEX_DIR.glob(f"{map_id}.*"):
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+
+# ایندکس سراسری روی polygon های همه نقشه‌ها به ترتیب تاریخچه (برای جستجو بدون map_id)
+# فقط bbox ها و شبکه سراسری نگه داشته می‌شوند؛ تست دقیق روی آرایه‌های نقشه مربوطه انجام می‌شود
+_GLOBAL_INDEX: Dict = {}
+GLOBAL_INDEX_NAME = "_all"
+
+
+def build_global_index(revision: Optional[Tuple] = None) -> Dict:
+    """ساخت ایندکس سراسری روی polygon های همه نقشه‌ها
+    اندیس سراسری هر polygon به ترتیب (جایگاه نقشه در تاریخچه، ترتیب feature در فایل) است،
+    پس کمترین اندیس سراسری همان «اولین نقشه تاریخچه که محله را دارد» است.
+    شبکه سراسری فقط یک بار (توسط اولین worker) ساخته و روی دیسک ذخیره می‌شود.
+    """
+    if revision is None:
+        revision = get_lookup_revision()
+    indexes = []
+    for item in load_history():
+        item_map_id = item.get("map_id")
+        if not item_map_id:
+            continue
+        try:
+            index = get_map_index(item_map_id)
+        except Exception as e:
+            print(f"Error building spatial index for map {item_map_id}: {e}")
+            continue
+        if index and index_size(index):
+            indexes.append(index)
+
+    if indexes:
+        bboxes = np.concatenate([np.asarray(index["bboxes"]) for index in indexes])
+    else:
+        bboxes = np.zeros((0, 4))
+
+    index_dir = _index_dir(GLOBAL_INDEX_NAME, revision)
+    loaded = _read_index_dir(index_dir)
+    if loaded is None:
+        # ساخت geometry های همه نقشه‌ها فقط برای برچسب‌گذاری شبکه سراسری
+        geometries = np.concatenate(
+            [index_geometries(index, range(index_size(index))) for index in indexes]
+        ) if indexes else np.array([], dtype=object)
+        arrays: Dict[str, np.ndarray] = {}
+        meta = {"revision": revision}
+        _store_grid(arrays, meta, _build_classification_grid(geometries, STRtree(geometries)))
+        _write_index_dir(index_dir, arrays, meta, prune=revision == get_lookup_revision())
+        loaded = _read_index_dir(index_dir) or (arrays, meta)
+    arrays, meta = loaded
+
+    return {
+        "revision": revision,
+        "tree": _bbox_tree(bboxes),
+        "bboxes": bboxes,
+        "indexes": indexes,
+        "offsets": np.cumsum([0] + [index_size(index) for index in indexes]),
+        "grid": _load_grid(arrays, meta),
+    }
+
+
+def get_global_index(revision: Optional[Tuple] = None) -> Dict:
+    """دریافت ایندکس سراسری - با تغییر تاریخچه یا هر یک از نقشه‌ها دوباره ساخته می‌شود
+    revision (اختیاری) همان get_lookup_revision() است اگر فراخواننده آن را قبلاً (مثلاً برای کلید کش) گرفته باشد.
+    """
+    global _GLOBAL_INDEX
+    if revision is None:
+        revision = get_lookup_revision()
+    global_index = _GLOBAL_INDEX
+    if global_index.get("revision") == revision:
+        return global_index
+    # ساخت همزمان در دو thread بی‌خطر است؛ آخرین نتیجه جایگزین می‌شود
+    global_index = build_global_index(revision)
+    _GLOBAL_INDEX = global_index
+    return global_index
+
+
+def split_global_hit(global_index: Dict, global_idx: int) -> Tuple[Dict, int]:
+    """تبدیل اندیس سراسری به (ایندکس نقشه، اندیس feature در آن نقشه)"""
+    position = int(np.searchsorted(global_index["offsets"], global_idx, side="right")) - 1
+    return global_index["indexes"][position], int(global_idx - global_index["offsets"][position])
+
+
+def _resolve_hit(index: Dict, feature_idx: int) -> Tuple[Dict, int]:
+    """ایندکس نقشه و اندیس محلی یک اندیس (در ایندکس نقشه یا ایندکس سراسری)"""
+    if "indexes" in index:
+        return split_global_hit(index, feature_idx)
+    return index, feature_idx
+
+
+def _points_in_feature(index: Dict, feature_idx: int, lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
+    """تست دقیق نقاط در یک feature از ایندکس نقشه یا ایندکس سراسری"""
+    map_index, local_idx = _resolve_hit(index, feature_idx)
+    return points_in_geometry(map_index, local_idx, lons, lats)
+
+
+def lookup_map_index(index: Dict, lon: float, lat: float) -> Optional[int]:
+    """پیدا کردن اولین feature شامل نقطه - همان ترتیب فایل (مثل iloc[0] در GeoDataFrame)"""
+    grid = index.get("grid")
+    if grid is not None:
+        label = _grid_label(grid, lon, lat)
+        if label == GRID_EMPTY:
+            return None
+        if label >= 0:
+            return label
+    point_lon, point_lat = np.array([lon]), np.array([lat])
+    for candidate in np.sort(index["tree"].query(Point(lon, lat))):
+        if _points_in_feature(index, int(candidate), point_lon, point_lat)[0]:
+            return int(candidate)
+    return None
+
+
+def nearest_map_feature(index: Dict, lon: float, lat: float, max_distance_m: float) -> Optional[Tuple[int, float]]:
+    """نزدیک‌ترین feature به نقطه تا فاصله max_distance_m متر - خروجی (اندیس، فاصله ژئودزیک به متر)
+    کاندیدها با یک query مستطیلی روی STRtree هرس می‌شوند و سپس با فاصله ژئودزیک (pyproj Geod) رتبه‌بندی می‌شوند.
+    """
+    if index_size(index) == 0:
+        return None
+    # تبدیل شعاع متری به محدوده درجه‌ای (محافظه‌کارانه، با cos عرض جغرافیایی لبه بالاتر)
+    dlat = max_distance_m / 110000.0
+    cos_lat = math.cos(math.radians(min(abs(lat) + dlat, 89.0)))
+    dlon = max_distance_m / (111320.0 * max(cos_lat, 0.01))
+    candidates = index["tree"].query(shapely.box(lon - dlon, lat - dlat, lon + dlon, lat + dlat))
+    if len(candidates) == 0:
+        return None
+
+    # نزدیک‌ترین نقطه روی هر polygon کاندید و فاصله ژئودزیک آن تا نقطه ورودی
+    geometries = np.array([index_geometry(*_resolve_hit(index, int(i))) for i in candidates], dtype=object)
+    # محلات کاملاً پوشانده شده در lookup geometry ندارند
+    present = ~shapely.is_empty(geometries)
+    candidates, geometries = candidates[present], geometries[present]
+    if len(candidates) == 0:
+        return None
+    lines = shapely.shortest_line(geometries, Point(lon, lat))
+    nearest = shapely.get_coordinates(lines).reshape(-1, 2, 2)[:, 0, :]
+    _, _, distances = GEOD.inv(
+        np.full(len(candidates), lon), np.full(len(candidates), lat), nearest[:, 0], nearest[:, 1]
+    )
+    distances = np.atleast_1d(distances)
+    best = np.lexsort((candidates, distances))[0]
+    if distances[best] > max_distance_m:
+        return None
+    return int(candidates[best]), float(distances[best])
+
+
+def lookup_map_index_bulk(index: Dict, lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
+    """نسخه برداری lookup_map_index برای آرایه‌ای از نقاط - خروجی اندیس feature یا ‎-1‎"""
+    result = np.full(len(lons), -1, dtype=np.int64)
+    if len(lons) == 0 or index_size(index) == 0:
+        return result
+    # خانه‌های داخلی و خالی شبکه مستقیماً جواب می‌دهند؛ فقط نقاط مرزی تست دقیق می‌شوند
+    grid = index.get("grid")
+    if grid is not None:
+        labels = _grid_labels(grid, lons, lats)
+        result[labels >= 0] = labels[labels >= 0]
+        exact = np.flatnonzero(labels == GRID_BOUNDARY)
+    else:
+        exact = np.arange(len(lons))
+    if len(exact) == 0:
+        return result
+
+    # کاندیدها از روی bbox؛ سپس برای هر feature یک تست ray casting برداری روی همه نقاط کاندید آن
+    point_idx, feature_idx = index["tree"].query(shapely.points(lons[exact], lats[exact]))
+    if len(point_idx) == 0:
+        return result
+    order = np.lexsort((point_idx, feature_idx))
+    point_idx, feature_idx = point_idx[order], feature_idx[order]
+    starts = np.flatnonzero(np.r_[True, feature_idx[1:] != feature_idx[:-1]])
+    inside = np.zeros(len(point_idx), dtype=bool)
+    for start, end in zip(starts, np.r_[starts[1:], len(feature_idx)]):
+        points = exact[point_idx[start:end]]
+        inside[start:end] = _points_in_feature(index, int(feature_idx[start]), lons[points], lats[points])
+
+    if "indexes" not in index:
+        # polygon های هر نقشه در زمان ساخت ایندکس بدون همپوشانی شده‌اند، پس هر نقطه حداکثر یک جواب دارد
+        result[exact[point_idx[inside]]] = feature_idx[inside]
+        return result
+    # بین نقشه‌ها همپوشانی طبیعی است (شهر / منطقه / محله)؛ کمترین اندیس (اولین نقشه تاریخچه) انتخاب می‌شود
+    first = np.full(len(exact), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first, point_idx[inside], feature_idx[inside])
+    matched = first != np.iinfo(np.int64).max
+    result[exact[matched]] = first[matched]
+    return result
+
+
+def _neighborhood_attributes(props: Dict) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """استخراج نام محله، منطقه و شهر از properties یک feature (یک بار در زمان ساخت ایندکس)"""
+    neighborhood = None
+    district = None
+    city = None
+    
+    # جستجوی نام محله - ابتدا فیلدهای استاندارد
+    for field in NEIGHBORHOOD_FIELDS:
+        if field in props and props[field]:
+            neighborhood = str(props[field])
+            break
+    
+    # اگر محله پیدا نشد، جستجوی هوشمند در همه فیلدها
+    if not neighborhood:
+        # جستجو برای فیلدهایی که نامشان شامل "name" یا "mahal" است
+        neighborhood_candidates = []
+        
+        for key, value in props.items():
+            key_lower = key.lower()
+            if key_lower in NEIGHBORHOOD_NAME_EXCLUDE_FIELDS:
+                continue
+            
+            value_str = str(value).strip() if value else ""
+            
+            # بررسی اینکه نام فیلد شامل "name" یا "mahal" باشد
+            if value_str and ('name' in key_lower or 'mahal' in key_lower):
+                # بررسی اینکه مقدار معتبر باشد (نه عدد خالص)
+                if not value_str.replace('.', '').replace('-', '').isdigit():
+                    if len(value_str) > 1 and len(value_str) < 200:
+                        neighborhood_candidates.append((key, value_str))
+        
+        # اگر کاندید پیدا شد، اولی را انتخاب می‌کنیم
+        if neighborhood_candidates:
+            neighborhood = neighborhood_candidates[0][1]
+    
+    # اگر هنوز پیدا نشد، جستجوی عمومی در همه فیلدها
+    if not neighborhood:
+        for key, value in props.items():
+            if key.lower() in NEIGHBORHOOD_FALLBACK_EXCLUDE_FIELDS:
+                continue
+            value_str = str(value).strip() if value else ""
+            # اگر مقدار خالی نباشد و عدد نباشد (احتمالاً نام است)
+            if value_str and not value_str.replace('.', '').replace('-', '').isdigit():
+                # بررسی اینکه نام محله باشد (نه مختصات یا کد)
+                if len(value_str) > 2 and len(value_str) < 100:
+                    neighborhood = value_str
+                    break
+    
+    # جستجوی منطقه
+    for field in DISTRICT_FIELDS:
+        if field in props and props[field]:
+            district = str(props[field])
+            break
+    
+    # جستجوی شهر
+    for field in CITY_FIELDS:
+        if field in props and props[field]:
+            city = str(props[field])
+            break
+    
+    return neighborhood, district, city
+
+
+def _searchable_names(props: Dict, neighborhood: Optional[str]) -> List[str]:
+    """همه نام‌های قابل جستجوی یک محله (نام ویرایش شده، نام اصلی و نام انگلیسی)"""
+    names = []
+    for value in (props.get("NAME_NEW"), neighborhood, props.get("Name"), props.get("name"),
+                  props.get("english_name"), props.get("EName"), props.get("ename")):
+        if value not in (None, "") and str(value).strip() and str(value).strip() not in names:
+            names.append(str(value).strip())
+    return names
+
+
+def _tootapp_url(links: Dict[str, str], feature_id: Optional[str]) -> str:
+    """ساخت لینک توت‌اپ یک محله از روی لینک‌های ذخیره شده نقشه"""
+    if feature_id and feature_id in links:
+        saved_link = links[feature_id]
+        if saved_link.startswith("http"):
+            return saved_link
+        return f"{TOOTAPP_BASE_URL.rstrip('/')}/{saved_link.lstrip('/')}"
+    # استفاده از base URL فقط
+    return TOOTAPP_BASE_URL.rstrip('/')
+
+
+def _neighborhood_payload(index: Dict, feature_idx: int, history: List[Dict]) -> Dict:
+    """پاسخ API محله برای یک feature پیدا شده (بدون coordinates)"""
+    record = index_record(index, feature_idx)
+    
+    # پیدا کردن map_name
+    map_id = index["map_id"]
+    # لایه‌های مشتق در تاریخچه نیستند؛ نام نقشه اصلی آن‌ها استفاده می‌شود
+    derived = split_derived_map_id(map_id)
+    history_map_id = derived[0] if derived else map_id
+    map_info = next((item for item in history if item.get("map_id") == history_map_id), None)
+    map_name = (map_info or {}).get("map_name", "")
+    
+    return {
+        "success": True,
+        "region": record["region"],
+        "district": record["district"],
+        "city": record["city"],
+        "map_id": map_id,
+        "map_name": map_name,
+        "tootapp_url": record["tootapp_url"],
+    }
+
+
+def get_map_feature(map_id: str, feature_id: str) -> Optional[Dict]:
+    """پاسخ API محله برای یک feature_id مشخص از طریق ایندکس شناسه‌های نقشه"""
+    index = get_map_index(map_id)
+    if not index:
+        return None
+    feature_idx = index_feature_ids(index).get(str(feature_id).strip())
+    if feature_idx is None:
+        return None
+    result = _neighborhood_payload(index, feature_idx, load_history())
+    result["feature_id"] = index_record(index, feature_idx)["feature_id"]
+    return result
+
+
+def lookup_neighborhood(lat: float, lon: float, map_id: Optional[str] = None,
+                        max_distance_m: Optional[float] = None, revision: Optional[Tuple] = None) -> Optional[Dict]:
+    """پیدا کردن محله یک نقطه در نقشه مشخص شده یا همه نقشه‌ها به ترتیب تاریخچه (پاسخ بدون coordinates)
+    اگر max_distance_m داده شود و هیچ محله‌ای نقطه را شامل نشود، نزدیک‌ترین محله تا آن فاصله برگردانده می‌شود.
+    revision (بدون map_id) به get_global_index داده می‌شود تا نسخه دوباره محاسبه نشود.
+    """
+    history = load_history()
+    if map_id:
+        # جستجو در نقشه خاص
+        try:
+            index = get_map_index(map_id)
+        except Exception:
+            return None
+        if not index:
+            return None
+    else:
+        # جستجو در همه نقشه‌ها با یک query روی ایندکس سراسری
+        index = get_global_index(revision)
+    
+    hit = lookup_map_index(index, lon, lat)
+    distance_m = 0.0
+    if hit is None and max_distance_m:
+        nearest = nearest_map_feature(index, lon, lat, max_distance_m)
+        if nearest is not None:
+            hit, distance_m = nearest
+    if hit is None:
+        return None
+    
+    if map_id:
+        result = _neighborhood_payload(index, hit, history)
+    else:
+        result = _neighborhood_payload(*split_global_hit(index, hit), history)
+    if max_distance_m:
+        result["distance_m"] = round(distance_m, 2)
+    return result
+
+
+def lookup_hierarchy(lat: float, lon: float, revision: Optional[Tuple] = None) -> List[Dict]:
+    """همه سطوح شامل یک نقطه (شهر ← منطقه ← محله) با یک query روی ایندکس سراسری
+    از هر نقشه اولین feature شامل نقطه برداشته می‌شود و سطوح به ترتیب مساحت (بزرگ به کوچک) مرتب می‌شوند.
+    """
+    history = load_history()
+    global_index = get_global_index(revision)
+    point_lon, point_lat = np.array([lon]), np.array([lat])
+    hits: Dict[str, Tuple[Dict, int]] = {}
+    for candidate in np.sort(global_index["tree"].query(Point(lon, lat))):
+        map_index, local_idx = split_global_hit(global_index, int(candidate))
+        if map_index["map_id"] in hits:
+            continue
+        if points_in_geometry(map_index, local_idx, point_lon, point_lat)[0]:
+            hits[map_index["map_id"]] = (map_index, local_idx)
+
+    levels = sorted(hits.values(), key=lambda hit: -float(hit[0]["areas"][hit[1]]))
+    results = []
+    for level, (map_index, local_idx) in enumerate(levels):
+        result = _neighborhood_payload(map_index, local_idx, history)
+        result.pop("success", None)
+        result["level"] = level
+        result["feature_id"] = index_record(map_index, local_idx)["feature_id"]
+        result["area_km2"] = round(float(map_index["areas"][local_idx]) / 1e6, 3)
+        results.append(result)
+    return results
+
+
+def get_lookup_revision(map_id: Optional[str] = None) -> Tuple:
+    """نسخه داده‌هایی که پاسخ یک lookup به آن‌ها وابسته است (یک نقشه یا تاریخچه و همه نقشه‌ها)"""
+    if map_id:
+        derived = split_derived_map_id(map_id)
+        if derived:
+            # لایه مشتق با تغییر نقشه اصلی قدیمی می‌شود، حتی اگر هنوز دوباره ساخته نشده باشد
+            return (map_id, get_map_revision(map_id), get_map_revision(derived[0]))
+        return (map_id, get_map_revision(map_id))
+    history = load_history()
+    return (
+        metadata_signature("history"),
+        tuple(get_map_revision(item["map_id"]) for item in history if item.get("map_id")),
+    )
+
+
+def _parse_points_payload(payload, default_map_id: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Optional[str]]:
+    """تبدیل بدنه درخواست دسته‌ای به آرایه‌های lat/lon/weight
+    ورودی قابل قبول: لیست JSON از {"lat", "lon", "weight"} یا [lat, lon, weight]، یا {"points": [...], "map_id": ...}
+    یا متن CSV با ستون‌های lat و lon و weight (با یا بدون header) - وزن اختیاری است و پیش‌فرض آن 1 است
+    """
+    map_id = default_map_id
+    if isinstance(payload, (bytes, str)):
+        text = payload.decode("utf-8-sig") if isinstance(payload, bytes) else payload
+        rows = [row for row in csv.reader(io.StringIO(text)) if row]
+        lat_col, lon_col, weight_col = 0, 1, 2
+        if rows:
+            header = [cell.strip() for cell in rows[0]]
+            header_lat = next((i for i, cell in enumerate(header) if cell in LAT_FIELDS), None)
+            header_lon = next((i for i, cell in enumerate(header) if cell in LON_FIELDS), None)
+            if header_lat is not None and header_lon is not None:
+                lat_col, lon_col = header_lat, header_lon
+                weight_col = next((i for i, cell in enumerate(header) if cell in WEIGHT_FIELDS), None)
+                rows = rows[1:]
+        raw_points = [
+            (
+                row[lat_col] if len(row) > lat_col else None,
+                row[lon_col] if len(row) > lon_col else None,
+                row[weight_col] if weight_col is not None and len(row) > weight_col else None,
+            )
+            for row in rows
+        ]
+    else:
+        if isinstance(payload, dict):
+            map_id = payload.get("map_id") or map_id
+            payload = payload.get("points")
+        if not isinstance(payload, list):
+            raise ValueError("بدنه درخواست باید لیستی از نقاط یا فایل CSV باشد")
+        raw_points = []
+        for item in payload:
+            if isinstance(item, dict):
+                raw_points.append((
+                    _first_nonempty(item, LAT_FIELDS),
+                    _first_nonempty(item, LON_FIELDS),
+                    _first_nonempty(item, WEIGHT_FIELDS),
+                ))
+            elif isinstance(item, (list, tuple)) and len(item) >= 2:
+                raw_points.append((item[0], item[1], item[2] if len(item) > 2 else None))
+            else:
+                raw_points.append((None, None, None))
+
+    if len(raw_points) > NEIGHBORHOOD_BATCH_MAX_POINTS:
+        raise ValueError(f"حداکثر {NEIGHBORHOOD_BATCH_MAX_POINTS} نقطه در هر درخواست مجاز است")
+
+    # مقادیر نامعتبر به NaN تبدیل می‌شوند و در خروجی خطا می‌گیرند
+    lats = np.full(len(raw_points), np.nan)
+    lons = np.full(len(raw_points), np.nan)
+    weights = np.ones(len(raw_points))
+    for i, (lat, lon, weight) in enumerate(raw_points):
+        try:
+            lats[i] = float(lat)
+            lons[i] = float(lon)
+        except (ValueError, TypeError):
+            lats[i] = lons[i] = np.nan
+        if weight not in (None, ""):
+            try:
+                weights[i] = float(weight)
+            except (ValueError, TypeError):
+                weights[i] = np.nan
+    return lats, lons, weights, map_id
+
+
+def lookup_neighborhoods_bulk(lats: np.ndarray, lons: np.ndarray, map_id: Optional[str] = None) -> List[Optional[Dict]]:
+    """geocoding دسته‌ای: برای هر نقطه پاسخ API محله (بدون coordinates) یا None برمی‌گرداند
+    ترتیب جستجو مثل api_get_neighborhood است: نقشه مشخص شده یا همه نقشه‌ها به ترتیب تاریخچه
+    """
+    history = load_history()
+    results: List[Optional[Dict]] = [None] * len(lats)
+    valid = np.flatnonzero(np.isfinite(lats) & np.isfinite(lons))
+    if len(valid) == 0:
+        return results
+
+    if map_id:
+        index = get_map_index(map_id)
+        if not index:
+            return results
+        hits = lookup_map_index_bulk(index, lons[valid], lats[valid])
+    else:
+        global_index = get_global_index()
+        hits = lookup_map_index_bulk(global_index, lons[valid], lats[valid])
+
+    matched = hits >= 0
+    payloads: Dict[int, Dict] = {}
+    for point_idx, hit in zip(valid[matched].tolist(), hits[matched].tolist()):
+        if hit not in payloads:
+            if map_id:
+                payloads[hit] = _neighborhood_payload(index, hit, history)
+            else:
+                payloads[hit] = _neighborhood_payload(*split_global_hit(global_index, hit), history)
+        results[point_idx] = payloads[hit]
+    return results
+
+
+def aggregate_points(map_id: str, lats: np.ndarray, lons: np.ndarray, weights: np.ndarray) -> Optional[Dict]:
+    """تعداد و مجموع وزن نقاط هر محله یک نقشه با یک lookup برداری و np.bincount
+    خروجی بر اساس feature_id است تا مستقیماً روی properties.feature_id لایه نقشه join شود.
+    """
+    index = get_map_index(map_id)
+    if not index:
+        return None
+    valid = np.flatnonzero(np.isfinite(lats) & np.isfinite(lons) & np.isfinite(weights))
+    hits = lookup_map_index_bulk(index, lons[valid], lats[valid])
+    matched = hits >= 0
+    counts = np.bincount(hits[matched], minlength=index_size(index))
+    sums = np.bincount(hits[matched], weights=weights[valid][matched], minlength=index_size(index))
+
+    results: Dict[str, Dict] = {}
+    for feature_idx in np.flatnonzero(counts).tolist():
+        record = index_record(index, feature_idx)
+        key = record["feature_id"] or str(feature_idx)
+        item = results.setdefault(key, {"region": record["region"], "count": 0, "sum": 0.0})
+        item["count"] += int(counts[feature_idx])
+        item["sum"] += float(sums[feature_idx])
+    return {
+        "count": len(lats),
+        "matched": int(matched.sum()),
+        "invalid": len(lats) - len(valid),
+        "results": results,
+    }
+
+
+def _parse_overlap_payload(payload) -> Tuple[object, Optional[Tuple[float, float, float]], Optional[str]]:
+    """تبدیل بدنه درخواست overlap به (polygon به مختصات جغرافیایی، (lon, lat, radius) دایره یا None، map_id)
+    ورودی قابل قبول: GeoJSON Polygon/MultiPolygon (یا Feature آن) یا {"center": {"lat", "lon"}, "radius_m": ..}
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("بدنه درخواست باید یک polygon یا دایره (center و radius_m) باشد")
+    map_id = payload.get("map_id")
+
+    if payload.get("center") is not None or payload.get("radius_m") is not None:
+        center = payload.get("center")
+        if isinstance(center, dict):
+            lat, lon = _first_nonempty(center, LAT_FIELDS), _first_nonempty(center, LON_FIELDS)
+        elif isinstance(center, (list, tuple)) and len(center) >= 2:
+            lon, lat = center[0], center[1]
+        else:
+            lat = lon = None
+        try:
+            lat, lon, radius = float(lat), float(lon), float(payload.get("radius_m"))
+        except (TypeError, ValueError):
+            raise ValueError("center (lat, lon) و radius_m باید عدد باشند")
+        if not 0 < radius <= NEIGHBORHOOD_OVERLAP_MAX_RADIUS_M:
+            raise ValueError(f"radius_m باید عددی بین 0 و {NEIGHBORHOOD_OVERLAP_MAX_RADIUS_M} باشد")
+        return None, (lon, lat, radius), map_id
+
+    geometry = payload.get("geometry") if payload.get("type") == "Feature" else payload.get("geometry", payload)
+    if not isinstance(geometry, dict) or geometry.get("type") not in ("Polygon", "MultiPolygon"):
+        raise ValueError("geometry باید Polygon یا MultiPolygon باشد")
+    try:
+        polygon = shape(geometry)
+    except Exception:
+        raise ValueError("geometry نامعتبر است")
+    if not polygon.is_valid:
+        polygon = shapely.make_valid(polygon)
+    if polygon.is_empty or polygon.area == 0:
+        raise ValueError("geometry خالی است")
+    return polygon, None, map_id
+
+
+def _laea_transform(geometries, transformer: Transformer, direction: str = "FORWARD"):
+    """تبدیل geometry ها بین مختصات جغرافیایی و تصویر هم‌مساحت (LAEA)"""
+    def project(coords: np.ndarray) -> np.ndarray:
+        x, y = transformer.transform(coords[:, 0], coords[:, 1], direction=direction)
+        return np.column_stack([x, y])
+    if direction == "FORWARD":
+        geometries = shapely.segmentize(geometries, OVERLAP_SEGMENTIZE_DEGREES)
+    return shapely.transform(geometries, project)
+
+
+def overlap_neighborhoods(polygon=None, circle: Optional[Tuple[float, float, float]] = None,
+                          map_id: Optional[str] = None) -> Dict:
+    """محلاتی که با یک polygon یا دایره همپوشانی دارند، با مساحت و نسبت همپوشانی
+    محاسبه مساحت در تصویر Lambert هم‌مساحت (LAEA) با مرکز روی محدوده درخواست انجام می‌شود؛
+    کاندیدها ابتدا با STRtree ایندکس هرس می‌شوند.
+    """
+    if circle is not None:
+        lon, lat, radius = circle
+    else:
+        lon, lat = polygon.centroid.x, polygon.centroid.y
+    transformer = Transformer.from_crs(
+        "EPSG:4326", f"+proj=laea +lat_0={lat} +lon_0={lon} +datum=WGS84 +units=m", always_xy=True
+    )
+    if circle is not None:
+        # دایره در تصویر هم‌مساحت ساخته می‌شود تا شعاع واقعاً متری باشد
+        query_projected = Point(0, 0).buffer(radius, quad_segs=32)
+        polygon = _laea_transform(query_projected, transformer, direction="INVERSE")
+    else:
+        query_projected = _laea_transform(polygon, transformer)
+    query_area = float(query_projected.area)
+
+    history = load_history()
+    index = get_map_index(map_id) if map_id else get_global_index()
+    result = {"query_area_m2": round(query_area, 2), "neighborhoods": []}
+    if not index or index_size(index) == 0:
+        return result
+
+    candidates = np.sort(index["tree"].query(polygon))
+    if len(candidates) == 0:
+        return result
+    hits = [_resolve_hit(index, int(candidate)) for candidate in candidates]
+    geometries = np.array([index_geometry(map_index, local_idx) for map_index, local_idx in hits], dtype=object)
+    intersecting = shapely.intersects(geometries, polygon)
+    hits = [hit for hit, keep in zip(hits, intersecting) if keep]
+    geometries = geometries[intersecting]
+    if len(geometries) == 0:
+        return result
+
+    projected = _laea_transform(geometries, transformer)
+    overlap_areas = shapely.area(shapely.intersection(projected, query_projected))
+    feature_areas = shapely.area(projected)
+    for (map_index, local_idx), overlap_area, feature_area in zip(hits, overlap_areas, feature_areas):
+        if overlap_area < NEIGHBORHOOD_OVERLAP_MIN_AREA_M2:
+            continue
+        item = _neighborhood_payload(map_index, local_idx, history)
+        item.pop("success", None)
+        item["feature_id"] = index_record(map_index, local_idx)["feature_id"]
+        item["overlap_area_m2"] = round(float(overlap_area), 2)
+        item["overlap_fraction"] = round(float(overlap_area / feature_area), 6) if feature_area else 0.0
+        item["query_fraction"] = round(float(overlap_area / query_area), 6) if query_area else 0.0
+        result["neighborhoods"].append(item)
+    result["neighborhoods"].sort(key=lambda item: -item["overlap_area_m2"])
+    return result
+
+
+TIME_FIELDS = ["timestamp", "time", "t", "datetime", "ts"]
+
+
+def _parse_timestamp(value) -> float:
+    """تبدیل timestamp (عدد epoch یا رشته ISO-8601) به ثانیه برای مرتب‌سازی نقاط مسیر"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(str(value).strip().replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        raise ValueError(f"timestamp نامعتبر: {value}")
+
+
+def _split_coordinates(coordinates) -> Tuple[List, List]:
+    """جدا کردن lon ها و lat های لیست [[lon, lat], ...]؛ مختصات ناقص خطای ValueError (پاسخ 400) می‌دهد"""
+    if not isinstance(coordinates, list) or not all(
+        isinstance(item, (list, tuple)) and len(item) >= 2 for item in coordinates
+    ):
+        raise ValueError("هر مختصات باید به صورت [lon, lat] باشد")
+    return [item[0] for item in coordinates], [item[1] for item in coordinates]
+
+
+def _parse_trace_payload(payload, default_map_id: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray, Optional[List], Optional[str]]:
+    """تبدیل بدنه درخواست مسیر به (lons, lats, timestamps, map_id)
+    ورودی قابل قبول: GeoJSON LineString (یا Feature آن)، {"coordinates": [[lon, lat], ...]}
+    یا {"points": [{"lat", "lon", "timestamp"}, ...]} - نقاط دارای timestamp به ترتیب زمان مرتب می‌شوند
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("بدنه درخواست باید یک LineString یا لیستی از نقاط باشد")
+    map_id = payload.get("map_id") or default_map_id
+    geometry = payload.get("geometry") if payload.get("type") == "Feature" else payload.get("geometry", payload)
+    timestamps = None
+
+    if isinstance(geometry, dict) and geometry.get("type") == "LineString":
+        lons, lats = _split_coordinates(geometry.get("coordinates") or [])
+    elif isinstance(payload.get("coordinates"), list):
+        lons, lats = _split_coordinates(payload["coordinates"])
+    elif isinstance(payload.get("points"), list):
+        points = [item for item in payload["points"] if isinstance(item, dict)]
+        if len(points) != len(payload["points"]):
+            raise ValueError("هر نقطه باید یک شیء با lat و lon باشد")
+        lats = [_first_nonempty(item, LAT_FIELDS) for item in points]
+        lons = [_first_nonempty(item, LON_FIELDS) for item in points]
+        raw_times = [_first_nonempty(item, TIME_FIELDS) for item in points]
+        if any(value is not None for value in raw_times):
+            if any(value is None for value in raw_times):
+                raise ValueError("timestamp باید برای همه نقاط ارسال شود")
+            timestamps = raw_times
+    else:
+        raise ValueError("بدنه درخواست باید یک LineString یا لیستی از نقاط باشد")
+
+    if len(lons) < 2:
+        raise ValueError("مسیر باید حداقل دو نقطه داشته باشد")
+    if len(lons) > NEIGHBORHOOD_BATCH_MAX_POINTS:
+        raise ValueError(f"حداکثر {NEIGHBORHOOD_BATCH_MAX_POINTS} نقطه در هر مسیر مجاز است")
+    try:
+        lons = np.array(lons, dtype=float)
+        lats = np.array(lats, dtype=float)
+    except (TypeError, ValueError):
+        raise ValueError("lat و lon باید عدد باشند")
+    if not (np.isfinite(lons).all() and np.isfinite(lats).all()):
+        raise ValueError("lat و lon باید عدد باشند")
+    return lons, lats, timestamps, map_id
+
+
+def trace_neighborhoods(lons: np.ndarray, lats: np.ndarray, map_id: Optional[str] = None,
+                        timestamps: Optional[List] = None) -> Optional[Dict]:
+    """محلاتی که یک مسیر GPS از آن‌ها عبور می‌کند، به ترتیب عبور
+    هر ضلع مسیر با STRtree به polygon های کاندید محدود می‌شود و تقاطع همه جفت‌های (ضلع، polygon)
+    یکجا با shapely محاسبه می‌شود. موقعیت روی مسیر به صورت «شماره ضلع + کسر طی شده از آن» است،
+    پس مسیرهای رفت و برگشتی و حلقه‌ای هم درست ترتیب‌بندی می‌شوند.
+    در هر نقشه polygon ها همپوشانی ندارند (resolve_overlaps)؛ بین نقشه‌های مختلف ایندکس سراسری
+    مثل /api/neighborhood اولین feature (کمترین اندیس) انتخاب می‌شود. None اگر نقشه map_id وجود نداشته باشد.
+    """
+    history = load_history()
+    index = get_map_index(map_id) if map_id else get_global_index()
+    if map_id and not index:
+        return None
+
+    # ترتیب زمانی و حذف نقاط تکراری پشت سر هم (ضلع با طول صفر)
+    order = np.arange(len(lons))
+    if timestamps is not None:
+        order = np.argsort([_parse_timestamp(value) for value in timestamps], kind="stable")
+    coords = np.column_stack([lons[order], lats[order]])
+    keep = np.r_[True, np.any(coords[1:] != coords[:-1], axis=1)]
+    source_idx = order[keep]
+    coords = coords[keep]
+
+    total_length = float(GEOD.line_length(coords[:, 0], coords[:, 1])) if len(coords) > 1 else 0.0
+    result = {"length_m": round(total_length, 2), "neighborhoods": []}
+    if not index or index_size(index) == 0 or len(coords) < 2:
+        return result
+
+    segments = shapely.linestrings(np.stack([coords[:-1], coords[1:]], axis=1))
+    seg_idx, feature_idx = index["tree"].query(segments)
+    if len(seg_idx) == 0:
+        return result
+
+    # تقاطع برداری همه جفت‌های (ضلع، polygon کاندید)
+    geometries = np.array([index_geometry(*_resolve_hit(index, int(i))) for i in feature_idx], dtype=object)
+    pieces, pair_idx = shapely.get_parts(shapely.intersection(segments[seg_idx], geometries), return_index=True)
+    is_line = shapely.get_type_id(pieces) == 1
+    pieces, pair_idx = pieces[is_line], pair_idx[is_line]
+    if len(pieces) == 0:
+        return result
+    pair_segments = segments[seg_idx[pair_idx]]
+    t0 = shapely.line_locate_point(pair_segments, shapely.get_point(pieces, 0), normalized=True)
+    t1 = shapely.line_locate_point(pair_segments, shapely.get_point(pieces, -1), normalized=True)
+    starts = seg_idx[pair_idx] + np.minimum(t0, t1)
+    ends = seg_idx[pair_idx] + np.maximum(t0, t1)
+    owners = feature_idx[pair_idx]
+    valid = ends > starts
+    starts, ends, owners = starts[valid], ends[valid], owners[valid]
+
+    # تقسیم مسیر به بازه‌های مقدماتی و انتخاب اولین feature پوشاننده هر بازه با یک پیمایش مرتب:
+    # تکه‌ها به ترتیب شروع وارد heap (کمترین اندیس در بالا) می‌شوند و تکه‌های تمام شده از بالای آن حذف می‌شوند
+    boundaries = np.unique(np.concatenate([starts, ends]))
+    order = np.argsort(starts, kind="stable")
+    starts, ends, owners = starts[order].tolist(), ends[order].tolist(), owners[order].tolist()
+    active: List[Tuple[int, float]] = []
+    next_piece = 0
+    intervals = []
+    for lo, hi in zip(boundaries[:-1].tolist(), boundaries[1:].tolist()):
+        while next_piece < len(starts) and starts[next_piece] <= lo:
+            heapq.heappush(active, (owners[next_piece], ends[next_piece]))
+            next_piece += 1
+        while active and active[0][1] <= lo:
+            heapq.heappop(active)
+        if active:
+            intervals.append([lo, hi, int(active[0][0])])
+
+    # ادغام بازه‌های پشت سر هم یک feature به یک عبور (ورود تا خروج)
+    visits = []
+    for lo, hi, owner in intervals:
+        if visits and visits[-1][2] == owner and lo - visits[-1][1] < 1e-9:
+            visits[-1][1] = hi
+        else:
+            visits.append([lo, hi, owner])
+
+    def position_coords(position: float) -> np.ndarray:
+        segment = min(int(position), len(coords) - 2)
+        fraction = position - segment
+        return coords[segment] + fraction * (coords[segment + 1] - coords[segment])
+
+    for lo, hi, owner in visits:
+        inner = np.arange(int(np.floor(lo)) + 1, int(np.ceil(hi)))
+        path = np.vstack([position_coords(lo), coords[inner], position_coords(hi)])
+        entry_idx = int(source_idx[min(int(np.floor(lo)), len(coords) - 1)])
+        exit_idx = int(source_idx[min(int(np.ceil(hi)), len(coords) - 1)])
+        map_index, local_idx = _resolve_hit(index, owner)
+        visit = _neighborhood_payload(map_index, local_idx, history)
+        visit.pop("success", None)
+        visit["feature_id"] = index_record(map_index, local_idx)["feature_id"]
+        visit["entry_index"] = entry_idx
+        visit["exit_index"] = exit_idx
+        visit["length_m"] = round(float(GEOD.line_length(path[:, 0], path[:, 1])), 2)
+        if timestamps is not None:
+            visit["entry_time"] = timestamps[entry_idx]
+            visit["exit_time"] = timestamps[exit_idx]
+        result["neighborhoods"].append(visit)
+    return result
+
+
+# ========== Neighborhood Result Cache ==========
+
+# کش LRU نتایج geocoding با کلید (map_id یا "all"، lat/lon گرد شده)
+# نقاط داخل یک خانه گرد شده (حدود ۱ متر با دقت ۵ رقم اعشار) پاسخ مشترک می‌گیرند
+NEIGHBORHOOD_CACHE_PRECISION = int(os.environ.get("NEIGHBORHOOD_CACHE_PRECISION", "5"))
+NEIGHBORHOOD_CACHE_MAX_ENTRIES = int(os.environ.get("NEIGHBORHOOD_CACHE_MAX_ENTRIES", "100000"))
+NEIGHBORHOOD_CACHE_MAX_BYTES = int(os.environ.get("NEIGHBORHOOD_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+NEIGHBORHOOD_CACHE_TTL = float(os.environ.get("NEIGHBORHOOD_CACHE_TTL", "300"))
+
+_CACHE_MISS = object()
+_NEIGHBORHOOD_CACHE: "OrderedDict[Tuple, Tuple]" = OrderedDict()
+_NEIGHBORHOOD_CACHE_LOCK = threading.Lock()
+_NEIGHBORHOOD_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0, "bytes": 0}
+
+
+def _neighborhood_cache_drop(key: Tuple) -> None:
+    """حذف یک ورودی از کش و کم کردن حجم آن از بودجه"""
+    entry = _NEIGHBORHOOD_CACHE.pop(key, None)
+    if entry is not None:
+        _NEIGHBORHOOD_CACHE_STATS["bytes"] -= entry[3]
+
+
+def neighborhood_cache_get(key: Tuple, revision: Tuple):
+    """خواندن نتیجه از کش - در صورت نبود، انقضا یا تغییر نسخه نقشه‌ها _CACHE_MISS برمی‌گرداند"""
+    with _NEIGHBORHOOD_CACHE_LOCK:
+        entry = _NEIGHBORHOOD_CACHE.get(key)
+        if entry is None:
+            _NEIGHBORHOOD_CACHE_STATS["misses"] += 1
+            return _CACHE_MISS
+        entry_revision, expires_at, value, _ = entry
+        if entry_revision != revision:
+            _neighborhood_cache_drop(key)
+            _NEIGHBORHOOD_CACHE_STATS["invalidations"] += 1
+            _NEIGHBORHOOD_CACHE_STATS["misses"] += 1
+            return _CACHE_MISS
+        if expires_at < time.monotonic():
+            _neighborhood_cache_drop(key)
+            _NEIGHBORHOOD_CACHE_STATS["expirations"] += 1
+            _NEIGHBORHOOD_CACHE_STATS["misses"] += 1
+            return _CACHE_MISS
+        _NEIGHBORHOOD_CACHE.move_to_end(key)
+        _NEIGHBORHOOD_CACHE_STATS["hits"] += 1
+        return value
+
+
+def neighborhood_cache_put(key: Tuple, revision: Tuple, value: Optional[Dict]) -> None:
+    """ذخیره نتیجه (یا None برای «محله پیدا نشد») در کش با رعایت بودجه تعداد و حجم"""
+    if NEIGHBORHOOD_CACHE_MAX_ENTRIES <= 0 or NEIGHBORHOOD_CACHE_MAX_BYTES <= 0:
+        return
+    size = len(json.dumps(value, ensure_ascii=False).encode("utf-8")) + len(repr(key)) + 64
+    with _NEIGHBORHOOD_CACHE_LOCK:
+        _neighborhood_cache_drop(key)
+        _NEIGHBORHOOD_CACHE[key] = (revision, time.monotonic() + NEIGHBORHOOD_CACHE_TTL, value, size)
+        _NEIGHBORHOOD_CACHE_STATS["bytes"] += size
+        while _NEIGHBORHOOD_CACHE and (
+            len(_NEIGHBORHOOD_CACHE) > NEIGHBORHOOD_CACHE_MAX_ENTRIES
+            or _NEIGHBORHOOD_CACHE_STATS["bytes"] > NEIGHBORHOOD_CACHE_MAX_BYTES
+        ):
+            oldest_key = next(iter(_NEIGHBORHOOD_CACHE))
+            _neighborhood_cache_drop(oldest_key)
+            _NEIGHBORHOOD_CACHE_STATS["evictions"] += 1
+
+
+def get_neighborhood_cache_stats() -> Dict:
+    """شمارنده‌های کش برای تنظیم اندازه آن"""
+    with _NEIGHBORHOOD_CACHE_LOCK:
+        stats = dict(_NEIGHBORHOOD_CACHE_STATS)
+        stats["entries"] = len(_NEIGHBORHOOD_CACHE)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else None
+    stats.update({
+        "precision": NEIGHBORHOOD_CACHE_PRECISION,
+        "max_entries": NEIGHBORHOOD_CACHE_MAX_ENTRIES,
+        "max_bytes": NEIGHBORHOOD_CACHE_MAX_BYTES,
+        "ttl_seconds": NEIGHBORHOOD_CACHE_TTL,
+    })
+    return stats
+
+
+# ========== File Cache ==========
+
+# کش محتوای فایل‌های داده (تاریخچه، کاربران، لینک‌ها، ویرایش‌ها، فهرست عوارض و فایل‌های نقشه) در حافظه هر worker
+# کلید: مسیر فایل و تابع خواننده؛ هر ورودی با (mtime, size) فایل اعتبارسنجی می‌شود تا نوشتن worker دیگر هم دیده شود.
+# بودجه حجم بر اساس تخمین حافظه مقدار خوانده شده (اشیای Python) است، نه اندازه فایل روی دیسک؛
+# GeoJSON کامل یک فایل ستونی چندین برابر خود فایل حافظه می‌گیرد.
+FILE_CACHE_MAX_BYTES = int(os.environ.get("FILE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+_FILE_CACHE: "OrderedDict[Tuple[str, str], Tuple]" = OrderedDict()
+_FILE_CACHE_LOCK = threading.Lock()
+_FILE_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0, "bytes": 0}
+
+
+def _file_cache_drop(key: Tuple[str, str]) -> None:
+    """حذف یک ورودی از کش و کم کردن حجم آن از بودجه"""
+    entry = _FILE_CACHE.pop(key, None)
+    if entry is not None:
+        _FILE_CACHE_STATS["bytes"] -= entry[2]
+
+
+# تعداد عناصری از هر لیست/دیکشنری که برای تخمین حجم بررسی می‌شوند (بقیه به نسبت برون‌یابی می‌شوند)
+_SIZE_ESTIMATE_SAMPLE = 16
+
+
+def estimate_object_size(value, _depth: int = 0) -> int:
+    """تخمین حافظه یک مقدار تو در تو (dict/list/str/عدد) با sys.getsizeof روی نمونه‌ای از عناصر هر سطح"""
+    size = sys.getsizeof(value)
+    if _depth > 32:
+        return size
+    if isinstance(value, dict):
+        items = value.items()
+        count = len(value)
+        sample = [key for pair in itertools.islice(items, _SIZE_ESTIMATE_SAMPLE) for key in pair]
+    elif isinstance(value, (list, tuple)):
+        count = len(value)
+        sample = value[:_SIZE_ESTIMATE_SAMPLE]
+    else:
+        return size
+    if not count:
+        return size
+    sampled = sum(estimate_object_size(item, _depth + 1) for item in sample)
+    sampled_count = min(count, _SIZE_ESTIMATE_SAMPLE)
+    return size + sampled * count // sampled_count
+
+
+def cached_file_read(path: Path, loader: Callable[[Path], object], clone: Optional[Callable] = copy.deepcopy):
+    """خروجی loader(path) از کش؛ فایل فقط وقتی دوباره خوانده می‌شود که (mtime, size) آن عوض شده باشد
+    None اگر فایل وجود ندارد. clone روی مقدار کش شده اعمال می‌شود تا تغییر آن توسط فراخواننده کش را خراب نکند
+    (clone=None فقط برای فراخواننده‌هایی که مقدار را تغییر نمی‌دهند).
+    """
+    key = (str(path), loader.__qualname__)
+    signature = _file_signature(path)
+    with _FILE_CACHE_LOCK:
+        entry = _FILE_CACHE.get(key)
+        if entry is not None and entry[0] == signature:
+            _FILE_CACHE.move_to_end(key)
+            _FILE_CACHE_STATS["hits"] += 1
+            value = entry[1]
+        else:
+            if entry is not None:
+                _file_cache_drop(key)
+                _FILE_CACHE_STATS["invalidations"] += 1
+            _FILE_CACHE_STATS["misses"] += 1
+            value = _CACHE_MISS
+
+    if value is _CACHE_MISS:
+        # نبود فایل هم کش می‌شود (مثلاً ویرایش‌های نقشه‌ای که هنوز ویرایش ندارد)
+        value = loader(path) if signature is not None else None
+        size = estimate_object_size(value)
+        if size <= FILE_CACHE_MAX_BYTES:
+            with _FILE_CACHE_LOCK:
+                _file_cache_drop(key)
+                _FILE_CACHE[key] = (signature, value, size)
+                _FILE_CACHE_STATS["bytes"] += size
+                while _FILE_CACHE_STATS["bytes"] > FILE_CACHE_MAX_BYTES:
+                    _file_cache_drop(next(iter(_FILE_CACHE)))
+                    _FILE_CACHE_STATS["evictions"] += 1
+    return clone(value) if clone is not None and value is not None else value
+
+
+def invalidate_file_cache(path: Path) -> None:
+    """حذف همه ورودی‌های یک فایل (بعد از نوشتن آن در همین worker)"""
+    path_key = str(path)
+    with _FILE_CACHE_LOCK:
+        for key in [key for key in _FILE_CACHE if key[0] == path_key]:
+            _file_cache_drop(key)
+            _FILE_CACHE_STATS["invalidations"] += 1
+
+
+def get_file_cache_stats() -> Dict:
+    with _FILE_CACHE_LOCK:
+        stats = dict(_FILE_CACHE_STATS)
+        stats["entries"] = len(_FILE_CACHE)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else None
+    stats["max_bytes"] = FILE_CACHE_MAX_BYTES
+    return stats
+
+
+def _read_json_file(path: Path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ========== Atomic Writes & Locks ==========
+
+# فایل‌های JSON با نوشتن در یک فایل موقت کنار فایل اصلی و os.replace ذخیره می‌شوند تا خواننده‌ها (در هر worker)
+# هرگز فایل نیمه‌کاره نبینند. چرخه‌های خواندن-تغییر-نوشتن داخل file_lock انجام می‌شوند (قفل fcntl روی
+# فایل {نام}.lock) تا ذخیره همزمان دو worker تغییرات یکدیگر را از بین نبرد. فایل قفل همراه فایل داده‌اش
+# (با remove_lock_file زیر همان قفل) حذف می‌شود؛ قفل فقط وقتی گرفته شده حساب می‌شود که فایل قفل باز شده
+# هنوز همان فایل روی دیسک باشد.
+# محتوای هر فایل قبل از rename با fsync روی دیسک می‌رود؛ fsync پوشه‌ها (ماندگاری خود rename ها) برای هر
+# درخواست جمع می‌شود و در پایان درخواست یک بار برای هر پوشه انجام می‌شود.
+JSON_WRITE_FSYNC = os.environ.get("JSON_WRITE_FSYNC", "1").lower() not in ("0", "false", "no")
+
+_PATH_LOCKS: Dict[str, threading.RLock] = {}
+_PATH_LOCK_DEPTH: Dict[str, int] = {}
+_PATH_LOCKS_GUARD = threading.Lock()
+
+
+@contextmanager
+def file_lock(path: Path):
+    """قفل انحصاری یک فایل بین thread ها و (با fcntl) بین worker ها؛ در یک thread قابل تکرار است
+    بدون fcntl (ویندوز) فقط thread های همین process هماهنگ می‌شوند.
+    """
+    key = str(path)
+    with _PATH_LOCKS_GUARD:
+        lock = _PATH_LOCKS.setdefault(key, threading.RLock())
+    with lock:
+        # قفل فایل فقط در بیرونی‌ترین سطح گرفته می‌شود؛ عمق فقط زیر همین RLock تغییر می‌کند
+        if _PATH_LOCK_DEPTH.get(key) or fcntl is None:
+            _PATH_LOCK_DEPTH[key] = _PATH_LOCK_DEPTH.get(key, 0) + 1
+            try:
+                yield
+            finally:
+                _PATH_LOCK_DEPTH[key] -= 1
+            return
+        lock_path = f"{key}.lock"
+        while True:
+            lock_file = open(lock_path, "a")
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            # اگر worker دیگری در این فاصله فایل قفل را حذف کرده باشد، قفل روی فایل حذف شده بی‌اثر است
+            try:
+                opened, current = os.fstat(lock_file.fileno()), os.stat(lock_path)
+                if (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino):
+                    break
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+        with lock_file:
+            _PATH_LOCK_DEPTH[key] = 1
+            try:
+                yield
+            finally:
+                _PATH_LOCK_DEPTH[key] = 0
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def remove_lock_file(path: Path) -> None:
+    """حذف فایل قفل یک فایل داده حذف شده - فقط داخل file_lock(path) صدا زده می‌شود"""
+    Path(f"{path}.lock").unlink(missing_ok=True)
+
+
+def _fsync_dir(directory: Path) -> None:
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _schedule_dir_fsync(directory: Path) -> None:
+    """fsync پوشه در پایان درخواست فعلی (یا فوراً اگر خارج از درخواست هستیم، مثل job های پس‌زمینه)"""
+    if not JSON_WRITE_FSYNC:
+        return
+    if has_request_context():
+        pending = g.setdefault("pending_dir_fsync", set())
+        pending.add(str(directory))
+    else:
+        _fsync_dir(directory)
+
+
+@app.teardown_request
+def _flush_pending_dir_fsync(exc=None) -> None:
+    for directory in g.pop("pending_dir_fsync", ()):
+        _fsync_dir(Path(directory))
+
+
+def write_json_atomic(path: Path, data, indent: Optional[int] = 2, default=None) -> None:
+    """نوشتن JSON در فایل موقت و جایگزینی اتمیک فایل اصلی (زیر قفل همان فایل)"""
+    temp_file = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with file_lock(path):
+        try:
+            with open(temp_file, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=indent, default=default)
+                if JSON_WRITE_FSYNC:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(temp_file, path)
+        finally:
+            if temp_file.exists():
+                temp_file.unlink()
+        invalidate_file_cache(path)
+    _schedule_dir_fsync(path.parent)
+
+
+# ========== SQLite Metadata Backend ==========
+
+# با METADATA_BACKEND=sqlite تاریخچه، کاربران، لینک‌ها، ویرایش‌ها، لوگوها و فهرست عوارض به جای فایل‌های JSON
+# در یک پایگاه SQLite (حالت WAL: خواننده‌های همزمان بدون قفل کردن نویسنده) با جدول‌های ایندکس‌دار نگه داشته می‌شوند.
+# توابع load_*/save_* همان امضا را دارند؛ جستجوهای تکی (کاربر، نقشه هم‌نام، ویرایش یک محله، لوگو) با ایندکس انجام می‌شوند.
+# انتقال یک‌باره داده‌های فعلی: flask --app app import-metadata
+# هر ذخیره لینک‌ها/ویرایش‌ها/تاریخچه نسخه آن را در جدول revisions بالا می‌برد (به جای mtime فایل) تا ایندکس‌ها،
+# snapshot ها و کش نتایج مثل قبل باطل شوند. قفل‌های file_lock همچنان چرخه‌های خواندن-تغییر-نوشتن را بین worker ها هماهنگ می‌کنند.
+METADATA_BACKEND = os.environ.get("METADATA_BACKEND", "json").strip().lower()
+METADATA_DB_FILE = Path(os.environ.get("METADATA_DB_PATH", str(UPLOAD_ROOT / "metadata.db")))
+
+_METADATA_DB = threading.local()
+_METADATA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    map_id TEXT PRIMARY KEY, position INTEGER NOT NULL, name_key TEXT NOT NULL, data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_position ON history (position);
+CREATE INDEX IF NOT EXISTS history_name_key ON history (name_key, position);
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY, position INTEGER NOT NULL, data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS links (
+    map_id TEXT NOT NULL, feature_id TEXT NOT NULL, position INTEGER NOT NULL, link TEXT NOT NULL,
+    PRIMARY KEY (map_id, feature_id)
+);
+CREATE TABLE IF NOT EXISTS neighborhood_edits (
+    map_id TEXT NOT NULL, edit_key TEXT NOT NULL, position INTEGER NOT NULL, feature_id TEXT NOT NULL, data TEXT NOT NULL,
+    PRIMARY KEY (map_id, edit_key)
+);
+CREATE INDEX IF NOT EXISTS neighborhood_edits_feature ON neighborhood_edits (map_id, feature_id, position);
+CREATE TABLE IF NOT EXISTS features_index (
+    feature_id TEXT PRIMARY KEY, position INTEGER NOT NULL, map_id TEXT, data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS features_index_map ON features_index (map_id, position);
+CREATE TABLE IF NOT EXISTS neighborhood_logos (
+    map_id TEXT NOT NULL, neighborhood_name TEXT NOT NULL, name_key TEXT NOT NULL, logo_filename TEXT NOT NULL,
+    PRIMARY KEY (map_id, neighborhood_name)
+);
+CREATE INDEX IF NOT EXISTS neighborhood_logos_name ON neighborhood_logos (map_id, name_key);
+CREATE TABLE IF NOT EXISTS revisions (
+    name TEXT PRIMARY KEY, updated_ns INTEGER NOT NULL, version INTEGER NOT NULL
+);
+"""
+
+
+def metadata_db() -> sqlite3.Connection:
+    """اتصال SQLite این thread (بعد از fork در worker جدید دوباره باز می‌شود)"""
+    conn = getattr(_METADATA_DB, "conn", None)
+    if conn is None or getattr(_METADATA_DB, "pid", None) != os.getpid():
+        conn = sqlite3.connect(str(METADATA_DB_FILE), timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_METADATA_SCHEMA)
+        _METADATA_DB.conn = conn
+        _METADATA_DB.pid = os.getpid()
+    return conn
+
+
+@contextmanager
+def metadata_transaction():
+    """تراکنش نوشتن (BEGIN IMMEDIATE: نویسنده‌ها پشت سر هم، خواننده‌ها بدون انتظار)
+    داخل یک تراکنش باز، بخشی از همان تراکنش است (برای انتقال همه داده‌ها در یک تراکنش).
+    """
+    conn = metadata_db()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _bump_metadata_revision(conn: sqlite3.Connection, name: str) -> None:
+    conn.execute(
+        "INSERT INTO revisions (name, updated_ns, version) VALUES (?, ?, 1) "
+        "ON CONFLICT (name) DO UPDATE SET updated_ns = excluded.updated_ns, version = version + 1",
+        (name, time.time_ns()),
+    )
+
+
+def metadata_signature(kind: str, map_id: Optional[str] = None) -> Optional[Tuple]:
+    """نسخه تاریخچه یا لینک‌ها/ویرایش‌های یک نقشه: (mtime, size) فایل JSON یا (زمان، شماره نسخه) در SQLite
+    عضو اول در هر دو حالت زمان آخرین تغییر به نانوثانیه است.
+    """
+    if METADATA_BACKEND == "sqlite":
+        name = f"{kind}:{map_id}" if map_id else kind
+        row = metadata_db().execute("SELECT updated_ns, version FROM revisions WHERE name = ?", (name,)).fetchone()
+        return tuple(row) if row else None
+    if kind == "history":
+        return _file_signature(HISTORY_FILE)
+    if kind == "links":
+        return _file_signature(LINKS_DIR / f"{map_id}.json")
+    return _file_signature(get_neighborhood_edits_file(map_id))
+
+
+def _history_name_key(item: Dict) -> str:
+    return (item.get("map_name") or item.get("original_filename", "")).lower().strip()
+
+
+def _sqlite_load_history() -> List[Dict]:
+    rows = metadata_db().execute("SELECT data FROM history ORDER BY position")
+    return [json.loads(data) for (data,) in rows]
+
+
+def _sqlite_save_history(history: List[Dict]) -> None:
+    with metadata_transaction() as conn:
+        conn.execute("DELETE FROM history")
+        conn.executemany(
+            "INSERT OR REPLACE INTO history (map_id, position, name_key, data) VALUES (?, ?, ?, ?)",
+            [(item.get("map_id"), position, _history_name_key(item), json.dumps(item, ensure_ascii=False))
+             for position, item in enumerate(history)],
+        )
+        _bump_metadata_revision(conn, "history")
+
+
+def _sqlite_find_map_by_name(search_name: str) -> Optional[str]:
+    row = metadata_db().execute(
+        "SELECT map_id FROM history WHERE name_key = ? ORDER BY position LIMIT 1", (search_name,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def _sqlite_load_users() -> List[Dict]:
+    return [json.loads(data) for (data,) in metadata_db().execute("SELECT data FROM users ORDER BY position")]
+
+
+def _sqlite_save_users(users: List[Dict]) -> None:
+    with metadata_transaction() as conn:
+        conn.execute("DELETE FROM users")
+        conn.executemany(
+            "INSERT OR REPLACE INTO users (username, position, data) VALUES (?, ?, ?)",
+            [(user.get("username"), position, json.dumps(user, ensure_ascii=False)) for position, user in enumerate(users)],
+        )
+
+
+def _sqlite_get_user(username: str) -> Optional[Dict]:
+    row = metadata_db().execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def _sqlite_load_links(map_id: str) -> Dict[str, str]:
+    rows = metadata_db().execute("SELECT feature_id, link FROM links WHERE map_id = ? ORDER BY position", (map_id,))
+    return dict(rows.fetchall())
+
+
+def _sqlite_save_links(map_id: str, links: Optional[Dict[str, str]]) -> None:
+    """جایگزینی لینک‌های یک نقشه (None: حذف کامل)"""
+    with metadata_transaction() as conn:
+        conn.execute("DELETE FROM links WHERE map_id = ?", (map_id,))
+        conn.executemany(
+            "INSERT INTO links (map_id, feature_id, position, link) VALUES (?, ?, ?, ?)",
+            [(map_id, str(feature_id), position, link) for position, (feature_id, link) in enumerate((links or {}).items())],
+        )
+        if links is None:
+            conn.execute("DELETE FROM revisions WHERE name = ?", (f"links:{map_id}",))
+        else:
+            _bump_metadata_revision(conn, f"links:{map_id}")
+
+
+def _sqlite_load_neighborhood_edits(map_id: str) -> Dict[str, Dict]:
+    rows = metadata_db().execute(
+        "SELECT edit_key, data FROM neighborhood_edits WHERE map_id = ? ORDER BY position", (map_id,)
+    )
+    return {edit_key: json.loads(data) for edit_key, data in rows}
+
+
+def _sqlite_save_neighborhood_edits(map_id: str, edits: Dict[str, Dict]) -> None:
+    rows = []
+    for position, (edit_key, edit_item) in enumerate(edits.items()):
+        feature_id = str(edit_item.get("feature_id", "")).strip() if isinstance(edit_item, dict) else ""
+        rows.append((map_id, edit_key, position, feature_id, json.dumps(edit_item, ensure_ascii=False)))
+    with metadata_transaction() as conn:
+        conn.execute("DELETE FROM neighborhood_edits WHERE map_id = ?", (map_id,))
+        conn.executemany(
+            "INSERT INTO neighborhood_edits (map_id, edit_key, position, feature_id, data) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        _bump_metadata_revision(conn, f"edits:{map_id}")
+
+
+# ویرایش‌های هر نقشه یک بار خوانده و تا تغییر نسخه آن (metadata_signature) در حافظه همین worker نگه داشته می‌شوند
+# (apply_neighborhood_edits برای هر feature صدا زده می‌شود)
+_SQLITE_EDITS_CACHE: Dict[str, Tuple] = {}
+
+
+def _sqlite_neighborhood_edits_by_feature(map_id: str) -> Tuple[Dict, Dict]:
+    """(همه ویرایش‌ها، ویرایش هر feature_id) یک نقشه از کش، مثل _read_neighborhood_edits_by_feature"""
+    signature = metadata_signature("edits", map_id)
+    cached = _SQLITE_EDITS_CACHE.get(map_id)
+    if cached is None or cached[0] != signature:
+        edits = _sqlite_load_neighborhood_edits(map_id) if signature is not None else {}
+        cached = (signature, edits, _edits_by_feature(edits))
+        _SQLITE_EDITS_CACHE[map_id] = cached
+    return cached[1], cached[2]
+
+
+def _sqlite_load_features_index(map_id: Optional[str] = None) -> List[Dict]:
+    if map_id is None:
+        rows = metadata_db().execute("SELECT data FROM features_index ORDER BY position")
+    else:
+        rows = metadata_db().execute("SELECT data FROM features_index WHERE map_id = ? ORDER BY position", (map_id,))
+    return [json.loads(data) for (data,) in rows]
+
+
+def _sqlite_save_features_index(index: List[Dict]) -> None:
+    with metadata_transaction() as conn:
+        conn.execute("DELETE FROM features_index")
+        conn.executemany(
+            "INSERT OR REPLACE INTO features_index (feature_id, position, map_id, data) VALUES (?, ?, ?, ?)",
+            [(item.get("feature_id"), position, item.get("map_id"), json.dumps(item, ensure_ascii=False))
+             for position, item in enumerate(index)],
+        )
+
+
+def _sqlite_save_neighborhood_logo(map_id: str, neighborhood_name: str, logo_filename: str) -> None:
+    with metadata_transaction() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO neighborhood_logos (map_id, neighborhood_name, name_key, logo_filename) "
+            "VALUES (?, ?, ?, ?)",
+            (map_id, neighborhood_name, neighborhood_name.strip().lower(), logo_filename),
+        )
+
+
+def _sqlite_load_neighborhood_logo(map_id: str, neighborhood_name: str) -> Optional[str]:
+    """همان ترتیب جستجوی نسخه JSON: نام دقیق، بدون حساسیت به حروف، سپس تطابق بخشی"""
+    conn = metadata_db()
+    name = neighborhood_name.strip()
+    for query, value in (
+        ("neighborhood_name = ?", name),
+        ("name_key = ?", name.lower()),
+    ):
+        row = conn.execute(
+            f"SELECT logo_filename FROM neighborhood_logos WHERE map_id = ? AND {query} AND logo_filename != ''",
+            (map_id, value),
+        ).fetchone()
+        if row:
+            return row[0]
+    for name_key, logo_filename in conn.execute(
+        "SELECT name_key, logo_filename FROM neighborhood_logos WHERE map_id = ? AND logo_filename != ''", (map_id,)
+    ):
+        if name.lower() in name_key or name_key in name.lower():
+            return logo_filename
+    return None
+
+
+def _sqlite_get_all_neighborhood_logos(map_id: str) -> Dict[str, str]:
+    rows = metadata_db().execute(
+        "SELECT neighborhood_name, logo_filename FROM neighborhood_logos WHERE map_id = ?", (map_id,)
+    )
+    return dict(rows.fetchall())
+
+
+def _sqlite_rename_neighborhood_logo_file(map_id: str, old_filename: str, new_filename: str) -> None:
+    with metadata_transaction() as conn:
+        conn.execute(
+            "UPDATE neighborhood_logos SET logo_filename = ? WHERE map_id = ? AND logo_filename = ?",
+            (new_filename, map_id, old_filename),
+        )
+
+
+_METADATA_TABLES = ("history", "users", "links", "neighborhood_edits", "features_index", "neighborhood_logos")
+
+
+def import_metadata_from_files() -> Dict[str, int]:
+    """انتقال داده‌های فایل‌های JSON فعلی به SQLite در یک تراکنش
+    اجرای دوباره همه جدول‌ها را با محتوای فایل‌ها جایگزین می‌کند و نسخه همه داده‌ها را بالا می‌برد تا کش‌ها باطل شوند.
+    اگر فایل کاربران وجود نداشته باشد، مثل نسخه JSON کاربر پیش‌فرض admin ساخته می‌شود.
+    """
+    def read(path: Path, default):
+        try:
+            return _read_json_file(path) if path.exists() else default
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Error reading {path}: {e}")
+            return default
+
+    counts = dict.fromkeys(_METADATA_TABLES, 0)
+    with metadata_transaction() as conn:
+        for table in _METADATA_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+        conn.execute("UPDATE revisions SET updated_ns = ?, version = version + 1", (time.time_ns(),))
+
+        history = read(HISTORY_FILE, [])
+        _sqlite_save_history(history)
+        counts["history"] = len(history)
+        users = read(USERS_FILE, []) if USERS_FILE.exists() else [default_admin_user()]
+        _sqlite_save_users(users)
+        counts["users"] = len(users)
+        index = read(FEATURES_INDEX_FILE, [])
+        _sqlite_save_features_index(index)
+        counts["features_index"] = len(index)
+        for links_file in sorted(LINKS_DIR.glob("*.json")):
+            links = read(links_file, {})
+            _sqlite_save_links(links_file.stem, links)
+            counts["links"] += len(links)
+        for edits_file in sorted(NEIGHBORHOOD_EDITS_DIR.glob("*.json")):
+            edits = read(edits_file, {})
+            _sqlite_save_neighborhood_edits(edits_file.stem, edits)
+            counts["neighborhood_edits"] += len(edits)
+        for logo_file in sorted(LOGO_DIR.glob("*.json")):
+            data = read(logo_file, {})
+            if data.get("map_id") and data.get("neighborhood_name"):
+                _sqlite_save_neighborhood_logo(data["map_id"], data["neighborhood_name"], data.get("logo_filename") or "")
+                counts["neighborhood_logos"] += 1
+    return counts
+
+
+def metadata_db_is_empty() -> bool:
+    """پایگاه SQLite هنوز هیچ داده‌ای ندارد (مثلاً METADATA_BACKEND=sqlite قبل از import-metadata تنظیم شده)"""
+    conn = metadata_db()
+    return not any(conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() for table in _METADATA_TABLES)
+
+
+def ensure_metadata_db() -> None:
+    """در شروع برنامه با METADATA_BACKEND=sqlite: اگر پایگاه خالی است، داده‌های فایل‌های JSON خودکار منتقل می‌شوند
+    تا تاریخچه، لینک‌ها و کاربران فعلی پنهان نشوند (قفل فایل مانع انتقال همزمان چند worker می‌شود).
+    """
+    with file_lock(METADATA_DB_FILE):
+        if not metadata_db_is_empty():
+            return
+        counts = import_metadata_from_files()
+    print(f"✅ پایگاه {METADATA_DB_FILE} خالی بود؛ داده‌های فایل‌های JSON منتقل شدند: {counts}")
+
+
+@app.cli.command("import-metadata")
+def import_metadata_command() -> None:
+    """انتقال تاریخچه، کاربران، لینک‌ها، ویرایش‌ها، لوگوها و فهرست عوارض از فایل‌های JSON به SQLite"""
+    counts = import_metadata_from_files()
+    print(f"✅ داده‌ها به {METADATA_DB_FILE} منتقل شدند:")
+    for name, count in counts.items():
+        print(f"   {name}: {count}")
+    if METADATA_BACKEND != "sqlite":
+        print("برای استفاده از آن METADATA_BACKEND=sqlite را تنظیم کنید.")
+
+
+if METADATA_BACKEND == "sqlite":
+    ensure_metadata_db()
+
+
+# ========== Neighborhood Search ==========
+
+# جستجوی نام محله (forward geocoding): لیست مرتب نام‌های نرمال شده برای جستجوی پیشوندی (bisect)
+# و ایندکس سه‌حرفی (trigram) برای جستجوی تقریبی؛ با تغییر هر نقشه دوباره ساخته می‌شود
+_SEARCH_INDEX: Dict = {}
+NEIGHBORHOOD_SEARCH_MAX_RESULTS = 50
+NEIGHBORHOOD_SEARCH_MIN_SCORE = 0.3
+
+_PERSIAN_CHAR_MAP = str.maketrans({
+    "ي": "ی", "ى": "ی", "ئ": "ی", "ك": "ک", "ة": "ه", "ۀ": "ه",
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ؤ": "و",
+    "\u200c": " ", "\u200f": None, "\u200e": None, "ـ": None,
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+    **{chr(code): None for code in range(0x064B, 0x0653)},
+})
+
+
+def normalize_search_text(text: str) -> str:
+    """یکسان‌سازی حروف عربی/فارسی، ارقام، نیم‌فاصله و اعراب برای مقایسه نام‌ها"""
+    return " ".join(str(text).translate(_PERSIAN_CHAR_MAP).lower().split())
+
+
+def _trigrams(text: str) -> set:
+    """مجموعه سه‌حرفی‌های یک متن نرمال شده (با فاصله در ابتدا و انتها)"""
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def build_search_index(revision: Optional[Tuple] = None) -> Dict:
+    """ساخت ایندکس جستجوی نام روی رکوردهای ایندکس همه نقشه‌های تاریخچه"""
+    if revision is None:
+        revision = get_lookup_revision()
+    entries = []
+    for item in load_history():
+        item_map_id = item.get("map_id")
+        if not item_map_id:
+            continue
+        try:
+            index = get_map_index(item_map_id)
+        except Exception as e:
+            print(f"Error building spatial index for map {item_map_id}: {e}")
+            continue
+        if not index:
+            continue
+        for feature_idx in range(index_size(index)):
+            for name in index_record(index, feature_idx).get("names") or []:
+                normalized = normalize_search_text(name)
+                if normalized:
+                    entries.append((normalized, name, index, feature_idx))
+
+    entries.sort(key=lambda entry: entry[0])
+    trigrams: Dict[str, List[int]] = {}
+    for entry_idx, entry in enumerate(entries):
+        for gram in _trigrams(entry[0]):
+            trigrams.setdefault(gram, []).append(entry_idx)
+    return {
+        "revision": revision,
+        "entries": entries,
+        "keys": [entry[0] for entry in entries],
+        "trigrams": trigrams,
+    }
+
+
+def get_search_index() -> Dict:
+    """دریافت ایندکس جستجو - با تغییر تاریخچه یا هر یک از نقشه‌ها دوباره ساخته می‌شود"""
+    global _SEARCH_INDEX
+    revision = get_lookup_revision()
+    search_index = _SEARCH_INDEX
+    if search_index.get("revision") == revision:
+        return search_index
+    search_index = build_search_index(revision)
+    _SEARCH_INDEX = search_index
+    return search_index
+
+
+def search_neighborhoods(query: str, limit: int = 10, map_id: Optional[str] = None) -> List[Dict]:
+    """جستجوی محله بر اساس نام: تطابق کامل، پیشوندی، پیشوند یکی از کلمات و در نهایت تقریبی (trigram)"""
+    normalized = normalize_search_text(query)
+    if not normalized:
+        return []
+    search_index = get_search_index()
+    entries, keys = search_index["entries"], search_index["keys"]
+    scores: Dict[int, float] = {}
+
+    # تطابق پیشوندی روی لیست مرتب (نام‌های کوتاه‌تر امتیاز بیشتری می‌گیرند)
+    start = bisect.bisect_left(keys, normalized)
+    end = bisect.bisect_left(keys, normalized + "\uffff")
+    for entry_idx in range(start, end):
+        key = keys[entry_idx]
+        scores[entry_idx] = 1.0 if key == normalized else 0.85 + 0.1 * len(normalized) / len(key)
+
+    # امتیاز تقریبی (ضریب Dice روی سه‌حرفی‌ها) و پیشوند کلمات میانی نام
+    query_grams = _trigrams(normalized)
+    shared: Dict[int, int] = {}
+    for gram in query_grams:
+        for entry_idx in search_index["trigrams"].get(gram, ()):
+            shared[entry_idx] = shared.get(entry_idx, 0) + 1
+    for entry_idx, count in shared.items():
+        if entry_idx in scores:
+            continue
+        key = keys[entry_idx]
+        if any(word.startswith(normalized) for word in key.split()):
+            score = 0.8
+        else:
+            score = 0.75 * 2 * count / (len(query_grams) + len(_trigrams(key)))
+        if score >= NEIGHBORHOOD_SEARCH_MIN_SCORE:
+            scores[entry_idx] = score
+
+    history = load_history()
+    results = []
+    seen = set()
+    for entry_idx in sorted(scores, key=lambda i: (-scores[i], keys[i])):
+        _, name, index, feature_idx = entries[entry_idx]
+        if map_id and index["map_id"] != map_id:
+            continue
+        if (index["map_id"], feature_idx) in seen:
+            continue
+        seen.add((index["map_id"], feature_idx))
+        result = _neighborhood_payload(index, feature_idx, history)
+        result.pop("success", None)
+        lon, lat = index["centroids"][feature_idx]
+        result.update({
+            "matched_name": name,
+            "feature_id": index_record(index, feature_idx)["feature_id"],
+            "centroid": {"lat": float(lat), "lon": float(lon)},
+            "bbox": [float(value) for value in index["bboxes"][feature_idx]],
+            "score": round(scores[entry_idx], 3),
+        })
+        results.append(result)
+        if len(results) >= limit:
+            break
+    return results
+
+
+# ========== Offline Bundle ==========
+
+# بسته باینری فشرده هر نقشه برای geocoding روی دستگاه (اپ موبایل)
+# نسخه بسته همان hash نسخه ایندکس است؛ اپ فقط با تغییر ETag بسته را دوباره دانلود می‌کند.
+#
+# ساختار (little-endian):
+#   header: magic "RGNB" | uint16 نسخه قالب | uint16 رزرو | uint32 تعداد feature | uint32 تعداد حلقه
+#           | uint32 تعداد نقطه | float64 × 4: مبدأ lon/lat و گام کوانتیزه lon/lat
+#           | uint16 nx | uint16 ny | float64 × 4: مبدأ lon/lat و اندازه خانه شبکه
+#   uint32[feature_count + 1]  offset حلقه‌های هر feature
+#   uint32[ring_count + 1]     offset نقاط هر حلقه
+#   uint16[point_count × 2]    مختصات کوانتیزه (lon = مبدأ + q × گام)
+#   int32[ny × nx]             برچسب شبکه (اندیس feature، ‎-1‎ خالی، ‎-2‎ مرزی: تست زوج و فرد روی حلقه‌ها)
+#   uint32 طول + JSON (UTF-8)  جدول [feature_id, نام, slug توت‌اپ, منطقه, شهر] برای هر feature
+BUNDLE_MAGIC = b"RGNB"
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_SIMPLIFY_DEGREES = float(os.environ.get("BUNDLE_SIMPLIFY_DEGREES", "0.00001"))
+BUNDLE_FILENAME = "bundle.bin"
+
+
+def _tootapp_slug(tootapp_url: Optional[str]) -> str:
+    """slug گروه توت‌اپ از روی لینک کامل (رشته خالی برای لینک پیش‌فرض)"""
+    base_url = TOOTAPP_BASE_URL.rstrip("/")
+    if not tootapp_url or tootapp_url.rstrip("/") == base_url:
+        return ""
+    if tootapp_url.startswith(base_url):
+        return tootapp_url[len(base_url):].strip("/")
+    return tootapp_url
+
+
+def build_map_bundle(index: Dict) -> bytes:
+    """ساخت بسته باینری یک نقشه از روی ایندکس آن (حلقه‌های ساده شده و کوانتیزه، شبکه و جدول نام‌ها)"""
+    count = index_size(index)
+    geometries = index_geometries(index, range(count))
+    if count:
+        geometries = shapely.simplify(geometries, BUNDLE_SIMPLIFY_DEGREES, preserve_topology=True)
+        minx, miny, maxx, maxy = shapely.total_bounds(geometries)
+    else:
+        minx = miny = maxx = maxy = 0.0
+    scale_x = max(maxx - minx, 1e-9) / 65535
+    scale_y = max(maxy - miny, 1e-9) / 65535
+
+    feature_rings = [0]
+    ring_offsets = [0]
+    points = []
+    for geom in geometries:
+        for polygon in shapely.get_parts(geom):
+            for ring in [polygon.exterior, *polygon.interiors]:
+                coords = shapely.get_coordinates(ring)
+                quantized = np.column_stack([
+                    np.rint((coords[:, 0] - minx) / scale_x),
+                    np.rint((coords[:, 1] - miny) / scale_y),
+                ]).astype(np.uint16)
+                # حذف نقاط تکراری پشت سر هم که بعد از کوانتیزه شدن به وجود می‌آیند
+                keep = np.r_[True, np.any(quantized[1:] != quantized[:-1], axis=1)]
+                points.append(quantized[keep])
+                ring_offsets.append(ring_offsets[-1] + int(keep.sum()))
+        feature_rings.append(len(ring_offsets) - 1)
+    points = np.concatenate(points) if points else np.zeros((0, 2), dtype=np.uint16)
+
+    grid = index.get("grid")
+    if grid is not None:
+        labels = np.asarray(grid["labels"], dtype=np.int32)
+        ny, nx = grid["shape"]
+        grid_header = (nx, ny, *grid["origin"], *grid["cell_size"])
+    else:
+        labels = np.zeros(0, dtype=np.int32)
+        grid_header = (0, 0, 0.0, 0.0, 0.0, 0.0)
+
+    table = []
+    for feature_idx in range(count):
+        record = index_record(index, feature_idx)
+        table.append([
+            record["feature_id"], record["region"], _tootapp_slug(record["tootapp_url"]),
+            record["district"], record["city"],
+        ])
+    table_bytes = json.dumps(table, ensure_ascii=False).encode("utf-8")
+
+    header = struct.pack(
+        "<4sHHIII4dHH4d",
+        BUNDLE_MAGIC, BUNDLE_FORMAT_VERSION, 0, count, len(ring_offsets) - 1, len(points),
+        minx, miny, scale_x, scale_y, *grid_header,
+    )
+    return b"".join([
+        header,
+        np.asarray(feature_rings, dtype="<u4").tobytes(),
+        np.asarray(ring_offsets, dtype="<u4").tobytes(),
+        points.astype("<u2").tobytes(),
+        labels.astype("<i4").tobytes(),
+        struct.pack("<I", len(table_bytes)),
+        table_bytes,
+    ])
+
+
+def get_map_bundle(map_id: str) -> Optional[Tuple[Path, str]]:
+    """مسیر فایل بسته و نسخه آن؛ بسته یک بار برای هر نسخه ایندکس ساخته و کنار آرایه‌های ایندکس ذخیره می‌شود"""
+    index = get_map_index(map_id)
+    if not index:
+        return None
+    bundle_file = index["path"] / BUNDLE_FILENAME
+    version = f"{index['path'].name.rsplit('.', 1)[1]}-{BUNDLE_FORMAT_VERSION}"
+    if not bundle_file.exists():
+        temp_file = bundle_file.with_name(f".{BUNDLE_FILENAME}.{os.getpid()}.{threading.get_ident()}")
+        with open(temp_file, "wb") as f:
+            f.write(build_map_bundle(index))
+        os.replace(temp_file, bundle_file)
+    return bundle_file, version
+
+
+# ========== Derived Layers ==========
+
+# لایه‌های مشتق: polygon های محلات بر اساس منطقه / شهر ادغام (dissolve) می‌شوند و مثل یک نقشه معمولی
+# با شناسه "<map_id>__district" یا "<map_id>__city" ذخیره، نمایش داده و geocode می‌شوند
+DERIVED_LAYER_SEPARATOR = "__"
+DERIVED_LAYER_LEVELS = ("district", "city")
+_DERIVED_LAYER_LOCK = threading.Lock()
+
+
+def get_derived_map_id(map_id: str, level: str) -> str:
+    """شناسه نقشه لایه مشتق یک نقشه در سطح مشخص"""
+    return f"{map_id}{DERIVED_LAYER_SEPARATOR}{level}"
+
+
+def split_derived_map_id(map_id: str) -> Optional[Tuple[str, str]]:
+    """(شناسه نقشه اصلی، سطح) برای شناسه یک لایه مشتق، یا None برای نقشه‌های معمولی"""
+    parent_map_id, separator, level = map_id.rpartition(DERIVED_LAYER_SEPARATOR)
+    if separator and parent_map_id and level in DERIVED_LAYER_LEVELS:
+        return parent_map_id, level
+    return None
+
+
+def _derived_layer_is_stale(map_id: str, level: str) -> bool:
+    """لایه مشتق وجود ندارد یا نقشه اصلی / ویرایش‌های آن بعد از ساخت لایه تغییر کرده‌اند"""
+    derived_signature = _file_signature(get_map_file(get_derived_map_id(map_id, level)))
+    if derived_signature is None:
+        return True
+    parent_signatures = (_file_signature(get_map_file(map_id)), metadata_signature("edits", map_id))
+    return any(
+        signature is not None and signature[0] > derived_signature[0]
+        for signature in parent_signatures
+    )
+
+
+def build_derived_layers(map_id: str) -> None:
+    """ساخت لایه‌های منطقه و شهر یک نقشه با unary_union روی polygon های هر گروه
+    گروه‌بندی بر اساس منطقه/شهر نهایی هر محله (بعد از اعمال ویرایش‌ها) انجام می‌شود.
+    """
+    index = get_map_index(map_id)
+    if not index:
+        return
+    geometries = index_geometries(index, range(index_size(index)))
+    records = [index_record(index, i) for i in range(index_size(index))]
+
+    for level in DERIVED_LAYER_LEVELS:
+        groups: Dict[Tuple, List[int]] = {}
+        for i, record in enumerate(records):
+            if level == "district":
+                if not record.get("district"):
+                    continue
+                key = (record.get("city") or "", record["district"])
+            else:
+                if not record.get("city"):
+                    continue
+                key = (record["city"],)
+            groups.setdefault(key, []).append(i)
+
+        features = []
+        for key, members in groups.items():
+            group_geometries = geometries[members]
+            try:
+                merged = shapely.union_all(group_geometries)
+            except shapely.errors.GEOSException:
+                merged = shapely.union_all(shapely.make_valid(group_geometries))
+            city = key[0] or None
+            name = key[-1]
+            properties = {
+                "feature_id": f"{level}:{'|'.join(key)}",
+                "name": name,
+                "city": city,
+                "feature_count": len(members),
+            }
+            if level == "district":
+                properties["district"] = name
+            features.append({
+                "type": "Feature",
+                "properties": properties,
+                "geometry": mapping(merged),
+            })
+
+        derived_map_id = get_derived_map_id(map_id, level)
+        geojson = {"type": "FeatureCollection", "features": features}
+        assign_feature_metrics(geojson)
+        data = {
+            "geojson": geojson,
+            "summary": {"feature_count": len(features), "crs": "EPSG:4326", "columns": ["name", level, "feature_count"]},
+            "original_filename": f"{map_id} ({level})",
+            "map_id": derived_map_id,
+            "parent_map_id": map_id,
+            "level": level,
+            "upload_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        write_map_store(derived_map_id, data)
+        invalidate_map_index(derived_map_id)
+
+
+def refresh_derived_layers(map_id: str) -> None:
+    """ساخت دوباره لایه‌های مشتق فقط اگر نسبت به نقشه اصلی قدیمی شده باشند"""
+    if not map_exists(map_id):
+        return
+    if any(_derived_layer_is_stale(map_id, level) for level in DERIVED_LAYER_LEVELS):
+        with _DERIVED_LAYER_LOCK:
+            if any(_derived_layer_is_stale(map_id, level) for level in DERIVED_LAYER_LEVELS):
+                build_derived_layers(map_id)
+
+
+def get_derived_layer(map_id: str, level: str) -> Optional[Dict]:
+    """داده‌های لایه مشتق یک نقشه (در صورت نیاز ابتدا ساخته می‌شود)"""
+    if level not in DERIVED_LAYER_LEVELS:
+        return None
+    refresh_derived_layers(map_id)
+    return load_map_data(get_derived_map_id(map_id, level))
+
+
+def delete_derived_layers(map_id: str) -> None:
+    """حذف لایه‌های مشتق یک نقشه"""
+    for level in DERIVED_LAYER_LEVELS:
+        derived_map_id = get_derived_map_id(map_id, level)
+        delete_map_files(derived_map_id)
+        invalidate_map_index(derived_map_id)
+
+
+# ========== Serving Snapshot ==========
+
+# GeoJSON نهایی صفحه نقشه (با شناسه‌ها، ویرایش‌ها و لینک‌های توت‌اپ) یک بار serialize و روی دیسک ذخیره می‌شود.
+# نام فایل شامل hash نسخه نقشه، لینک‌ها و ویرایش‌هاست؛ با تغییر هر کدام snapshot جدید ساخته و قبلی حذف می‌شود.
+SNAPSHOT_DIR = UPLOAD_ROOT / "snapshots"
+SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+SNAPSHOT_FORMAT_VERSION = 1
+# تعداد دفعات ساخت دوباره snapshot ای که worker دیگری قبل از خواندن حذف کرده است
+SNAPSHOT_READ_ATTEMPTS = 3
+
+
+def build_map_snapshot(map_id: str, source_map_id: str) -> Optional[bytes]:
+    """GeoJSON آماده ارسال یک نقشه (یا لایه مشتق آن) با ویرایش‌ها و لینک‌های نقشه map_id"""
+    map_data = load_map_data(source_map_id)
+    geojson = map_data.get("geojson") if map_data else None
+    if not geojson:
+        return None
+    for feature in geojson.get("features", []):
+        props = feature.get("properties", {})
+        # شناسه در زمان آپلود (یا اولین بارگذاری نقشه‌های قدیمی) در properties ذخیره شده است
+        feature_id = props.get("feature_id")
+        original_name = props.get('NAME_NEW') or props.get('Name') or props.get('name') or 'نامشخص'
+        feature["properties"] = apply_neighborhood_edits(props, map_id, feature_id, original_name)
+    _attach_tootapp_links(geojson, map_id)
+    return json.dumps(geojson).encode("utf-8")
+
+
+def get_map_snapshot(map_id: str, level: Optional[str] = None) -> Optional[Tuple[Path, str]]:
+    """(مسیر فایل snapshot، نسخه آن) برای یک نقشه یا لایه منطقه/شهر آن؛ None اگر نقشه وجود ندارد"""
+    if level:
+        if level not in DERIVED_LAYER_LEVELS:
+            return None
+        refresh_derived_layers(map_id)
+        source_map_id = get_derived_map_id(map_id, level)
+    else:
+        source_map_id = map_id
+    source_signature = _file_signature(get_map_file(source_map_id))
+    if source_signature is None:
+        return None
+
+    revision = [SNAPSHOT_FORMAT_VERSION, get_map_revision(map_id), source_signature]
+    version = hashlib.md5(json.dumps(revision, default=str).encode("utf-8")).hexdigest()[:16]
+    snapshot_file = SNAPSHOT_DIR / f"{source_map_id}.{version}.geojson"
+    if snapshot_file.exists():
+        return snapshot_file, version
+
+    content = build_map_snapshot(map_id, source_map_id)
+    if content is None:
+        return None
+    temp_file = snapshot_file.with_name(f".{snapshot_file.name}.{os.getpid()}.{threading.get_ident()}")
+    with open(temp_file, "wb") as f:
+        f.write(content)
+    os.replace(temp_file, snapshot_file)
+    # اگر نقشه، لینک‌ها یا ویرایش‌ها در حین ساخت عوض شده باشند این snapshot قدیمی است و نباید نسخه جدیدتر را حذف کند
+    if get_map_revision(map_id) == revision[1] and _file_signature(get_map_file(source_map_id)) == source_signature:
+        for old_file in SNAPSHOT_DIR.glob(f"{source_map_id}.*.geojson"):
+            if old_file != snapshot_file:
+                old_file.unlink(missing_ok=True)
+                invalidate_file_cache(old_file)
+    return snapshot_file, version
+
+
+def _read_text_file(path: Path) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def load_map_snapshot(map_id: str, level: Optional[str] = None) -> Optional[str]:
+    """متن GeoJSON snapshot (از کش فایل‌ها) برای قرار دادن در صفحه نقشه"""
+    for _ in range(SNAPSHOT_READ_ATTEMPTS):
+        snapshot = get_map_snapshot(map_id, level)
+        if snapshot is None:
+            return None
+        # worker دیگری ممکن است snapshot را بین ساخت و خواندن (با نسخه جدیدتر) حذف کرده باشد؛ دوباره ساخته می‌شود
+        try:
+            content = cached_file_read(snapshot[0], _read_text_file, clone=None)
+        except FileNotFoundError:
+            continue
+        if content is not None:
+            return content
+    return None
+
+
+def open_map_snapshot(map_id: str, level: Optional[str] = None) -> Optional[Tuple[BinaryIO, str]]:
+    """فایل باز snapshot و نسخه آن (مثل load_map_snapshot، اگر فایل قبل از باز شدن حذف شود دوباره ساخته می‌شود)"""
+    for _ in range(SNAPSHOT_READ_ATTEMPTS):
+        snapshot = get_map_snapshot(map_id, level)
+        if snapshot is None:
+            return None
+        try:
+            return open(snapshot[0], "rb"), snapshot[1]
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def delete_map_snapshots(map_id: str) -> None:
+    """حذف snapshot های یک نقشه و لایه‌های مشتق آن"""
+    for pattern in (f"{map_id}.*.geojson", f"{map_id}{DERIVED_LAYER_SEPARATOR}*.geojson"):
+        for snapshot_file in SNAPSHOT_DIR.glob(pattern):
+            snapshot_file.unlink(missing_ok=True)
+            invalidate_file_cache(snapshot_file)
+
+
+# ========== Geocoding Jobs ==========
+
+# پردازش فایل‌های بزرگ نقاط (CSV یا NDJSON) در پس‌زمینه به صورت تکه‌تکه
+# وضعیت هر job روی دیسک است تا هر worker بتواند آن را گزارش دهد
+GEOCODE_JOB_FORMATS = {"csv": "csv", "ndjson": "ndjson", "jsonl": "ndjson"}
+GEOCODE_JOB_CHUNK_ROWS = 20000
+GEOCODE_JOB_RESULT_FIELDS = ["region", "district", "city", "tootapp_url"]
+# job در حال اجرایی که worker آن دیگر زنده نیست یا این مدت (ثانیه) وضعیتش را به‌روز نکرده، شکست خورده ثبت می‌شود
+GEOCODE_JOB_STALE_SECONDS = int(os.environ.get("GEOCODE_JOB_STALE_SECONDS", "600"))
+
+
+def get_geocode_job_dir(job_id: str) -> Path:
+    """پوشه فایل‌های یک job (ورودی، خروجی و وضعیت)"""
+    return GEOCODE_JOBS_DIR / secure_filename(job_id)
+
+
+def _geocode_job_is_stale(job: Dict) -> bool:
+    """job صف‌شده یا در حال اجرایی که thread آن با restart یا timeout شدن worker از بین رفته است"""
+    if job.get("status") not in ("queued", "running"):
+        return False
+    if time.time() - float(job.get("heartbeat") or 0) > GEOCODE_JOB_STALE_SECONDS:
+        return True
+    pid = job.get("pid")
+    if not pid or job.get("hostname") != socket.gethostname():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+def load_geocode_job(job_id: str) -> Optional[Dict]:
+    """بارگذاری وضعیت یک job (job های رها شده همین‌جا شکست خورده ثبت می‌شوند)"""
+    status_file = get_geocode_job_dir(job_id) / "status.json"
+    if not status_file.exists():
+        return None
+    try:
+        with open(status_file, "r", encoding="utf-8") as f:
+            job = json.load(f)
+    except (json.JSONDecodeError, IOError):
+        return None
+    if _geocode_job_is_stale(job):
+        job["status"] = "failed"
+        job["error"] = "پردازش این job با توقف worker متوقف شد"
+        save_geocode_job(job)
+        (status_file.parent / f"output.{job['format']}.part").unlink(missing_ok=True)
+    return job
+
+
+def save_geocode_job(job: Dict) -> None:
+    """ذخیره وضعیت یک job (با جایگزینی اتمیک تا خواننده‌ها فایل نیمه‌کاره نبینند)
+    pid و heartbeat پردازش‌کننده همراه وضعیت ذخیره می‌شوند تا job رها شده قابل تشخیص باشد.
+    """
+    job["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if job.get("status") in ("queued", "running"):
+        job.update({"pid": os.getpid(), "hostname": socket.gethostname(), "heartbeat": time.time()})
+    status_file = get_geocode_job_dir(job["job_id"]) / "status.json"
+    temp_file = status_file.with_suffix(".tmp")
+    with open(temp_file, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False, indent=2)
+    os.replace(temp_file, status_file)
+
+
+def create_geocode_job(file_obj: FileStorage, map_id: Optional[str] = None) -> Dict:
+    """ذخیره فایل نقاط آپلود شده و شروع پردازش آن در یک thread پس‌زمینه"""
+    filename = file_obj.filename or ""
+    extension = filename.rsplit(".", 1)[1].lower() if "." in filename else ""
+    if extension not in GEOCODE_JOB_FORMATS:
+        raise ValueError("فقط فایل‌های CSV یا NDJSON پذیرفته می‌شوند.")
+    job_format = GEOCODE_JOB_FORMATS[extension]
+
+    job_id = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    job_dir = get_geocode_job_dir(job_id)
+    job_dir.mkdir(parents=True, exist_ok=True)
+    input_file = job_dir / f"input.{job_format}"
+    file_obj.save(input_file)
+
+    job = {
+        "job_id": job_id,
+        "status": "queued",
+        "format": job_format,
+        "map_id": map_id or None,
+        "original_filename": filename,
+        "bytes_total": input_file.stat().st_size,
+        "bytes_processed": 0,
+        "rows_processed": 0,
+        "rows_matched": 0,
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "error": None,
+    }
+    save_geocode_job(job)
+    threading.Thread(target=run_geocode_job, args=(job_id,), daemon=True).start()
+    return job
+
+
+def _geocode_rows(rows: List[Dict], lats: List, lons: List, map_id: Optional[str]) -> int:
+    """افزودن region/district/city/tootapp_url به یک تکه از ردیف‌ها - خروجی تعداد ردیف‌های دارای محله"""
+    lat_array = np.full(len(rows), np.nan)
+    lon_array = np.full(len(rows), np.nan)
+    for i, (lat, lon) in enumerate(zip(lats, lons)):
+        try:
+            lat_array[i] = float(lat)
+            lon_array[i] = float(lon)
+        except (ValueError, TypeError):
+            lat_array[i] = lon_array[i] = np.nan
+
+    matched = 0
+    for row, payload in zip(rows, lookup_neighborhoods_bulk(lat_array, lon_array, map_id)):
+        for field in GEOCODE_JOB_RESULT_FIELDS:
+            row[field] = payload.get(field) if payload else None
+        matched += payload is not None
+    return matched
+
+
+def run_geocode_job(job_id: str) -> None:
+    """پردازش فایل ورودی یک job به صورت تکه‌ای و نوشتن فایل خروجی غنی‌شده"""
+    job = load_geocode_job(job_id)
+    if not job:
+        return
+    job_dir = get_geocode_job_dir(job_id)
+    input_file = job_dir / f"input.{job['format']}"
+    output_file = job_dir / f"output.{job['format']}"
+    partial_file = job_dir / f"output.{job['format']}.part"
+    job["status"] = "running"
+    save_geocode_job(job)
+
+    try:
+        with open(input_file, "rb") as raw, open(partial_file, "w", encoding="utf-8", newline="") as out:
+            text = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+
+            def report(rows_count: int, matched_count: int) -> None:
+                job["rows_processed"] += rows_count
+                job["rows_matched"] += matched_count
+                job["bytes_processed"] = raw.tell()
+                save_geocode_job(job)
+
+            if job["format"] == "csv":
+                reader = csv.DictReader(text)
+                fieldnames = list(reader.fieldnames or [])
+                lat_field = next((f for f in fieldnames if f.strip() in LAT_FIELDS), None)
+                lon_field = next((f for f in fieldnames if f.strip() in LON_FIELDS), None)
+                if not lat_field or not lon_field:
+                    raise ValueError("ستون‌های lat و lon در فایل CSV پیدا نشد")
+                # ستون‌های اضافه ردیف‌های بلندتر از header (کلید None در DictReader) نوشته نمی‌شوند
+                writer = csv.DictWriter(
+                    out, fieldnames=fieldnames + [f for f in GEOCODE_JOB_RESULT_FIELDS if f not in fieldnames],
+                    extrasaction="ignore",
+                )
+                writer.writeheader()
+                while True:
+                    rows = [row for _, row in zip(range(GEOCODE_JOB_CHUNK_ROWS), reader)]
+                    if not rows:
+                        break
+                    matched = _geocode_rows(
+                        rows, [row.get(lat_field) for row in rows], [row.get(lon_field) for row in rows], job["map_id"]
+                    )
+                    writer.writerows(rows)
+                    report(len(rows), matched)
+            else:
+                while True:
+                    lines = [line for _, line in zip(range(GEOCODE_JOB_CHUNK_ROWS), text)]
+                    if not lines:
+                        break
+                    rows = []
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        try:
+                            row = json.loads(line)
+                        except json.JSONDecodeError:
+                            row = None
+                        if not isinstance(row, dict):
+                            row = {"raw": line.rstrip("\n"), "error": "JSON نامعتبر"}
+                        rows.append(row)
+                    matched = _geocode_rows(
+                        rows,
+                        [_first_nonempty(row, LAT_FIELDS) for row in rows],
+                        [_first_nonempty(row, LON_FIELDS) for row in rows],
+                        job["map_id"],
+                    )
+                    for row in rows:
+                        out.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+                    report(len(rows), matched)
+
+        os.replace(partial_file, output_file)
+        job["status"] = "done"
+        job["bytes_processed"] = job["bytes_total"]
+        save_geocode_job(job)
+    except Exception as e:
+        print(f"Error in geocode job {job_id}: {e}")
+        job["status"] = "failed"
+        job["error"] = str(e)
+        save_geocode_job(job)
+        partial_file.unlink(missing_ok=True)
+
+
+# ========== Templates ==========
+
+LOGIN_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="fa">
+<head>
+  <meta charset="utf-8" />
+  <title>ورود ادمین - نقشه محلات</title>
+  <meta name="viewport" content="width=device-width, initial-scale=1" />
+  <style>
+    body { font-family: sans-serif; background: #f4f6f8; margin: 0; padding: 0; direction: rtl; }
+    .container { max-width: 400px; margin: 5rem auto; padding: 2rem; background: #fff; border-radius: 12px; box-shadow: 0 15px 35px rgba(0,0,0,0.1); }
+    h1 { text-align: center; color: #1f4e5f; margin-bottom: 1.5rem; }
+    input[type="password"] { width: 100%; padding: 0.75rem; border: 1px solid #dde3ea; border-radius: 8px; margin-bottom: 1rem; box-sizing: border-box; }
+    button { width: 100%; padding: 0.75rem; border: none; border-radius: 8px; font-size: 1rem; cursor: pointer; background: #2a9d8f; color: #fff; }
+    .error { color: #d62828; margin-top: 0.75rem; text-align: center; }
+    .back-link { text-align: center; margin-top: 1rem; }
+    .back-link a { color: #2a9d8f; text-decoration: none; }
+  </style>
+</head>
+<body>
+  <div class="container">
+    <h1>ورود به پنل مدیریت</h1>
+    <form method="post">
+      <input type="text" name="username" placeholder="نام کاربری" required autofocus />
+      <input type="password" name="password" placeholder="رمز عبور" required />
+      <button type="submit">ورود</button>
+      {% if error %}
+        <div class="error">{{ error }}</div>
+      {% endif %}
+    </form>
+    <div class="back-link">
+      <a href="/">بازگشت به صفحه اصلی</a>
+    </div>
+  </div>
+</body>
+</html>
+"""
+
+ADMIN_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="fa">
+<head>
+  <meta charset="utf-8" />
+  <title>پنل ادمین - آپلود نقشه</title>
+  <meta name="viewport" content="width=device-width, initial-scale=1" />
+  <style>
+    body { font-family: sans-serif; background: #f4f6f8; margin: 0; padding: 0; direction: rtl; }
+    header { padding: 1.5rem; text-align: center; background: #1f4e5f; color: #fff; }
+    main { max-width: 1100px; margin: 1.5rem auto; padding: 0 1rem 2rem; }
+    .card { background: #fff; border-radius: 12px; padding: 1.5rem; margin-bottom: 1.5rem; box-shadow: 0 15px 35px rgba(0,0,0,0.07); }
+    input[type="file"], input[type="text"] { width: 100%; padding: 0.75rem; border: 1px solid #dde3ea; border-radius: 8px; margin-bottom: 1rem; box-sizing: border-box; }
+    button { padding: 0.75rem 1.5rem; border: none; border-radius: 8px; font-size: 1rem; cursor: pointer; background: #2a9d8f; color: #fff; margin-left: 0.5rem; }
+    button.logout { background: #d62828; }
+    button.delete { background: #d62828; padding: 0.5rem 1rem; font-size: 0.9rem; }
+    .error { color: #d62828; margin-top: 0.75rem; }
+    .success { color: #2a9d8f; margin-top: 0.75rem; }
+    .back-link { margin-top: 1rem; }
+    .back-link a { color: #2a9d8f; text-decoration: none; }
+    .history-list { list-style: none; padding: 0; margin-top: 1rem; }
+    .history-item { padding: 1rem; margin-bottom: 0.5rem; background: #f8f9fa; border-radius: 8px; display: flex; justify-content: space-between; align-items: center; }
+    .history-item-info { flex: 1; }
+    .history-item-actions { margin-right: 1rem; }
+    h2 { margin-top: 0; }
+  </style>
+</head>
+<body>
+  <header>
+    <h1>پنل مدیریت - آپلود نقشه</h1>
+    <p>کاربر: {{ current_username }} ({{ current_role_name }})</p>
+  </header>
+  <main>
+    <div class="card">
+      <div style="text-align: left; margin-bottom: 1rem;">
+        <a href="/" style="color: #2a9d8f; text-decoration: none;">← بازگشت به صفحه اصلی</a>
+        {% if has_manage_users %}
+        <a href="/admin/users" style="text-decoration: none; margin-right: 1rem;">
+          <button type="button" style="background: #6f42c1;">مدیریت کاربران</button>
+        </a>
+        {% endif %}
+        <form method="post" action="/admin/logout" style="display: inline; margin-right: 1rem;">
+          <button type="submit" class="logout">خروج</button>
+        </form>
+      </div>
+      <form method="post" enctype="multipart/form-data">
+        <label>نام نقشه (اختیاری):</label>
+        <input type="text" name="map_name" placeholder="مثلاً: محلات تهران" />
+        <label>انتخاب فایل (Zip حاوی Shapefile یا GeoJSON):</label>
+        <input type="file" name="shapefile" accept=".zip,.geojson,.json" required />
+        <button type="submit">آپلود و ذخیره</button>
+        {% if error %}
+          <div class="error">{{ error }}</div>
+        {% endif %}
+        {% if success %}
+          <div class="success">{{ success }}</div>
+        {% endif %}
+      </form>
+    </div>
+    <div class="card">
+      <h2>آپلود عوارض محله</h2>
+      <p style="color: #6c757d; margin-bottom: 1rem;">برای آپلود عوارض محله (مثلاً پارک‌ها، مدارس، مراکز خرید و...) ابتدا نقشه را انتخاب کنید:</p>
+      <form id="uploadFeatureForm" enctype="multipart/form-data" onsubmit="uploadFeature(event)">
+        <label>انتخاب نقشه:</label>
+        <select name="map_id" id="featureMapId" required style="width: 100%; padding: 0.75rem; border: 1px solid #dde3ea; border-radius: 8px; margin-bottom: 1rem; box-sizing: border-box;">
+          <option value="">-- انتخاب نقشه --</option>
+          {% for item in history %}
+          <option value="{{ item.map_id }}">{{ item.map_name or item.original_filename }}</option>
+          {% endfor %}
+        </select>
+        <label>نام عارضه (اختیاری):</label>
+        <input type="text" name="feature_name" placeholder="مثلاً: پارک‌های تهران" />
+        <label>انتخاب فایل (Zip حاوی Shapefile یا GeoJSON):</label>
+        <input type="file" name="shapefile" accept=".zip,.geojson,.json" required />
+        <button type="submit">آپلود عوارض</button>
+      </form>
+      <div id="featureUploadStatus" style="margin-top: 1rem;"></div>
+    </div>
+    <div class="card">
+      <h2>تعیین محله برای فایل نقاط</h2>
+      <p style="color: #6c757d; margin-bottom: 1rem;">فایل CSV (با ستون‌های lat و lon) یا NDJSON را آپلود کنید تا در پس‌زمینه محله، منطقه، شهر و لینک توت‌اپ هر ردیف اضافه شود:</p>
+      <form id="geocodeJobForm" enctype="multipart/form-data" onsubmit="startGeocodeJob(event)">
+        <label>نقشه (اختیاری):</label>
+        <select name="map_id" style="width: 100%; padding: 0.75rem; border: 1px solid #dde3ea; border-radius: 8px; margin-bottom: 1rem; box-sizing: border-box;">
+          <option value="">-- همه نقشه‌ها --</option>
+          {% for item in history %}
+          <option value="{{ item.map_id }}">{{ item.map_name or item.original_filename }}</option>
+          {% endfor %}
+        </select>
+        <label>انتخاب فایل (CSV یا NDJSON):</label>
+        <input type="file" name="points" accept=".csv,.ndjson,.jsonl" required />
+        <button type="submit">شروع پردازش</button>
+      </form>
+      <div id="geocodeJobStatus" style="margin-top: 1rem;"></div>
+    </div>
+    <div class="card">
+      <h2>تاریخچه نقشه‌ها</h2>
+      {% if history %}
+      <ul class="history-list">
+        {% for item in history %}
+        <li class="history-item">
+          <div class="history-item-info">
+            <strong>{{ item.map_name or item.original_filename }}</strong><br/>
+            <small>تاریخ: {{ item.upload_date }} | تعداد عوارض: {{ item.feature_count }} | شناسه: {{ item.map_id }}</small>
+          </div>
+          <div class="history-item-actions">
+            <a href="/admin/links/{{ item.map_id }}" style="text-decoration: none;">
+              <button type="button" style="background: #2a9d8f; padding: 0.5rem 1rem; font-size: 0.9rem; margin-left: 0.5rem;">مدیریت لینک‌های محلات</button>
+            </a>
+            <a href="/admin/neighborhoods/edit/{{ item.map_id }}" style="text-decoration: none;">
+              <button type="button" style="background: #17a2b8; padding: 0.5rem 1rem; font-size: 0.9rem; margin-left: 0.5rem;">ویرایش محلات</button>
+            </a>
+            <a href="/admin/features/links/{{ item.map_id }}" style="text-decoration: none;">
+              <button type="button" style="background: #ffc107; color: #000; padding: 0.5rem 1rem; font-size: 0.9rem; margin-left: 0.5rem;">مدیریت لینک‌های عوارض</button>
+            </a>
+            <form method="post" action="/admin/delete/{{ item.map_id }}" style="display: inline;" onsubmit="return confirm('آیا مطمئن هستید که می‌خواهید این نقشه را حذف کنید؟');">
+              <button type="submit" class="delete">حذف</button>
+            </form>
           </div>
         </li>
         {% endfor %}
@@ -1126,6 +4297,48 @@ ADMIN_TEMPLATE = """
         statusDiv.innerHTML = `<div class="error">خطا در آپلود: ${error.message}</div>`;
       }
     }
+    
+    async function startGeocodeJob(event) {
+      event.preventDefault();
+      const form = document.getElementById('geocodeJobForm');
+      const statusDiv = document.getElementById('geocodeJobStatus');
+      
+      statusDiv.innerHTML = '<p style="color: #2a9d8f;">در حال آپلود...</p>';
+      
+      try {
+        const response = await fetch('/admin/geocode-jobs', {
+          method: 'POST',
+          body: new FormData(form)
+        });
+        const data = await response.json();
+        if (!data.success) {
+          statusDiv.innerHTML = `<div class="error">${data.error}</div>`;
+          return;
+        }
+        form.reset();
+        pollGeocodeJob(data.status_url);
+      } catch (error) {
+        statusDiv.innerHTML = `<div class="error">خطا در آپلود: ${error.message}</div>`;
+      }
+    }
+    
+    async function pollGeocodeJob(statusUrl) {
+      const statusDiv = document.getElementById('geocodeJobStatus');
+      try {
+        const data = await (await fetch(statusUrl)).json();
+        const job = data.job;
+        if (job.status === 'done') {
+          statusDiv.innerHTML = `<div class="success">پردازش تمام شد: ${job.rows_processed} ردیف (${job.rows_matched} دارای محله) - <a href="${data.download_url}">دانلود فایل خروجی</a></div>`;
+        } else if (job.status === 'failed') {
+          statusDiv.innerHTML = `<div class="error">خطا در پردازش: ${job.error}</div>`;
+        } else {
+          statusDiv.innerHTML = `<p style="color: #2a9d8f;">در حال پردازش... ${Math.round(data.progress * 100)}% (${job.rows_processed} ردیف)</p>`;
+          setTimeout(() => pollGeocodeJob(statusUrl), 2000);
+        }
+      } catch (error) {
+        statusDiv.innerHTML = `<div class="error">خطا در دریافت وضعیت: ${error.message}</div>`;
+      }
+    }
   </script>
 </body>
 </html>
@@ -2231,6 +5444,10 @@ INDEX_TEMPLATE = """
       
       // مساحت: اول exact match برای area، سپس جستجوی کلمات کلیدی
       let area = (props.area && String(props.area).trim() !== '') ? String(props.area).trim() : null;
+      // مساحت ژئودزیک محاسبه شده در زمان آپلود، وقتی مساحت دستی وارد نشده است
+      if (!area && props.area_m2 != null) {
+        area = Math.round(Number(props.area_m2)).toLocaleString('fa-IR');
+      }
       if (!area) {
         area = getFieldValueByKeywords(props, ['مساحت', 'area']);
       }
@@ -3149,32 +6366,20 @@ def index():
     history = load_history()
     selected_map_id = request.args.get("map_id")
     city_name = request.args.get("city")  # نام شهر برای بارگذاری کسب و کارها
-    geojson = None
+    geojson_text = None
     summary = None
     selected_features_geojson = []  # لیست عوارض انتخاب شده
     selected_feature_ids = []  # لیست feature_ids برای checkbox ها
 
     if selected_map_id:
-        map_data = load_map_data(selected_map_id)
-        if map_data:
-            geojson = map_data.get("geojson")
-            summary = map_data.get("summary")
-            # اعمال ویرایش‌های محلات
-            if geojson and geojson.get("features"):
-                for feature in geojson.get("features", []):
-                    props = feature.get("properties", {})
-                    feature_id = get_feature_identifier(feature)
-                    # ذخیره feature_id در properties برای استفاده بعدی
-                    if feature_id:
-                        props["feature_id"] = feature_id
-                    original_name = props.get('NAME_NEW') or props.get('Name') or props.get('name') or 'نامشخص'
-                    # اعمال ویرایش‌ها - باید قبل از JSON serialization انجام شود
-                    props = apply_neighborhood_edits(props, selected_map_id, feature_id, original_name)
-                    # به‌روزرسانی properties در feature
-                    feature["properties"] = props
-            # اتصال لینک‌های توت‌اپ (با استفاده از لینک‌های ذخیره شده)
-            if geojson:
-                _attach_tootapp_links(geojson, selected_map_id)
+        # level=district یا level=city: نمایش لایه ادغام شده به جای همه مرزهای داخلی محلات
+        level = request.args.get("level")
+        level = level if level in DERIVED_LAYER_LEVELS else None
+        # GeoJSON نهایی (با ویرایش‌ها و لینک‌های توت‌اپ) از snapshot آماده خوانده می‌شود
+        geojson_text = load_map_snapshot(selected_map_id, level)
+        if geojson_text:
+            map_info = load_map_info(get_derived_map_id(selected_map_id, level) if level else selected_map_id)
+            summary = map_info.get("summary") if map_info else None
         
         # بارگذاری تمام عوارض مربوط به این نقشه (به صورت خودکار)
         try:
@@ -3205,7 +6410,7 @@ def index():
         history=history,
         selected_map_id=selected_map_id,
         city_name=json.dumps(city_name) if city_name else None,
-        geojson=json.dumps(geojson) if geojson else None,
+        geojson=geojson_text,
         summary=summary,
         selected_features_geojson=[json.dumps(fg) for fg in selected_features_geojson] if selected_features_geojson else [],
         selected_feature_ids=selected_feature_ids,
@@ -3239,12 +6444,13 @@ def admin_login():
             session["username"] = username
             session["role"] = get_user(username).get("role", "viewer")
             # به‌روزرسانی last_login
-            users = load_users()
-            for user in users:
-                if user.get("username") == username:
-                    user["last_login"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    break
-            save_users(users)
+            with file_lock(USERS_FILE):
+                users = load_users()
+                for user in users:
+                    if user.get("username") == username:
+                        user["last_login"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                        break
+                save_users(users)
             return redirect(url_for("admin_panel"))
         else:
             error = "نام کاربری یا رمز عبور اشتباه است."
@@ -3309,15 +6515,16 @@ def admin_panel():
                     
                     save_map_data(map_id, geojson, summary, file_obj.filename)
 
-                    history = load_history()
-                    history.insert(0, {
-                        "map_id": map_id,
-                        "map_name": final_map_name,
-                        "original_filename": file_obj.filename,
-                        "upload_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "feature_count": summary.get("feature_count", 0),
-                    })
-                    save_history(history)
+                    with file_lock(HISTORY_FILE):
+                        history = load_history()
+                        history.insert(0, {
+                            "map_id": map_id,
+                            "map_name": final_map_name,
+                            "original_filename": file_obj.filename,
+                            "upload_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            "feature_count": summary.get("feature_count", 0),
+                        })
+                        save_history(history)
 
                 except ValueError as exc:
                     error = str(exc)
@@ -3363,12 +6570,11 @@ def admin_manage_links(map_id: str):
     if not has_permission("manage_links"):
         return redirect(url_for("admin_panel") + "?error=شما دسترسی مدیریت لینک‌ها ندارید")
 
-    # بارگذاری داده‌های نقشه
-    map_data = load_map_data(map_id)
-    if not map_data:
+    # بارگذاری ویژگی‌های محلات (geometry ها لازم نیستند)
+    attributes = load_map_attributes(map_id)
+    if attributes is None:
         return redirect(url_for("admin_panel") + "?error=نقشه پیدا نشد")
 
-    geojson = map_data.get("geojson")
     history = load_history()
     map_info = next((item for item in history if item.get("map_id") == map_id), None)
     map_name = map_info.get("map_name", map_info.get("original_filename", "نقشه")) if map_info else "نقشه"
@@ -3381,10 +6587,10 @@ def admin_manage_links(map_id: str):
     saved_links = load_links(map_id)
     saved_logos = get_all_neighborhood_logos(map_id)  # فقط یک بار فراخوانی می‌شود
     
-    if geojson and geojson.get("features"):
-        for feature in geojson.get("features", []):
-            props = feature.get("properties", {}).copy()  # کپی برای اعمال ویرایش‌ها
-            feature_id = get_feature_identifier(feature)
+    if attributes:
+        for props in attributes:
+            props = dict(props)  # کپی برای اعمال ویرایش‌ها
+            feature_id = props.get("feature_id")
             
             # اعمال ویرایش‌های محله
             original_name = props.get('NAME_NEW') or props.get('Name') or props.get('name') or 'نامشخص'
@@ -3503,29 +6709,31 @@ def admin_save_single_link(map_id: str):
         return json.dumps({"success": False, "error": "شناسه محله نامعتبر است"}), 400, {"Content-Type": "application/json"}
 
     try:
-        # بارگذاری لینک‌های موجود
-        links = load_links(map_id)
-
-        if link_value:
-            # حذف tootapp.ir/join/ یا tootapp.ir/ اگر کاربر آن را وارد کرده
-            if link_value.startswith("tootapp.ir/join/"):
-                link_value = link_value.replace("tootapp.ir/join/", "")
-            elif link_value.startswith("tootapp.ir/"):
-                link_value = link_value.replace("tootapp.ir/", "")
-            if link_value.startswith("https://tootapp.ir/join/"):
-                link_value = link_value.replace("https://tootapp.ir/join/", "")
-            elif link_value.startswith("https://tootapp.ir/"):
-                link_value = link_value.replace("https://tootapp.ir/", "")
-            if link_value.startswith("http://tootapp.ir/join/"):
-                link_value = link_value.replace("http://tootapp.ir/join/", "")
-            elif link_value.startswith("http://tootapp.ir/"):
-                link_value = link_value.replace("http://tootapp.ir/", "")
-            links[feature_id] = link_value
-        elif feature_id in links:
-            # اگر لینک خالی شد، حذف می‌کنیم
-            del links[feature_id]
-
-        save_links(map_id, links)
+        # خواندن، تغییر و نوشتن لینک‌ها زیر قفل فایل آن‌ها (بین worker ها)
+        with file_lock(LINKS_DIR / f"{map_id}.json"):
+            # بارگذاری لینک‌های موجود
+            links = load_links(map_id)
+
+            if link_value:
+                # حذف tootapp.ir/join/ یا tootapp.ir/ اگر کاربر آن را وارد کرده
+                if link_value.startswith("tootapp.ir/join/"):
+                    link_value = link_value.replace("tootapp.ir/join/", "")
+                elif link_value.startswith("tootapp.ir/"):
+                    link_value = link_value.replace("tootapp.ir/", "")
+                if link_value.startswith("https://tootapp.ir/join/"):
+                    link_value = link_value.replace("https://tootapp.ir/join/", "")
+                elif link_value.startswith("https://tootapp.ir/"):
+                    link_value = link_value.replace("https://tootapp.ir/", "")
+                if link_value.startswith("http://tootapp.ir/join/"):
+                    link_value = link_value.replace("http://tootapp.ir/join/", "")
+                elif link_value.startswith("http://tootapp.ir/"):
+                    link_value = link_value.replace("http://tootapp.ir/", "")
+                links[feature_id] = link_value
+            elif feature_id in links:
+                # اگر لینک خالی شد، حذف می‌کنیم
+                del links[feature_id]
+
+            save_links(map_id, links)
         return json.dumps({"success": True, "message": "لینک با موفقیت ذخیره شد"}), 200, {"Content-Type": "application/json"}
     except Exception as e:
         return json.dumps({"success": False, "error": str(e)}), 500, {"Content-Type": "application/json"}
@@ -3747,18 +6955,7 @@ def api_get_neighborhood_logo():
                 if found_file:
                     # به‌روزرسانی JSON با نام فایل صحیح
                     try:
-                        # پیدا کردن فایل JSON مربوطه و به‌روزرسانی آن
-                        for json_file in LOGO_DIR.glob("*.json"):
-                            try:
-                                with open(json_file, 'r', encoding='utf-8') as f:
-                                    data = json.load(f)
-                                if data.get("logo_filename") == logo_filename and data.get("map_id") == map_id:
-                                    data["logo_filename"] = found_file
-                                    with open(json_file, 'w', encoding='utf-8') as f:
-                                        json.dump(data, f, ensure_ascii=False, indent=2)
-                                    break
-                            except Exception:
-                                continue
+                        rename_neighborhood_logo_file(map_id, logo_filename, found_file)
                     except Exception:
                         pass
                     
@@ -3846,21 +7043,22 @@ def admin_save_neighborhood_edit(map_id: str):
         if not feature_id:
             return jsonify({"success": False, "error": "شناسه محله مشخص نشد"}), 400
         
-        # بارگذاری ویرایش‌های موجود
-        all_edits = load_neighborhood_edits(map_id)
-        
-        # ساخت کلید
-        edit_key = get_neighborhood_edit_key(feature_id, original_name)
-        
-        # ذخیره ویرایش‌ها
-        all_edits[edit_key] = {
-            "feature_id": feature_id,
-            "original_name": original_name,
-            "edits": edits,
-            "updated_at": datetime.now().isoformat()
-        }
-        
-        save_neighborhood_edits(map_id, all_edits)
+        with file_lock(get_neighborhood_edits_file(map_id)):
+            # بارگذاری ویرایش‌های موجود
+            all_edits = load_neighborhood_edits(map_id)
+            
+            # ساخت کلید
+            edit_key = get_neighborhood_edit_key(feature_id, original_name)
+            
+            # ذخیره ویرایش‌ها
+            all_edits[edit_key] = {
+                "feature_id": feature_id,
+                "original_name": original_name,
+                "edits": edits,
+                "updated_at": datetime.now().isoformat()
+            }
+            
+            save_neighborhood_edits(map_id, all_edits)
         
         # بررسی که ویرایش درست ذخیره شد
         saved_edits = load_neighborhood_edits(map_id)
@@ -3919,252 +7117,578 @@ def admin_create_user():
     password = request.form.get("password", "")
     role = request.form.get("role", "viewer")
     
-    success, message = create_user(username, password, role)
+    success, message = create_user(username, password, role)
+    
+    if success:
+        return redirect(url_for("admin_manage_users") + f"?success={message}")
+    else:
+        return redirect(url_for("admin_manage_users") + f"?error={message}")
+
+
+@app.route("/admin/users/change-password", methods=["POST"])
+def admin_change_password():
+    """تغییر رمز عبور کاربر (فقط برای admin)"""
+    if not session.get("username"):
+        return redirect(url_for("admin_login"))
+    
+    if not has_permission("manage_users"):
+        return redirect(url_for("admin_panel") + "?error=شما دسترسی مدیریت کاربران ندارید")
+    
+    username = request.form.get("username", "").strip()
+    new_password = request.form.get("new_password", "")
+    
+    success, message = update_user_password(username, new_password)
+    
+    if success:
+        return redirect(url_for("admin_manage_users") + f"?success={message}")
+    else:
+        return redirect(url_for("admin_manage_users") + f"?error={message}")
+
+
+@app.route("/admin/users/delete/<username>", methods=["POST"])
+def admin_delete_user(username: str):
+    """حذف کاربر (فقط برای admin)"""
+    if not session.get("username"):
+        return redirect(url_for("admin_login"))
+    
+    if not has_permission("manage_users"):
+        return redirect(url_for("admin_panel") + "?error=شما دسترسی مدیریت کاربران ندارید")
+    
+    success, message = delete_user(username)
+    
+    if success:
+        return redirect(url_for("admin_manage_users") + f"?success={message}")
+    else:
+        return redirect(url_for("admin_manage_users") + f"?error={message}")
+
+
+@app.route("/api/neighborhood", methods=["GET", "POST"])
+def api_get_neighborhood():
+    """
+    API برای دریافت نام محله بر اساس مختصات جغرافیایی
+    
+    Parameters:
+        - lat: عرض جغرافیایی (latitude)
+        - lon: طول جغرافیایی (longitude)
+        - map_id: (اختیاری) شناسه نقشه خاص. اگر نباشد، در همه نقشه‌ها جستجو می‌کند
+        - max_distance_m: (اختیاری) اگر نقطه داخل هیچ محله‌ای نبود، نزدیک‌ترین محله تا این فاصله (متر)
+    
+    Returns JSON:
+        {
+            "success": true/false,
+            "region": "نام محله",
+            "district": "نام منطقه",
+            "city": "نام شهر",
+            "map_id": "شناسه نقشه",
+            "map_name": "نام نقشه",
+            "tootapp_url": "لینک توت‌اپ (اگر موجود باشد)",
+            "distance_m": "فاصله تا محله به متر (فقط وقتی max_distance_m ارسال شود)"
+        }
+    """
+    try:
+        # دریافت پارامترها
+        if request.method == "POST":
+            data = request.get_json() or request.form
+            lat = data.get("lat") or data.get("latitude")
+            lon = data.get("lon") or data.get("longitude") or data.get("lng")
+            map_id = data.get("map_id")
+            max_distance_m = data.get("max_distance_m")
+        else:  # GET
+            lat = request.args.get("lat") or request.args.get("latitude")
+            lon = request.args.get("lon") or request.args.get("longitude") or request.args.get("lng")
+            map_id = request.args.get("map_id")
+            max_distance_m = request.args.get("max_distance_m")
+        
+        # بررسی پارامترهای ورودی
+        if not lat or not lon:
+            return jsonify({
+                "success": False,
+                "error": "پارامترهای lat و lon الزامی هستند"
+            }), 400
+        
+        try:
+            lat = float(lat)
+            lon = float(lon)
+        except (ValueError, TypeError):
+            return jsonify({
+                "success": False,
+                "error": "lat و lon باید عدد باشند"
+            }), 400
+        
+        if max_distance_m not in (None, ""):
+            try:
+                max_distance_m = float(max_distance_m)
+            except (ValueError, TypeError):
+                max_distance_m = -1
+            if not 0 < max_distance_m <= NEIGHBORHOOD_MAX_FALLBACK_DISTANCE_M:
+                return jsonify({
+                    "success": False,
+                    "error": f"max_distance_m باید عددی بین 0 و {NEIGHBORHOOD_MAX_FALLBACK_DISTANCE_M} باشد"
+                }), 400
+        else:
+            max_distance_m = None
+        
+        # جستجو در کش نتایج (مختصات گرد شده) و در صورت نبود، در ایندکس نقشه‌ها
+        cache_key = (
+            map_id or "all",
+            round(lat, NEIGHBORHOOD_CACHE_PRECISION),
+            round(lon, NEIGHBORHOOD_CACHE_PRECISION),
+            max_distance_m,
+        )
+        cache_revision = get_lookup_revision(map_id)
+        result = neighborhood_cache_get(cache_key, cache_revision)
+        if result is _CACHE_MISS:
+            result = lookup_neighborhood(lat, lon, map_id, max_distance_m, revision=cache_revision)
+            neighborhood_cache_put(cache_key, cache_revision, result)
+        
+        if result is not None:
+            result = dict(result)
+            result["coordinates"] = {"lat": lat, "lon": lon}
+            return jsonify(result), 200
+        
+        # اگر هیچ محله‌ای پیدا نشد
+        return jsonify({
+            "success": False,
+            "error": "محله‌ای برای این مختصات پیدا نشد",
+            "coordinates": {
+                "lat": lat,
+                "lon": lon
+            }
+        }), 404
+        
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": f"خطا در پردازش درخواست: {str(e)}"
+        }), 500
+
+
+@app.route("/api/neighborhood/hierarchy", methods=["GET", "POST"])
+def api_get_neighborhood_hierarchy():
+    """
+    API سلسله‌مراتبی: همه سطوح (شهر، منطقه، محله، ...) شامل یک نقطه در یک درخواست
+    
+    Parameters:
+        - lat: عرض جغرافیایی (latitude)
+        - lon: طول جغرافیایی (longitude)
+    
+    Returns JSON:
+        {
+            "success": true/false,
+            "levels": [{"level", "region", "district", "city", "map_id", "map_name", "feature_id", "tootapp_url", "area_km2"}, ...],
+            "coordinates": {"lat", "lon"}
+        }
+    سطوح به ترتیب دربرگیری (بزرگ‌ترین محدوده اول) مرتب شده‌اند.
+    """
+    try:
+        if request.method == "POST":
+            data = request.get_json(silent=True) or request.form
+        else:
+            data = request.args
+        lat = data.get("lat") or data.get("latitude")
+        lon = data.get("lon") or data.get("longitude") or data.get("lng")
+        
+        if not lat or not lon:
+            return jsonify({"success": False, "error": "پارامترهای lat و lon الزامی هستند"}), 400
+        try:
+            lat = float(lat)
+            lon = float(lon)
+        except (ValueError, TypeError):
+            return jsonify({"success": False, "error": "lat و lon باید عدد باشند"}), 400
+        
+        cache_key = (
+            "hierarchy",
+            round(lat, NEIGHBORHOOD_CACHE_PRECISION),
+            round(lon, NEIGHBORHOOD_CACHE_PRECISION),
+        )
+        cache_revision = get_lookup_revision()
+        levels = neighborhood_cache_get(cache_key, cache_revision)
+        if levels is _CACHE_MISS:
+            levels = lookup_hierarchy(lat, lon, revision=cache_revision)
+            neighborhood_cache_put(cache_key, cache_revision, levels)
+        
+        coordinates = {"lat": lat, "lon": lon}
+        if not levels:
+            return jsonify({
+                "success": False,
+                "error": "محله‌ای برای این مختصات پیدا نشد",
+                "coordinates": coordinates,
+            }), 404
+        return jsonify({"success": True, "levels": levels, "coordinates": coordinates}), 200
+    except Exception as e:
+        return jsonify({"success": False, "error": f"خطا در پردازش درخواست: {str(e)}"}), 500
+
+
+@app.route("/api/maps/<map_id>/layers/<level>", methods=["GET"])
+def api_get_map_layer(map_id: str, level: str):
+    """
+    دریافت لایه ادغام شده (dissolve) منطقه‌ها یا شهرهای یک نقشه محلات
+    
+    لایه مشتق با شناسه map_id برگشتی در /api/neighborhood و /api/neighborhood/batch قابل geocode است.
+    """
+    if level not in DERIVED_LAYER_LEVELS:
+        return jsonify({"success": False, "error": f"سطح باید یکی از {', '.join(DERIVED_LAYER_LEVELS)} باشد"}), 400
+    try:
+        layer = get_derived_layer(map_id, level)
+    except Exception as e:
+        return jsonify({"success": False, "error": f"خطا در ساخت لایه: {str(e)}"}), 500
+    if not layer:
+        return jsonify({"success": False, "error": "نقشه پیدا نشد"}), 404
+    return jsonify({
+        "success": True,
+        "map_id": layer.get("map_id"),
+        "parent_map_id": map_id,
+        "level": level,
+        "geojson": layer.get("geojson"),
+    }), 200
+
+
+@app.route("/api/neighborhood/search", methods=["GET"])
+def api_search_neighborhood():
+    """
+    API جستجوی محله بر اساس نام (forward geocoding)
+    
+    Parameters:
+        - q: متن جستجو (فارسی یا انگلیسی)
+        - limit: (اختیاری) حداکثر تعداد نتایج - پیش‌فرض 10
+        - map_id: (اختیاری) فقط محلات یک نقشه
+    
+    Returns JSON:
+        {
+            "success": true,
+            "results": [{"region", "district", "city", "map_id", "map_name", "feature_id", "tootapp_url",
+                         "matched_name", "centroid": {"lat", "lon"}, "bbox": [minx, miny, maxx, maxy], "score"}, ...]
+        }
+    """
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"success": False, "error": "پارامتر q الزامی است"}), 400
+    try:
+        limit = int(request.args.get("limit", 10))
+    except (ValueError, TypeError):
+        return jsonify({"success": False, "error": "limit باید عدد باشد"}), 400
+    limit = max(1, min(limit, NEIGHBORHOOD_SEARCH_MAX_RESULTS))
+    
+    try:
+        results = search_neighborhoods(query, limit, request.args.get("map_id"))
+    except Exception as e:
+        return jsonify({"success": False, "error": f"خطا در پردازش درخواست: {str(e)}"}), 500
+    return jsonify({"success": True, "count": len(results), "results": results}), 200
+
+
+@app.route("/api/maps/<map_id>/aggregate", methods=["POST"])
+def api_aggregate_map_points(map_id: str):
+    """
+    API تجمیع نقاط: تعداد و مجموع وزن نقاط داخل هر محله یک نقشه (برای نقشه‌های choropleth)
+    
+    Body: همان قالب /api/neighborhood/batch، با وزن اختیاری هر نقطه
+        - JSON: [{"lat": .., "lon": .., "weight": ..}, ...] یا [[lat, lon, weight], ...]
+        - CSV (text/csv): ستون‌های lat و lon و weight
     
-    if success:
-        return redirect(url_for("admin_manage_users") + f"?success={message}")
-    else:
-        return redirect(url_for("admin_manage_users") + f"?error={message}")
+    Returns JSON:
+        {
+            "success": true,
+            "map_id": "شناسه نقشه",
+            "count": تعداد نقاط,
+            "matched": تعداد نقاط داخل محلات,
+            "invalid": تعداد نقاط نامعتبر,
+            "results": {"feature_id": {"region": "نام محله", "count": .., "sum": ..}, ...}
+        }
+    """
+    try:
+        payload = request.get_json(silent=True)
+        if payload is None:
+            payload = request.get_data()
+        try:
+            lats, lons, weights, _ = _parse_points_payload(payload)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        
+        result = aggregate_points(map_id, lats, lons, weights)
+        if result is None:
+            return jsonify({"success": False, "error": "نقشه پیدا نشد"}), 404
+        result = dict(result, success=True, map_id=map_id)
+        return jsonify(result), 200
+    except Exception as e:
+        return jsonify({"success": False, "error": f"خطا در پردازش درخواست: {str(e)}"}), 500
 
 
-@app.route("/admin/users/change-password", methods=["POST"])
-def admin_change_password():
-    """تغییر رمز عبور کاربر (فقط برای admin)"""
-    if not session.get("username"):
-        return redirect(url_for("admin_login"))
+@app.route("/api/maps/<map_id>/neighbors", methods=["GET"])
+def api_get_map_adjacency(map_id: str):
+    """لیست همسایگی همه محلات یک نقشه: {"feature_id": ["feature_id همسایه", ...], ...}"""
+    try:
+        index = get_map_index(map_id)
+    except Exception as e:
+        return jsonify({"success": False, "error": f"خطا در پردازش درخواست: {str(e)}"}), 500
+    if not index:
+        return jsonify({"success": False, "error": "نقشه پیدا نشد"}), 404
     
-    if not has_permission("manage_users"):
-        return redirect(url_for("admin_panel") + "?error=شما دسترسی مدیریت کاربران ندارید")
+    adjacency = {}
+    for feature_idx in range(index_size(index)):
+        feature_id = index_record(index, feature_idx)["feature_id"]
+        adjacency[feature_id] = [
+            index_record(index, int(neighbor))["feature_id"] for neighbor in index_neighbors(index, feature_idx)
+        ]
+    return jsonify({"success": True, "map_id": map_id, "adjacency": adjacency}), 200
+
+
+@app.route("/api/maps/<map_id>/neighbors/<feature_id>", methods=["GET"])
+def api_get_feature_neighbors(map_id: str, feature_id: str):
+    """محلات همسایه (دارای مرز مشترک) یک محله - برای پیشنهاد «گروه‌های نزدیک» کنار لینک توت‌اپ"""
+    try:
+        index = get_map_index(map_id)
+    except Exception as e:
+        return jsonify({"success": False, "error": f"خطا در پردازش درخواست: {str(e)}"}), 500
+    if not index:
+        return jsonify({"success": False, "error": "نقشه پیدا نشد"}), 404
+    feature_idx = index_feature_ids(index).get(feature_id.strip())
+    if feature_idx is None:
+        return jsonify({"success": False, "error": "محله پیدا نشد"}), 404
     
-    username = request.form.get("username", "").strip()
-    new_password = request.form.get("new_password", "")
+    history = load_history()
+    neighbors = []
+    for neighbor in index_neighbors(index, feature_idx).tolist():
+        item = _neighborhood_payload(index, neighbor, history)
+        item.pop("success", None)
+        item["feature_id"] = index_record(index, neighbor)["feature_id"]
+        neighbors.append(item)
+    return jsonify({
+        "success": True,
+        "map_id": map_id,
+        "feature_id": index_record(index, feature_idx)["feature_id"],
+        "region": index_record(index, feature_idx)["region"],
+        "count": len(neighbors),
+        "neighbors": neighbors,
+    }), 200
+
+
+@app.route("/api/maps/<map_id>/bundle", methods=["GET"])
+def api_get_map_bundle(map_id: str):
+    """
+    دانلود بسته باینری geocoding آفلاین یک نقشه (برای اپ موبایل)
     
-    success, message = update_user_password(username, new_password)
+    نسخه بسته در ETag و هدر X-Bundle-Version است؛ با If-None-Match اگر بسته تغییر نکرده باشد 304 برمی‌گردد.
+    """
+    from flask import send_file
     
-    if success:
-        return redirect(url_for("admin_manage_users") + f"?success={message}")
-    else:
-        return redirect(url_for("admin_manage_users") + f"?error={message}")
+    try:
+        bundle = get_map_bundle(map_id)
+    except Exception as e:
+        return jsonify({"success": False, "error": f"خطا در ساخت بسته: {str(e)}"}), 500
+    if bundle is None:
+        return jsonify({"success": False, "error": "نقشه پیدا نشد"}), 404
+    
+    bundle_file, version = bundle
+    response = send_file(
+        bundle_file,
+        mimetype="application/octet-stream",
+        as_attachment=True,
+        download_name=f"{map_id}.rgnb",
+        etag=version,
+        conditional=True,
+        max_age=0,
+    )
+    response.headers["X-Bundle-Version"] = version
+    return response
 
 
-@app.route("/admin/users/delete/<username>", methods=["POST"])
-def admin_delete_user(username: str):
-    """حذف کاربر (فقط برای admin)"""
-    if not session.get("username"):
-        return redirect(url_for("admin_login"))
+@app.route("/api/maps/<map_id>/geojson", methods=["GET"])
+def api_get_map_geojson(map_id: str):
+    """
+    GeoJSON نهایی یک نقشه (با ویرایش‌ها و لینک‌های توت‌اپ) از snapshot آماده، بدون پردازش در هر درخواست
     
-    if not has_permission("manage_users"):
-        return redirect(url_for("admin_panel") + "?error=شما دسترسی مدیریت کاربران ندارید")
+    Query Parameters:
+        - level: (اختیاری) district یا city برای لایه ادغام شده
     
-    success, message = delete_user(username)
+    نسخه snapshot در ETag است؛ با If-None-Match اگر تغییری نکرده باشد 304 برمی‌گردد.
+    """
+    from flask import send_file
     
-    if success:
-        return redirect(url_for("admin_manage_users") + f"?success={message}")
-    else:
-        return redirect(url_for("admin_manage_users") + f"?error={message}")
+    level = request.args.get("level")
+    if level and level not in DERIVED_LAYER_LEVELS:
+        return jsonify({"success": False, "error": f"سطح باید یکی از {', '.join(DERIVED_LAYER_LEVELS)} باشد"}), 400
+    try:
+        snapshot = open_map_snapshot(map_id, level)
+    except Exception as e:
+        return jsonify({"success": False, "error": f"خطا در ساخت GeoJSON: {str(e)}"}), 500
+    if snapshot is None:
+        return jsonify({"success": False, "error": "نقشه پیدا نشد"}), 404
+    
+    snapshot_file, version = snapshot
+    return send_file(
+        snapshot_file,
+        mimetype="application/geo+json",
+        etag=version,
+        conditional=True,
+        max_age=0,
+    )
 
 
-@app.route("/api/neighborhood", methods=["GET", "POST"])
-def api_get_neighborhood():
+@app.route("/api/maps/<map_id>/features/<feature_id>", methods=["GET"])
+def api_get_map_feature(map_id: str, feature_id: str):
+    """دریافت محله، منطقه، شهر و لینک توت‌اپ یک feature نقشه با شناسه آن
+    با ?geometry=1 خود feature (GeoJSON کامل) هم در کلید feature برگردانده می‌شود.
     """
-    API برای دریافت نام محله بر اساس مختصات جغرافیایی
+    try:
+        result = get_map_feature(map_id, feature_id)
+        if result is not None and request.args.get("geometry") in ("1", "true"):
+            result["feature"] = load_map_feature(map_id, feature_id)
+    except Exception as e:
+        return jsonify({"success": False, "error": f"خطا در پردازش درخواست: {str(e)}"}), 500
+    if result is None:
+        return jsonify({"success": False, "error": "محله پیدا نشد"}), 404
+    return jsonify(result), 200
+
+
+@app.route("/api/neighborhood/cache-stats", methods=["GET"])
+def api_neighborhood_cache_stats():
+    """شمارنده‌های کش نتایج API محله و کش فایل‌ها (hit/miss/eviction) در این worker"""
+    return jsonify({
+        "success": True,
+        "pid": os.getpid(),
+        "cache": get_neighborhood_cache_stats(),
+        "file_cache": get_file_cache_stats(),
+    }), 200
+
+
+@app.route("/api/neighborhood/batch", methods=["POST"])
+def api_get_neighborhood_batch():
+    """
+    API دسته‌ای برای دریافت نام محله هزاران نقطه در یک درخواست
     
-    Parameters:
-        - lat: عرض جغرافیایی (latitude)
-        - lon: طول جغرافیایی (longitude)
-        - map_id: (اختیاری) شناسه نقشه خاص. اگر نباشد، در همه نقشه‌ها جستجو می‌کند
+    Body:
+        - JSON: [{"lat": .., "lon": ..}, ...] یا [[lat, lon], ...] یا {"points": [...], "map_id": ".."}
+        - CSV (text/csv): ستون‌های lat و lon
+        - map_id: (اختیاری) در query string یا بدنه JSON
     
     Returns JSON:
         {
-            "success": true/false,
-            "region": "نام محله",
-            "district": "نام منطقه",
-            "city": "نام شهر",
-            "map_id": "شناسه نقشه",
-            "map_name": "نام نقشه",
-            "tootapp_url": "لینک توت‌اپ (اگر موجود باشد)"
+            "success": true,
+            "count": تعداد نقاط,
+            "matched": تعداد نقاط دارای محله,
+            "results": [پاسخی با همان ساختار /api/neighborhood برای هر نقطه]
         }
     """
     try:
-        # دریافت پارامترها
-        if request.method == "POST":
-            data = request.get_json() or request.form
-            lat = data.get("lat") or data.get("latitude")
-            lon = data.get("lon") or data.get("longitude") or data.get("lng")
-            map_id = data.get("map_id")
-        else:  # GET
-            lat = request.args.get("lat") or request.args.get("latitude")
-            lon = request.args.get("lon") or request.args.get("longitude") or request.args.get("lng")
-            map_id = request.args.get("map_id")
-        
-        # بررسی پارامترهای ورودی
-        if not lat or not lon:
-            return jsonify({
-                "success": False,
-                "error": "پارامترهای lat و lon الزامی هستند"
-            }), 400
-        
+        payload = request.get_json(silent=True)
+        if payload is None:
+            payload = request.get_data()
         try:
-            lat = float(lat)
-            lon = float(lon)
-        except (ValueError, TypeError):
-            return jsonify({
-                "success": False,
-                "error": "lat و lon باید عدد باشند"
-            }), 400
+            lats, lons, _, map_id = _parse_points_payload(payload, request.args.get("map_id"))
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         
-        # ایجاد نقطه از مختصات
-        point = Point(lon, lat)  # توجه: GeoJSON از [lon, lat] استفاده می‌کند
+        payloads = lookup_neighborhoods_bulk(lats, lons, map_id)
         
-        # جستجو در نقشه‌ها
-        history = load_history()
-        maps_to_search = []
+        results = []
+        matched = 0
+        for lat, lon, payload_item in zip(lats.tolist(), lons.tolist(), payloads):
+            if payload_item is not None:
+                result = dict(payload_item)
+                matched += 1
+            elif lat != lat or lon != lon:
+                result = {"success": False, "error": "lat و lon باید عدد باشند"}
+            else:
+                result = {"success": False, "error": "محله‌ای برای این مختصات پیدا نشد"}
+            result["coordinates"] = {
+                "lat": lat if lat == lat else None,
+                "lon": lon if lon == lon else None
+            }
+            results.append(result)
         
-        if map_id:
-            # جستجو در نقشه خاص
-            map_data = load_map_data(map_id)
-            if map_data:
-                maps_to_search = [(map_id, map_data)]
-        else:
-            # جستجو در همه نقشه‌ها
-            for item in history:
-                item_map_id = item.get("map_id")
-                if item_map_id:
-                    map_data = load_map_data(item_map_id)
-                    if map_data:
-                        maps_to_search.append((item_map_id, map_data))
+        return jsonify({
+            "success": True,
+            "count": len(results),
+            "matched": matched,
+            "results": results
+        }), 200
         
-        # جستجو در هر نقشه
-        for current_map_id, map_data in maps_to_search:
-            geojson = map_data.get("geojson")
-            if not geojson or not geojson.get("features"):
-                continue
-            
-            # تبدیل GeoJSON به GeoDataFrame برای جستجوی سریع
-            try:
-                gdf = gpd.GeoDataFrame.from_features(geojson["features"], crs="EPSG:4326")
-                
-                # پیدا کردن feature که شامل این نقطه است
-                mask = gdf.contains(point)
-                matching_features = gdf[mask]
-                
-                if not matching_features.empty:
-                    # اولین feature پیدا شده
-                    feature_series = matching_features.iloc[0]
-                    props = feature_series.to_dict()
-                    
-                    # تبدیل به dict برای get_feature_identifier
-                    feature_dict = {
-                        "properties": {k: v for k, v in props.items() if k != "geometry"}
-                    }
-                    
-                    # استخراج اطلاعات
-                    neighborhood = None
-                    district = None
-                    city = None
-                    
-                    # جستجوی نام محله - ابتدا فیلدهای استاندارد
-                    for field in NEIGHBORHOOD_FIELDS:
-                        if field in props and props[field]:
-                            neighborhood = str(props[field])
-                            break
-                    
-                    # اگر محله پیدا نشد، جستجوی هوشمند در همه فیلدها
-                    if not neighborhood:
-                        # جستجو برای فیلدهایی که نامشان شامل "name" یا "mahal" است
-                        exclude_fields = ['geometry', 'tootapp_url', 'district', 'region', 'city', 'ostan', 'id', 'ID']
-                        neighborhood_candidates = []
-                        
-                        for key, value in props.items():
-                            if key.lower() in [f.lower() for f in exclude_fields]:
-                                continue
-                            
-                            key_lower = key.lower()
-                            value_str = str(value).strip() if value else ""
-                            
-                            # بررسی اینکه نام فیلد شامل "name" یا "mahal" باشد
-                            if value_str and ('name' in key_lower or 'mahal' in key_lower):
-                                # بررسی اینکه مقدار معتبر باشد (نه عدد خالص)
-                                if not value_str.replace('.', '').replace('-', '').isdigit():
-                                    if len(value_str) > 1 and len(value_str) < 200:
-                                        neighborhood_candidates.append((key, value_str))
-                        
-                        # اگر کاندید پیدا شد، اولی را انتخاب می‌کنیم
-                        if neighborhood_candidates:
-                            neighborhood = neighborhood_candidates[0][1]
-                    
-                    # اگر هنوز پیدا نشد، جستجوی عمومی در همه فیلدها
-                    if not neighborhood:
-                        exclude_fields = ['geometry', 'tootapp_url', 'district', 'region', 'city', 'ostan', 'id', 'ID', 'lat', 'lon', 'longitude', 'latitude']
-                        for key, value in props.items():
-                            if key.lower() in [f.lower() for f in exclude_fields]:
-                                continue
-                            value_str = str(value).strip() if value else ""
-                            # اگر مقدار خالی نباشد و عدد نباشد (احتمالاً نام است)
-                            if value_str and not value_str.replace('.', '').replace('-', '').isdigit():
-                                # بررسی اینکه نام محله باشد (نه مختصات یا کد)
-                                if len(value_str) > 2 and len(value_str) < 100:
-                                    neighborhood = value_str
-                                    break
-                    
-                    # جستجوی منطقه
-                    for field in DISTRICT_FIELDS:
-                        if field in props and props[field]:
-                            district = str(props[field])
-                            break
-                    
-                    # جستجوی شهر
-                    for field in CITY_FIELDS:
-                        if field in props and props[field]:
-                            city = str(props[field])
-                            break
-                    
-                    # پیدا کردن map_name
-                    map_info = next((item for item in history if item.get("map_id") == current_map_id), None)
-                    map_name = map_info.get("map_name") if map_info else map_info.get("original_filename", "") if map_info else ""
-                    
-                    # بارگذاری لینک توت‌اپ
-                    links = load_links(current_map_id)
-                    feature_id = get_feature_identifier(feature_dict)
-                    tootapp_url = None
-                    
-                    if feature_id and feature_id in links:
-                        saved_link = links[feature_id]
-                        if saved_link.startswith("http"):
-                            tootapp_url = saved_link
-                        else:
-                            tootapp_url = f"{TOOTAPP_BASE_URL.rstrip('/')}/{saved_link.lstrip('/')}"
-                    else:
-                        # استفاده از base URL فقط
-                        tootapp_url = TOOTAPP_BASE_URL.rstrip('/')
-                    
-                    return jsonify({
-                        "success": True,
-                        "region": neighborhood,
-                        "district": district,
-                        "city": city,
-                        "map_id": current_map_id,
-                        "map_name": map_name,
-                        "tootapp_url": tootapp_url,
-                        "coordinates": {
-                            "lat": lat,
-                            "lon": lon
-                        }
-                    }), 200
-                    
-            except Exception as e:
-                # اگر GeoPandas خطا داد، با روش ساده‌تر امتحان می‌کنیم
-                continue
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": f"خطا در پردازش درخواست: {str(e)}"
+        }), 500
+
+
+@app.route("/api/neighborhood/trace", methods=["POST"])
+def api_get_neighborhood_trace():
+    """
+    API مسیر: محلاتی که یک مسیر GPS (مثلاً یک سفر پیک) از آن‌ها عبور می‌کند در یک درخواست
+    
+    Body (JSON):
+        - {"type": "LineString", "coordinates": [[lon, lat], ...]} یا Feature آن
+        - یا {"points": [{"lat": .., "lon": .., "timestamp": ..}, ...]} (timestamp عدد epoch یا ISO-8601)
+        - map_id: (اختیاری) در query string یا بدنه JSON
+    
+    Returns JSON:
+        {
+            "success": true,
+            "length_m": طول کل مسیر به متر,
+            "neighborhoods": [
+                {"region", "district", "city", "map_id", "map_name", "feature_id", "tootapp_url",
+                 "entry_index", "exit_index", "length_m", "entry_time", "exit_time"}, ...
+            ]
+        }
+    entry_index و exit_index شماره نقطه ورودی قبل از ورود و بعد از خروج هستند.
+    """
+    try:
+        payload = request.get_json(silent=True)
+        try:
+            lons, lats, timestamps, map_id = _parse_trace_payload(payload, request.args.get("map_id"))
+            result = trace_neighborhoods(lons, lats, map_id, timestamps)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        if result is None:
+            return jsonify({"success": False, "error": "نقشه پیدا نشد"}), 404
         
-        # اگر هیچ محله‌ای پیدا نشد
+        return jsonify({
+            "success": True,
+            "count": len(result["neighborhoods"]),
+            "length_m": result["length_m"],
+            "neighborhoods": result["neighborhoods"]
+        }), 200
+        
+    except Exception as e:
         return jsonify({
             "success": False,
-            "error": "محله‌ای برای این مختصات پیدا نشد",
-            "coordinates": {
-                "lat": lat,
-                "lon": lon
-            }
-        }), 404
+            "error": f"خطا در پردازش درخواست: {str(e)}"
+        }), 500
+
+
+@app.route("/api/neighborhood/overlap", methods=["POST"])
+def api_get_neighborhood_overlap():
+    """
+    API همپوشانی: محلاتی که با یک محدوده دلخواه همپوشانی دارند (مثلاً برای تقسیم بودجه کمپین)
+    
+    Body (JSON):
+        - GeoJSON Polygon یا MultiPolygon (یا Feature آن)
+        - یا دایره: {"center": {"lat": .., "lon": ..}, "radius_m": ..}
+        - map_id: (اختیاری) در query string یا بدنه JSON
+    
+    Returns JSON:
+        {
+            "success": true,
+            "query_area_m2": مساحت محدوده درخواست,
+            "neighborhoods": [
+                {"region", "district", "city", "map_id", "map_name", "feature_id", "tootapp_url",
+                 "overlap_area_m2", "overlap_fraction" (سهم از مساحت محله), "query_fraction" (سهم از محدوده)}, ...
+            ]
+        }
+    """
+    try:
+        payload = request.get_json(silent=True)
+        try:
+            polygon, circle, map_id = _parse_overlap_payload(payload)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        
+        result = overlap_neighborhoods(polygon, circle, map_id or request.args.get("map_id"))
+        return jsonify({
+            "success": True,
+            "count": len(result["neighborhoods"]),
+            "query_area_m2": result["query_area_m2"],
+            "neighborhoods": result["neighborhoods"]
+        }), 200
         
     except Exception as e:
         return jsonify({
@@ -4173,6 +7697,85 @@ def api_get_neighborhood():
         }), 500
 
 
+@app.route("/admin/geocode-jobs", methods=["GET", "POST"])
+def admin_geocode_jobs():
+    """ایجاد job جدید geocoding (POST) یا لیست jobهای موجود (GET)"""
+    if not session.get("username"):
+        return jsonify({"success": False, "error": "لطفاً وارد شوید"}), 403
+    
+    if not has_permission("upload"):
+        return jsonify({"success": False, "error": "شما دسترسی آپلود ندارید"}), 403
+    
+    if request.method == "POST":
+        file_obj = request.files.get("points")
+        if not file_obj or not file_obj.filename:
+            return jsonify({"success": False, "error": "لطفاً یک فایل انتخاب کنید"}), 400
+        map_id = request.form.get("map_id", "").strip() or None
+        if map_id and not get_map_revision(map_id)[0]:
+            return jsonify({"success": False, "error": "نقشه پیدا نشد"}), 404
+        try:
+            job = create_geocode_job(file_obj, map_id)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        return jsonify({
+            "success": True,
+            "job": job,
+            "status_url": url_for("admin_geocode_job_status", job_id=job["job_id"]),
+        }), 202
+    
+    jobs = []
+    for status_file in sorted(GEOCODE_JOBS_DIR.glob("*/status.json"), reverse=True):
+        job = load_geocode_job(status_file.parent.name)
+        if job:
+            jobs.append(job)
+    return jsonify({"success": True, "jobs": jobs}), 200
+
+
+@app.route("/admin/geocode-jobs/<job_id>", methods=["GET"])
+def admin_geocode_job_status(job_id: str):
+    """وضعیت و درصد پیشرفت یک job"""
+    if not session.get("username"):
+        return jsonify({"success": False, "error": "لطفاً وارد شوید"}), 403
+    
+    if not has_permission("upload"):
+        return jsonify({"success": False, "error": "شما دسترسی آپلود ندارید"}), 403
+    
+    job = load_geocode_job(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "job پیدا نشد"}), 404
+    
+    progress = job["bytes_processed"] / job["bytes_total"] if job.get("bytes_total") else 1.0
+    result = {"success": True, "job": job, "progress": round(min(progress, 1.0), 4)}
+    if job.get("status") == "done":
+        result["download_url"] = url_for("admin_geocode_job_download", job_id=job_id)
+    return jsonify(result), 200
+
+
+@app.route("/admin/geocode-jobs/<job_id>/download", methods=["GET"])
+def admin_geocode_job_download(job_id: str):
+    """دانلود فایل خروجی غنی‌شده یک job"""
+    from flask import send_file
+    
+    if not session.get("username"):
+        return jsonify({"success": False, "error": "لطفاً وارد شوید"}), 403
+    
+    if not has_permission("upload"):
+        return jsonify({"success": False, "error": "شما دسترسی آپلود ندارید"}), 403
+    
+    job = load_geocode_job(job_id)
+    if not job or job.get("status") != "done":
+        return jsonify({"success": False, "error": "خروجی این job آماده نیست"}), 404
+    
+    output_file = get_geocode_job_dir(job_id) / f"output.{job['format']}"
+    base_name = (job.get("original_filename") or "points").rsplit(".", 1)[0]
+    return send_file(
+        output_file,
+        mimetype="text/csv" if job["format"] == "csv" else "application/x-ndjson",
+        as_attachment=True,
+        download_name=f"{secure_filename(base_name) or 'points'}_geocoded.{job['format']}",
+    )
+
+
 @app.route("/admin/features/upload", methods=["POST"])
 def admin_upload_feature():
     """آپلود عوارض محله (فقط برای admin)"""
@@ -4194,8 +7797,7 @@ def admin_upload_feature():
             return jsonify({"success": False, "error": "شناسه نقشه الزامی است"}), 400
         
         # بررسی وجود نقشه
-        map_data = load_map_data(map_id)
-        if not map_data:
+        if not map_exists(map_id):
             return jsonify({"success": False, "error": "نقشه پیدا نشد"}), 404
         
         # بارگذاری و تبدیل shapefile
@@ -4206,17 +7808,18 @@ def admin_upload_feature():
         final_feature_name = feature_name or file_obj.filename
         save_feature_data(feature_id, geojson, summary, file_obj.filename, map_id, final_feature_name)
         
-        # به‌روزرسانی فهرست
-        index = load_features_index()
-        index.append({
-            "feature_id": feature_id,
-            "feature_name": final_feature_name,
-            "map_id": map_id,
-            "original_filename": file_obj.filename,
-            "upload_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "feature_count": summary.get("feature_count", 0),
-        })
-        save_features_index(index)
+        with file_lock(FEATURES_INDEX_FILE):
+            # به‌روزرسانی فهرست
+            index = load_features_index()
+            index.append({
+                "feature_id": feature_id,
+                "feature_name": final_feature_name,
+                "map_id": map_id,
+                "original_filename": file_obj.filename,
+                "upload_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "feature_count": summary.get("feature_count", 0),
+            })
+            save_features_index(index)
         
         return jsonify({
             "success": True,
@@ -4238,8 +7841,7 @@ def api_list_features():
     if not map_id:
         return jsonify({"success": False, "error": "شناسه نقشه الزامی است"}), 400
     
-    index = load_features_index()
-    features = [item for item in index if item.get("map_id") == map_id]
+    features = load_features_index(map_id)
     
     return jsonify({
         "success": True,
@@ -4470,10 +8072,11 @@ def admin_delete_feature(feature_id: str):
         if feature_file.exists():
             feature_file.unlink()
         
-        # حذف از فهرست
-        index = load_features_index()
-        index = [item for item in index if item.get("feature_id") != feature_id]
-        save_features_index(index)
+        with file_lock(FEATURES_INDEX_FILE):
+            # حذف از فهرست
+            index = load_features_index()
+            index = [item for item in index if item.get("feature_id") != feature_id]
+            save_features_index(index)
         
         return jsonify({"success": True, "message": "عارضه با موفقیت حذف شد"}), 200
         
@@ -4497,9 +8100,6 @@ def admin_update_feature_link(feature_id: str):
         if not map_id:
             return jsonify({"success": False, "error": "شناسه نقشه الزامی است"}), 400
         
-        # بارگذاری لینک‌های موجود
-        links = load_links(map_id)
-        
         # پاک کردن پیشوندهای مختلف
         if link_value.startswith("tootapp.ir/join/"):
             link_value = link_value.replace("tootapp.ir/join/", "")
@@ -4514,9 +8114,11 @@ def admin_update_feature_link(feature_id: str):
         elif link_value.startswith("http://tootapp.ir/"):
             link_value = link_value.replace("http://tootapp.ir/", "")
         
-        # ذخیره لینک (حتی اگر خالی باشد)
-        links[feature_id] = link_value
-        save_links(map_id, links)
+        # ذخیره لینک (حتی اگر خالی باشد) - خواندن و نوشتن لینک‌ها زیر قفل فایل آن‌ها
+        with file_lock(LINKS_DIR / f"{map_id}.json"):
+            links = load_links(map_id)
+            links[feature_id] = link_value
+            save_links(map_id, links)
         
         return jsonify({"success": True, "message": "لینک با موفقیت آپدیت شد"}), 200
         
@@ -0,0 +1,67 @@
+"""تنظیمات مشترک تست‌ها: برنامه با یک پوشه uploads موقت import می‌شود (قبل از import خود app)."""
+
+import io
+import json
+import os
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+
+import pytest
+
+_UPLOAD_ROOT = tempfile.mkdtemp(prefix="regions-map-tests-")
+os.environ["UPLOAD_ROOT"] = _UPLOAD_ROOT
+os.environ["JSON_WRITE_FSYNC"] = "0"
+os.environ.setdefault("METADATA_BACKEND", "json")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    return app_module
+
+
+@pytest.fixture
+def client(app):
+    """کلاینت تست وارد شده با کاربر پیش‌فرض admin"""
+    app.app.config["TESTING"] = True
+    client = app.app.test_client()
+    app.load_users()
+    response = client.post("/admin/login", data={"username": "admin", "password": "admin123"})
+    assert response.status_code in (200, 302)
+    return client
+
+
+def feature_collection(items):
+    """GeoJSON از لیست (نام، geometry shapely)"""
+    from shapely.geometry import mapping
+
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "properties": {"name": name, "OBJECTID": i}, "geometry": mapping(geom)}
+            for i, (name, geom) in enumerate(items)
+        ],
+    }
+
+
+@pytest.fixture
+def upload_map(app, client):
+    """آپلود یک GeoJSON از طریق پنل ادمین و برگرداندن map_id آن"""
+    def upload(items, name=None):
+        name = name or f"test-map-{uuid.uuid4().hex[:12]}"
+        body = json.dumps(feature_collection(items)).encode("utf-8")
+        response = client.post(
+            "/admin",
+            data={"shapefile": (io.BytesIO(body), f"{name}.geojson"), "map_name": name},
+            content_type="multipart/form-data",
+        )
+        assert response.status_code == 200
+        map_id = app.find_duplicate_map(name, "")
+        assert map_id
+        return map_id
+
+    return upload
@@ -0,0 +1,172 @@
+"""ایندکس مکانی: lookup در برابر بررسی مستقیم shapely، برابری batch و تکی، شبکه، همپوشانی‌ها و همسایگی"""
+
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import MultiPoint, Point, box
+
+BOUNDS = (51.30, 35.60, 51.40, 35.70)
+
+
+def _partition(seed=7, count=40):
+    """افراز نامنظم محدوده به سلول‌های voronoi به علاوه یک محله داخل سوراخ یکی از سلول‌ها"""
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = BOUNDS
+    seeds = MultiPoint(np.column_stack([rng.uniform(minx, maxx, count), rng.uniform(miny, maxy, count)]))
+    cells = [cell.intersection(box(*BOUNDS)) for cell in shapely.get_parts(shapely.voronoi_polygons(seeds))]
+    cells = [cell for cell in cells if not cell.is_empty]
+    inner = cells[0].centroid.buffer(0.002)
+    cells[0] = cells[0].difference(inner)
+    return [(f"محله {i}", cell) for i, cell in enumerate(cells)] + [("داخلی", inner)]
+
+
+def _random_points(seed=11, count=400):
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = BOUNDS
+    # کمی بیرون از محدوده هم نقطه می‌گیریم تا حالت «پیدا نشد» هم بررسی شود
+    return rng.uniform(miny - 0.01, maxy + 0.01, count), rng.uniform(minx - 0.01, maxx + 0.01, count)
+
+
+def _expected_region(items, lat, lon):
+    point = Point(lon, lat)
+    if any(geom.boundary.distance(point) < 1e-9 for _, geom in items):
+        return pytest  # نقطه روی مرز: هر دو جواب درست است
+    return next((name for name, geom in items if geom.contains(point)), None)
+
+
+def _single_region(client, map_id, lat, lon):
+    response = client.get("/api/neighborhood", query_string={"lat": lat, "lon": lon, "map_id": map_id})
+    body = response.get_json()
+    if response.status_code == 404:
+        return None
+    assert response.status_code == 200, body
+    return body["region"]
+
+
+@pytest.mark.parametrize("grid_cells", [256, 0])
+def test_lookup_matches_brute_force(app, client, upload_map, monkeypatch, grid_cells):
+    monkeypatch.setattr(app, "NEIGHBORHOOD_GRID_MAX_CELLS", grid_cells)
+    items = _partition()
+    map_id = upload_map(items)
+    lats, lons = _random_points()
+    checked = 0
+    for lat, lon in zip(lats, lons):
+        expected = _expected_region(items, lat, lon)
+        if expected is pytest:
+            continue
+        assert _single_region(client, map_id, lat, lon) == expected, (lat, lon)
+        checked += 1
+    assert checked > 300
+
+
+def test_batch_matches_single_lookup(app, client, upload_map):
+    items = _partition(seed=3)
+    map_id = upload_map(items)
+    lats, lons = _random_points(seed=5, count=150)
+    response = client.post(
+        f"/api/neighborhood/batch?map_id={map_id}",
+        json=[{"lat": float(lat), "lon": float(lon)} for lat, lon in zip(lats, lons)],
+    )
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert len(results) == len(lats)
+    for result, lat, lon in zip(results, lats, lons):
+        single = client.get("/api/neighborhood", query_string={"lat": lat, "lon": lon, "map_id": map_id}).get_json()
+        assert result == single
+
+
+def test_global_lookup_without_map_id(app, client, upload_map):
+    map_id = upload_map([("دور افتاده", box(60.0, 30.0, 60.01, 30.01))])
+    body = client.get("/api/neighborhood", query_string={"lat": 30.005, "lon": 60.005}).get_json()
+    assert body["region"] == "دور افتاده"
+    assert body["map_id"] == map_id
+
+
+@pytest.mark.parametrize("priority, expected", [
+    ("file_order", {(35.635, 51.335): "big", (35.65, 51.36): "big"}),
+    ("smallest_area", {(35.635, 51.335): "small", (35.65, 51.36): "big"}),
+    ("largest_area", {(35.635, 51.335): "big", (35.65, 51.36): "big"}),
+])
+def test_overlap_priority(app, client, upload_map, monkeypatch, priority, expected):
+    monkeypatch.setattr(app, "OVERLAP_PRIORITY", priority)
+    big = box(51.30, 35.60, 51.40, 35.70)
+    small = box(51.33, 35.63, 51.34, 35.64)
+    map_id = upload_map([("big", big), ("small", small)])
+    for (lat, lon), region in expected.items():
+        assert _single_region(client, map_id, lat, lon) == region
+
+
+def test_covered_feature_keeps_its_record(app, client, upload_map, monkeypatch):
+    monkeypatch.setattr(app, "OVERLAP_PRIORITY", "file_order")
+    map_id = upload_map([("big", box(51.30, 35.60, 51.40, 35.70)), ("covered", box(51.33, 35.63, 51.34, 35.64))])
+    index = app.get_map_index(map_id)
+    assert [app.index_record(index, i)["region"] for i in range(app.index_size(index))] == ["big", "covered"]
+    assert _single_region(client, map_id, 35.635, 51.335) == "big"
+    assert [item["region"] for item in app.search_neighborhoods("covered", map_id=map_id)] == ["covered"]
+
+
+def test_invalid_polygon_is_indexed(app, client, upload_map):
+    bowtie = shapely.Polygon([(51.30, 35.60), (51.40, 35.70), (51.40, 35.60), (51.30, 35.70)])
+    map_id = upload_map([("bowtie", bowtie), ("square", box(51.35, 35.62, 51.45, 35.68))])
+    assert _single_region(client, map_id, 35.65, 51.31) == "bowtie"
+    assert _single_region(client, map_id, 35.65, 51.44) == "square"
+
+
+def test_adjacency(app, upload_map):
+    map_id = upload_map([
+        ("a", box(51.30, 35.60, 51.31, 35.61)),
+        ("b", box(51.31, 35.60, 51.32, 35.61)),
+        ("corner", box(51.32, 35.61, 51.33, 35.62)),
+        ("far", box(51.50, 35.60, 51.51, 35.61)),
+    ])
+    index = app.get_map_index(map_id)
+    neighbors = {
+        app.index_record(index, i)["region"]: sorted(app.index_record(index, int(j))["region"] for j in app.index_neighbors(index, i))
+        for i in range(app.index_size(index))
+    }
+    assert neighbors == {"a": ["b"], "b": ["a"], "corner": [], "far": []}
+
+
+def test_covered_feature_at_index_zero(app, client, upload_map, monkeypatch):
+    """محله پوشانده شده در اولین ردیف (geometry خالی) نباید lookup را با خطا مواجه کند"""
+    monkeypatch.setattr(app, "OVERLAP_PRIORITY", "largest_area")
+    monkeypatch.setattr(app, "NEIGHBORHOOD_GRID_MAX_CELLS", 0)
+    map_id = upload_map([("covered", box(51.33, 35.63, 51.34, 35.64)), ("big", box(51.30, 35.60, 51.40, 35.70))])
+    assert _single_region(client, map_id, 35.635, 51.335) == "big"
+    assert _single_region(client, map_id, 35.65, 51.38) == "big"
+    assert _single_region(client, map_id, 35.80, 51.38) is None
+    response = client.post(
+        f"/api/neighborhood/batch?map_id={map_id}",
+        json=[{"lat": 35.635, "lon": 51.335}, {"lat": 35.80, "lon": 51.38}],
+    )
+    assert response.status_code == 200
+    assert [result.get("region") for result in response.get_json()["results"]] == ["big", None]
+
+
+def test_unscoped_lookup_computes_revision_once(app, client, upload_map, monkeypatch):
+    upload_map([("یک بار", box(61.0, 31.0, 61.01, 31.01))])
+    # اولین درخواست ایندکس سراسری را می‌سازد (ساخت، نسخه را برای حذف نسخه‌های قدیمی دوباره بررسی می‌کند)
+    assert _single_region(client, None, 31.001, 61.001) == "یک بار"
+    real_revision = app.get_lookup_revision
+    calls = []
+
+    def revision(map_id=None):
+        calls.append(map_id)
+        return real_revision(map_id)
+
+    monkeypatch.setattr(app, "get_lookup_revision", revision)
+    for lat, lon in ((31.005, 61.005), (31.006, 61.006)):
+        calls.clear()
+        assert _single_region(client, None, lat, lon) == "یک بار"
+        assert calls == [None]
+        calls.clear()
+        assert client.get("/api/neighborhood/hierarchy", query_string={"lat": lat, "lon": lon}).status_code == 200
+        assert calls == [None]
+
+
+def test_payload_map_name(app, client, upload_map):
+    map_id = upload_map([("نام دار", box(62.0, 32.0, 62.01, 32.01))], name="نقشه نام دار")
+    body = client.get("/api/neighborhood", query_string={"lat": 32.005, "lon": 62.005, "map_id": map_id}).get_json()
+    assert body["map_name"] == "نقشه نام دار"
+    # نقشه‌ای که در تاریخچه نیست نام خالی دارد (نه خطا)
+    assert app._neighborhood_payload(app.get_map_index(map_id), 0, [])["map_name"] == ""
@@ -0,0 +1,93 @@
+"""فایل ستونی نقشه (.store): نوشتن و خواندن دوباره همه انواع داده"""
+
+import uuid
+
+from shapely.geometry import MultiPolygon, Point, box, mapping, shape
+
+
+def _sample_data(map_id):
+    features = [
+        {
+            "type": "Feature",
+            "id": "first",
+            "properties": {
+                "feature_id": "f1", "name": "محله یک", "OBJECTID": 1, "area": 12.5,
+                "active": True, "tags": ["a", "b"], "meta": {"k": 1}, "note": None,
+            },
+            "geometry": mapping(box(51.30, 35.60, 51.31, 35.61)),
+        },
+        {
+            "type": "Feature",
+            "properties": {"feature_id": "f2", "name": "محله دو", "OBJECTID": 2, "area": 3, "extra": "فقط اینجا"},
+            "geometry": mapping(MultiPolygon([box(51.32, 35.60, 51.33, 35.61), box(51.34, 35.60, 51.35, 35.61)])),
+        },
+        {
+            "type": "Feature",
+            "properties": {"feature_id": "f3", "name": "", "OBJECTID": "3", "area": None, "active": False},
+            "geometry": None,
+        },
+        {
+            "type": "Feature",
+            "properties": {"feature_id": "f4", "name": "نقطه", "OBJECTID": 4},
+            "geometry": mapping(Point(51.36, 35.605)),
+        },
+    ]
+    return {
+        "geojson": {"type": "FeatureCollection", "name": "نمونه", "features": features},
+        "summary": {"total_features": len(features)},
+        "original_filename": "sample.geojson",
+        "map_id": map_id,
+        "upload_date": "2024-01-01 00:00:00",
+    }
+
+
+def _same_geometry(a, b):
+    if a is None or b is None:
+        return a is None and b is None
+    return shape(a).equals(shape(b))
+
+
+def test_store_round_trip(app):
+    map_id = uuid.uuid4().hex
+    data = _sample_data(map_id)
+    app.write_map_store(map_id, data)
+    assert app.get_map_store_file(map_id).exists()
+
+    loaded = app.load_map_data(map_id)
+    assert {key: value for key, value in loaded.items() if key != "geojson"} == {
+        key: value for key, value in data.items() if key != "geojson"
+    }
+    assert loaded["geojson"]["name"] == "نمونه"
+    original = data["geojson"]["features"]
+    features = loaded["geojson"]["features"]
+    assert len(features) == len(original)
+    for got, expected in zip(features, original):
+        assert got["properties"] == expected["properties"]
+        assert got.get("id") == expected.get("id")
+        assert _same_geometry(got["geometry"], expected["geometry"])
+
+    assert app.load_map_attributes(map_id) == [feature["properties"] for feature in original]
+
+    geometries = app.load_map_geometries(map_id)
+    assert len(geometries) == len(original)
+    assert geometries[2] is None
+    assert geometries[1].equals(shape(original[1]["geometry"]))
+
+    feature = app.load_map_feature(map_id, "f2")
+    assert feature["properties"] == original[1]["properties"]
+    assert _same_geometry(feature["geometry"], original[1]["geometry"])
+    assert app.load_map_feature(map_id, "missing") is None
+
+
+def test_store_rewrite_replaces_content(app):
+    map_id = uuid.uuid4().hex
+    data = _sample_data(map_id)
+    app.write_map_store(map_id, data)
+    assert len(app.load_map_data(map_id)["geojson"]["features"]) == 4
+
+    data["geojson"]["features"] = data["geojson"]["features"][:1]
+    data["geojson"]["features"][0]["properties"]["name"] = "تغییر کرده"
+    app.write_map_store(map_id, data)
+    loaded = app.load_map_data(map_id)
+    assert [f["properties"]["name"] for f in loaded["geojson"]["features"]] == ["تغییر کرده"]
+    assert app.load_map_feature(map_id, "f2") is None
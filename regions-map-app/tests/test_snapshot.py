@@ -0,0 +1,68 @@
+"""snapshot GeoJSON صفحه نقشه: ETag، حذف نسخه‌های قدیمی و ساخت دوباره فایل حذف شده"""
+
+import json
+
+from shapely.geometry import box
+
+
+def _snapshot_files(app, map_id):
+    return sorted(app.SNAPSHOT_DIR.glob(f"{map_id}.*.geojson"))
+
+
+def test_geojson_route_etag(client, upload_map):
+    map_id = upload_map([("only", box(51.30, 35.60, 51.31, 35.61))])
+    response = client.get(f"/api/maps/{map_id}/geojson")
+    assert response.status_code == 200
+    assert [f["properties"]["name"] for f in json.loads(response.data)["features"]] == ["only"]
+    etag = response.headers["ETag"]
+    assert client.get(f"/api/maps/{map_id}/geojson", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/api/maps/missing/geojson").status_code == 404
+
+
+def test_stale_build_does_not_prune_newer_snapshot(app, upload_map, monkeypatch):
+    map_id = upload_map([("only", box(51.30, 35.60, 51.31, 35.61))])
+    current_file, _ = app.get_map_snapshot(map_id)
+
+    # این worker نسخه قدیمی نقشه را دیده و در حین ساخت، نسخه فعلی توسط worker دیگری ساخته شده است
+    real_revision = app.get_map_revision
+    calls = []
+
+    def revision(requested_map_id):
+        calls.append(requested_map_id)
+        value = real_revision(requested_map_id)
+        return ("stale",) + tuple(value[1:]) if len(calls) == 1 else value
+
+    monkeypatch.setattr(app, "get_map_revision", revision)
+    stale_file, _ = app.get_map_snapshot(map_id)
+    assert stale_file != current_file
+    assert current_file.exists()
+
+    # ساخت با نسخه فعلی، snapshot قدیمی را حذف می‌کند
+    monkeypatch.setattr(app, "get_map_revision", real_revision)
+    current_file.unlink()
+    assert app.get_map_snapshot(map_id)[0] == current_file
+    assert _snapshot_files(app, map_id) == [current_file]
+
+
+def test_missing_snapshot_is_rebuilt(app, upload_map, monkeypatch):
+    map_id = upload_map([("only", box(51.30, 35.60, 51.31, 35.61))])
+    content = app.load_map_snapshot(map_id)
+    snapshot_file, _ = app.get_map_snapshot(map_id)
+    snapshot_file.unlink()
+    assert app.load_map_snapshot(map_id) == content
+    assert snapshot_file.exists()
+
+    # فایل بعد از بررسی وجود و قبل از خواندن حذف می‌شود
+    real_read = app._read_text_file
+    removed = []
+
+    def read(path):
+        if not removed:
+            removed.append(path)
+            path.unlink()
+        return real_read(path)
+
+    app.invalidate_file_cache(snapshot_file)
+    monkeypatch.setattr(app, "_read_text_file", read)
+    assert app.load_map_snapshot(map_id) == content
+    assert removed == [snapshot_file]
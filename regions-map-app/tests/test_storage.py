@@ -0,0 +1,114 @@
+"""نوشتن اتمیک JSON و file_lock بین thread ها و process ها (مثل چند worker gunicorn)"""
+
+import json
+import multiprocessing
+import os
+import threading
+import uuid
+
+import pytest
+
+INCREMENTS = 50
+
+
+def _increment(app, path, count):
+    for _ in range(count):
+        with app.file_lock(path):
+            value = json.loads(path.read_text(encoding="utf-8"))["value"]
+            app.write_json_atomic(path, {"value": value + 1})
+
+
+def _process_increment(path, count):
+    import app as app_module
+
+    _increment(app_module, path, count)
+
+
+@pytest.fixture
+def counter_file(app):
+    path = app.UPLOAD_ROOT / f"counter-{uuid.uuid4().hex}.json"
+    app.write_json_atomic(path, {"value": 0})
+    yield path
+    path.unlink(missing_ok=True)
+    app.remove_lock_file(path)
+
+
+def test_threads_do_not_lose_updates(app, counter_file):
+    threads = [threading.Thread(target=_increment, args=(app, counter_file, INCREMENTS)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert json.loads(counter_file.read_text(encoding="utf-8")) == {"value": 8 * INCREMENTS}
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="نیاز به fork")
+def test_processes_do_not_lose_updates(app, counter_file):
+    if app.fcntl is None:
+        pytest.skip("بدون fcntl قفل بین process ها وجود ندارد")
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_process_increment, args=(counter_file, INCREMENTS)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    # این process هم همزمان می‌نویسد
+    _increment(app, counter_file, INCREMENTS)
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    assert json.loads(counter_file.read_text(encoding="utf-8")) == {"value": 5 * INCREMENTS}
+
+
+def test_readers_never_see_partial_file(app, counter_file):
+    payload = {"value": 0, "padding": "x" * 200000}
+    stop = threading.Event()
+    errors = []
+
+    def write():
+        for i in range(30):
+            app.write_json_atomic(counter_file, {**payload, "value": i})
+        stop.set()
+
+    def read():
+        while not stop.is_set():
+            try:
+                json.loads(counter_file.read_text(encoding="utf-8"))
+            except ValueError as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert json.loads(counter_file.read_text(encoding="utf-8"))["value"] == 29
+    assert not list(counter_file.parent.glob(f".{counter_file.name}.*.tmp"))
+
+
+def test_lock_file_removed_while_waiting(app, counter_file):
+    """حذف فایل قفل (مثل delete_map) نباید باعث شود دو نویسنده همزمان وارد شوند"""
+    inside = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def holder():
+        with app.file_lock(counter_file):
+            order.append("holder")
+            inside.set()
+            release.wait(5)
+            app.remove_lock_file(counter_file)
+            order.append("holder-done")
+
+    def waiter():
+        inside.wait(5)
+        with app.file_lock(counter_file):
+            order.append("waiter")
+
+    threads = [threading.Thread(target=holder), threading.Thread(target=waiter)]
+    for thread in threads:
+        thread.start()
+    inside.wait(5)
+    release.set()
+    for thread in threads:
+        thread.join(10)
+    assert order == ["holder", "holder-done", "waiter"]
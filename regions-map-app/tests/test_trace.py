@@ -0,0 +1,36 @@
+"""API مسیر (/api/neighborhood/trace): محلات عبور شده و اعتبارسنجی بدنه درخواست"""
+
+import pytest
+from shapely.geometry import box
+
+
+def test_trace_crosses_neighborhoods(client, upload_map):
+    map_id = upload_map([("west", box(51.30, 35.60, 51.31, 35.61)), ("east", box(51.31, 35.60, 51.32, 35.61))])
+    response = client.post(
+        f"/api/neighborhood/trace?map_id={map_id}",
+        json={"type": "LineString", "coordinates": [[51.302, 35.605], [51.318, 35.605]]},
+    )
+    assert response.status_code == 200
+    assert [item["region"] for item in response.get_json()["neighborhoods"]] == ["west", "east"]
+
+
+def test_trace_unknown_map(client):
+    response = client.post("/api/neighborhood/trace?map_id=missing", json={"coordinates": [[51.3, 35.6], [51.4, 35.7]]})
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize("payload", [
+    {"coordinates": [5, 6]},
+    {"coordinates": [[51.0], [51.1]]},
+    {"coordinates": [[51.0, 35.0], "51.1,35.1"]},
+    {"type": "LineString", "coordinates": [[51.0], [51.1]]},
+    {"type": "LineString", "coordinates": {"lon": 51.0}},
+    {"type": "Feature", "geometry": {"type": "LineString", "coordinates": [7, 8]}},
+    {"points": [{"lat": 35.6}, {"lat": 35.7}]},
+    {"coordinates": [[51.0, 35.0]]},
+])
+def test_trace_rejects_malformed_coordinates(client, upload_map, payload):
+    map_id = upload_map([("only", box(51.30, 35.60, 51.31, 35.61))])
+    response = client.post(f"/api/neighborhood/trace?map_id={map_id}", json=payload)
+    assert response.status_code == 400
+    assert response.get_json()["success"] is False